@@ -0,0 +1,97 @@
+"""In-process caches shared by the requests of an Application."""
+from collections import OrderedDict
+import threading
+import time
+
+
+_MISSING = object()
+
+
+class LRUCache:
+
+    """A bounded least-recently-used cache.
+
+    Entries can be stored with a version, in which case get only returns the
+    entry if the caller asks for the same version (e.g. a survey's
+    last_update_time), and with a time to live.
+
+    API requests run on the executor's threads, so every operation holds a
+    lock. The hits and misses attributes count the calls to get.
+    """
+
+    def __init__(self, max_size: int, ttl: float=None, clock=time.monotonic):
+        """Create an empty cache.
+
+        :param max_size: the maximum number of entries. If this is 0, nothing
+                         is ever stored.
+        :param ttl: the number of seconds an entry stays valid, or None
+        :param clock: the function giving the current time in seconds
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version=None, default=None):
+        """Return the entry for the key, or the default.
+
+        :param key: the key
+        :param version: the version the entry must have been stored with
+        :param default: the value to return on a miss
+        """
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING:
+                value, entry_version, expires = entry
+                fresh = expires is None or expires > self._clock()
+                if fresh and entry_version == version:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value, version=None) -> None:
+        """Store an entry, evicting the least recently used if full."""
+        if self.max_size <= 0:
+            return
+        expires = None if self.ttl is None else self._clock() + self.ttl
+        with self._lock:
+            self._entries[key] = (value, version, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key) -> None:
+        """Remove the entry for the key, if there is one."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_where(self, predicate) -> None:
+        """Remove the entries whose keys satisfy the predicate."""
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+
+    def clear(self) -> None:
+        """Remove every entry."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """The size and hit/miss counts of the cache."""
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def __len__(self):
+        """The number of entries (including any that have expired)."""
+        return len(self._entries)
@@ -1,9 +1,12 @@
 """Handlers for the API endpoints."""
-from dokomoforms.handlers.api.v0.serializer import ModelJSONSerializer
+from dokomoforms.handlers.api.v0.serializer import (
+    ModelJSONSerializer, FastModelJSONSerializer
+)
 
 from dokomoforms.handlers.api.v0.base import BaseResource
 from dokomoforms.handlers.api.v0.surveys import (
-    SurveyResource, get_survey_for_handler
+    SurveyResource, get_survey_for_handler, get_survey_version_for_handler,
+    get_survey_snapshot_for_handler
 )
 from dokomoforms.handlers.api.v0.submissions import (
     SubmissionResource, get_submission_for_handler
@@ -14,11 +17,12 @@ from dokomoforms.handlers.api.v0.photos import PhotoResource
 
 
 __all__ = (
-    'ModelJSONSerializer',
+    'ModelJSONSerializer', 'FastModelJSONSerializer',
 
     'BaseResource',
 
     'SurveyResource', 'get_survey_for_handler',
+    'get_survey_version_for_handler', 'get_survey_snapshot_for_handler',
     'SubmissionResource', 'get_submission_for_handler',
     'UserResource',
     'NodeResource',
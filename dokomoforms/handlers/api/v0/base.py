@@ -1,34 +1,137 @@
 """The base class of the TornadoResource classes in the api module."""
 from abc import ABCMeta, abstractmethod
-from collections import OrderedDict
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+import binascii
+from collections import namedtuple, OrderedDict
 import datetime
+from functools import partial
+import hashlib
+import json
 import logging
 from time import localtime
+from types import GeneratorType
 
 from passlib.hash import bcrypt_sha256
 
+import psycopg2
+
+from restless.constants import OK
 from restless.tnd import TornadoResource
 import restless.exceptions as exc
 
-from sqlalchemy import text, func
+from sqlalchemy import text, func, and_, or_, true
 from sqlalchemy.sql.functions import count
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm.exc import NoResultFound
 
+from tornado import gen
+from tornado.concurrent import is_future
+from tornado.iostream import StreamClosedError
 import tornado.web
 
 from dokomoforms.exc import SurveyAccessForbidden
-from dokomoforms.handlers.api.v0.serializer import ModelJSONSerializer
+from dokomoforms.handlers.api.v0.serializer import FastModelJSONSerializer
 from dokomoforms.handlers.api.v0.util import filename_safe
 from dokomoforms.handlers.util import BaseHandler, BaseAPIHandler
 from dokomoforms.models import Administrator, Email, Survey, Submission
+from dokomoforms.models.async_db import fetch_all, fetch_scalar
 from dokomoforms.models.survey import (
     administrator_filter, _administrator_table
 )
-from dokomoforms.models.util import column_search, get_fields_subset, get_model
+from dokomoforms.models.util import (
+    column_search, get_fields_subset, get_fields_projection, get_model,
+    ModelJSONEncoder
+)
 from dokomoforms.exc import DokomoError
 
 
+# Marks the end of a streamed response body, see BaseResource._stream
+_END_OF_STREAM = object()
+
+
+# The Content-Type of each format= other than json
+_CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'geojson': 'application/geo+json',
+}
+
+
+# The queries for a list response, see BaseResource._list_plan
+_ListPlan = namedtuple(
+    '_ListPlan',
+    'total filtered page projection order_by_text keyset_columns'
+    ' counted_over limit'
+)
+
+
+def _encode_cursor(order_by, values) -> str:
+    """Return an opaque token for the position after the given values.
+
+    :param order_by: the (attribute name, direction) pairs of the ordering
+    :param values: the values of the ordering attributes in the last row
+    """
+    payload = json.dumps(
+        {'order_by': order_by, 'values': values},
+        cls=ModelJSONEncoder, separators=(',', ':'),
+    )
+    return urlsafe_b64encode(payload.encode()).decode()
+
+
+def _decode_cursor(cursor, order_by) -> list:
+    """Return the values stored in a cursor created by _encode_cursor.
+
+    :raises ValueError: if the cursor is garbled or was created for a
+                        different ordering
+    """
+    try:
+        payload = json.loads(urlsafe_b64decode(cursor.encode()).decode())
+        cursor_order_by = [list(pair) for pair in payload['order_by']]
+        values = payload['values']
+    except (binascii.Error, UnicodeError, ValueError, KeyError, TypeError):
+        raise ValueError('invalid cursor: {}'.format(cursor))
+    if cursor_order_by != [list(pair) for pair in order_by]:
+        raise ValueError('cursor does not match order_by')
+    if len(values) != len(order_by):
+        raise ValueError('invalid cursor: {}'.format(cursor))
+    return values
+
+
+def _keyset_filter(columns, values):
+    """Return the filter for the rows after the given keyset position.
+
+    The ordering is NULLS LAST in both directions, so for a non-NULL value the
+    rows after it are the ones strictly past it or NULL, and for a NULL value
+    only the other NULL rows tie with it.
+
+    :param columns: the (column, direction) pairs of the ordering, the last of
+                    which must be unique and not nullable
+    :param values: the values of the columns in the last row of the page
+    """
+    clauses = []
+    equal_so_far = []
+    for (column, direction), value in zip(columns, values):
+        if value is None:
+            equal_so_far.append(column.is_(None))
+            continue
+        if direction == 'asc':
+            past = column > value
+        else:
+            past = column < value
+        clauses.append(and_(*(equal_so_far + [or_(past, column.is_(None))])))
+        equal_so_far.append(column == value)
+    if not clauses:
+        return ~true()
+    return or_(*clauses)
+
+
+def _projected_dict(projection, row) -> OrderedDict:
+    """Build the response for one row selected with a fields= projection."""
+    return OrderedDict(
+        (name, convert(value))
+        for (name, _, convert), value in zip(projection, row)
+    )
+
+
 class BaseResource(TornadoResource, metaclass=ABCMeta):
 
     """Set up the basics for the model resource.
@@ -43,7 +146,10 @@ class BaseResource(TornadoResource, metaclass=ABCMeta):
     _request_handler_base_ = BaseAPIHandler
 
     # The serializer is used to serialize / deserialize models to json
-    serializer = ModelJSONSerializer()
+    serializer = FastModelJSONSerializer()
+
+    # Set by _not_modified
+    _etag_matches = False
 
     @property  # pragma: no cover
     @abstractmethod
@@ -65,18 +171,58 @@ class BaseResource(TornadoResource, metaclass=ABCMeta):
         """The handler's session."""
         return self.r_handler.session
 
+    @property
+    def db_pool(self):
+        """The application's momoko pool, or None.
+
+        See dokomoforms.models.async_db
+        """
+        return getattr(self.application, 'db_pool', None)
+
+    @property
+    def survey_cache(self):
+        """The application's cache of SurveySnapshots, or None.
+
+        See dokomoforms.models.snapshot
+        """
+        return getattr(self.application, 'survey_cache', None)
+
+    @property
+    def principal_cache(self):
+        """The application's cache of Principals, or None.
+
+        See dokomoforms.models.principal
+        """
+        return getattr(self.application, 'principal_cache', None)
+
+    @property
+    def menu_cache(self):
+        """The application's cache of survey menus, or None.
+
+        See dokomoforms.models.survey.menu_surveys
+        """
+        return getattr(self.application, 'menu_cache', None)
+
     @property
     def current_user_model(self):
-        """The handler's current_user_model."""
+        """The handler's current_user_model.
+
+        Falls back to the Administrator named in the Email header, which is
+        looked up once per request and remembered on the handler.
+        """
         logged_in_user = self.r_handler.current_user_model
         if logged_in_user:
             return logged_in_user
+        try:
+            return self.r_handler._email_user_model
+        except AttributeError:
+            pass
         try:
             email = self.r_handler.request.headers['Email']
         except KeyError:
             return None
         try:
-            return (
+            user = (
                 self.session
                 .query(Administrator)
                 .join(Email)
@@ -84,7 +230,9 @@ class BaseResource(TornadoResource, metaclass=ABCMeta):
                 .one()
             )
         except NoResultFound:
-            return None
+            user = None
+        self.r_handler._email_user_model = user
+        return user
 
     @property
     def current_user(self):
@@ -105,6 +253,7 @@ class BaseResource(TornadoResource, metaclass=ABCMeta):
         modifiers = set(self.request.arguments)
         modifiers.discard('format')
         modifiers.discard('dialect')
+        modifiers.discard('layout')
         return bool(modifiers)
 
     def _set_filename(self, filename, extension):
@@ -150,18 +299,145 @@ class BaseResource(TornadoResource, metaclass=ABCMeta):
     def build_response(self, data, status=200):
         """Finish the Tornado response.
 
-        This takes into account non-JSON content-types.
+        This takes into account non-JSON content-types. If the data is an
+        generator of chunks rather than a string, the response is streamed and
+        the returned future resolves when it is done.
         """
-        if self.content_type == 'csv':
-            content_type = 'text/csv'
-        else:
-            content_type = 'application/json'
+        content_type = _CONTENT_TYPES.get(
+            self.content_type, 'application/json'
+        )
         self.ref_rh.set_header(
             'Content-Type', '{}; charset=UTF-8'.format(content_type)
         )
+        if self._etag_matches:
+            self.ref_rh.set_status(304)
+            self.ref_rh.finish()
+            return
         self.ref_rh.set_status(status)
+        if isinstance(data, GeneratorType):
+            return self._stream(data)
         self.ref_rh.finish(data)
 
+    def _not_modified(self, etag) -> bool:
+        """Set the ETag of the response and check the If-None-Match header.
+
+        If this returns True the client already has the response, so the
+        view can return None without loading anything and build_response
+        answers 304 Not Modified.
+        """
+        self.ref_rh.set_header('Etag', etag)
+        self._etag_matches = self.ref_rh.check_etag_header()
+        return self._etag_matches
+
+    @gen.coroutine
+    def _run(self, fn, *args):
+        """Run fn(*args) on the application's executor.
+
+        Without an executor, fn runs right away on the IOLoop.
+        """
+        executor = getattr(self.application, 'executor', None)
+        if executor is None:
+            return fn(*args)
+        result = yield executor.submit(fn, *args)
+        return result
+
+    @gen.coroutine
+    def _stream(self, chunks):
+        """Write the response body one chunk at a time.
+
+        Each chunk is produced on the executor and flushed to the client
+        before the next one is produced, so only one chunk needs to be in
+        memory at a time.
+        """
+        try:
+            while True:
+                chunk = yield self._run(next, chunks, _END_OF_STREAM)
+                if chunk is _END_OF_STREAM:
+                    break
+                self.ref_rh.write(chunk)
+                yield self.ref_rh.flush()
+        except StreamClosedError:
+            # The client went away
+            return
+        finally:
+            chunks.close()
+        self.ref_rh.finish()
+
+    def _check(self, method, endpoint):
+        """Check the method and authentication, then deserialize the body.
+
+        This is the start of restless.tnd.TornadoResource.handle
+        """
+        if method not in self.http_methods.get(endpoint, {}):
+            raise exc.MethodNotImplemented(
+                "Unsupported method '{}' for {} endpoint.".format(
+                    method, endpoint
+                )
+            )
+        if not self.is_authenticated():
+            raise exc.Unauthorized()
+        self.data = self.deserialize(method, endpoint, self.request_body())
+
+    def _view(self, method, endpoint, *args, **kwargs):
+        """Run and serialize the view for the request.
+
+        This is the part of the request that talks to the database, so handle
+        runs it on the executor.
+        """
+        self._check(method, endpoint)
+        view_method = getattr(self, self.http_methods[endpoint][method])
+        return self.serialize(
+            method, endpoint, view_method(*args, **kwargs)
+        )
+
+    @gen.coroutine
+    def _async_view(self, view_method, method, endpoint, *args, **kwargs):
+        """Run an async_ view on the IOLoop, see handle."""
+        yield self._run(self._check, method, endpoint)
+        data = yield view_method(*args, **kwargs)
+        serialized = yield self._run(self.serialize, method, endpoint, data)
+        return serialized
+
+    def _async_view_method(self, method, endpoint):
+        """The async_ version of the view for the request, or None."""
+        if self.db_pool is None:
+            return None
+        view_name = self.http_methods.get(endpoint, {}).get(method)
+        if view_name is None:
+            return None
+        return getattr(self, 'async_' + view_name, None)
+
+    @gen.coroutine
+    def handle(self, endpoint, *args, **kwargs):
+        """Handle the request without blocking the IOLoop on the database.
+
+        The view runs on the application's executor (see _view), and the
+        response is built on the IOLoop. Streamed responses are waited for.
+
+        If the application has an async pool and the resource has an async_
+        version of the view (e.g. async_list for list), that coroutine runs
+        on the IOLoop instead, without holding a thread while it waits.
+        """
+        method = self.request_method()
+        async_view = self._async_view_method(method, endpoint)
+        if async_view is None:
+            view = self._run(
+                partial(self._view, method, endpoint, *args, **kwargs)
+            )
+        else:
+            view = self._async_view(
+                async_view, method, endpoint, *args, **kwargs
+            )
+        try:
+            serialized = yield view
+        except Exception as err:
+            self.handle_error(err)
+            return
+        status = self.status_map.get(self.http_methods[endpoint][method], OK)
+        response = self.build_response(serialized, status=status)
+        if is_future(response):
+            yield response
+
     def handle_error(self, err):
         """Generate a serialized error message.
 
@@ -171,7 +447,7 @@ class BaseResource(TornadoResource, metaclass=ABCMeta):
         """
         understood = (
             KeyError, ValueError, TypeError, AttributeError,
-            SQLAlchemyError, DokomoError
+            SQLAlchemyError, psycopg2.Error, DokomoError
         )
 
         if isinstance(err, tornado.web.HTTPError):
@@ -211,6 +487,13 @@ class BaseResource(TornadoResource, metaclass=ABCMeta):
             ('total_entries', data[1]),
             ('filtered_entries', data[0]),
         ))
+        # count=false skips the totals
+        if data[1] is None:
+            del response['total_entries']
+        if data[0] is None:
+            del response['filtered_entries']
+        if len(data) > 3 and data[3] is not None:
+            response['next_cursor'] = data[3]
         # add additional properties to the response object
         full_response = self._add_meta_props(response)
 
@@ -225,7 +508,7 @@ class BaseResource(TornadoResource, metaclass=ABCMeta):
         if self.r_handler.current_user is not None:
             not_an_admin_but_should_be = (
                 admin_only and
-                self.r_handler.current_user_model.role != 'administrator'
+                not self.r_handler.current_principal.is_administrator
             )
             if not_an_admin_but_should_be:
                 return False
@@ -254,7 +537,20 @@ class BaseResource(TornadoResource, metaclass=ABCMeta):
             return False
         if user.token_expiration.timetuple() < localtime():
             return False
-        return bcrypt_sha256.verify(token, user.token)
+        # bcrypt is slow on purpose, so a token that checks out is cached
+        # (as a hash) for a while. The entry is only good for the stored
+        # token hash, so generating a new token invalidates it.
+        application = getattr(self, 'application', None)
+        token_cache = getattr(application, 'token_cache', None)
+        token_key = (email, hashlib.sha256(token.encode()).hexdigest())
+        stored_token = bytes(user.token)
+        if token_cache is not None:
+            if token_cache.get(token_key, stored_token):
+                return True
+        verified = bcrypt_sha256.verify(token, user.token)
+        if verified and token_cache is not None:
+            token_cache.put(token_key, True, stored_token)
+        return verified
 
     def _specific_fields(self, model_or_models, is_detail=True):
         """Pick out the specified fields on the given models.
@@ -273,50 +569,73 @@ class BaseResource(TornadoResource, metaclass=ABCMeta):
         models = model_or_models
         return [get_fields_subset(model, fields) for model in models]
 
+    def _projection(self):
+        """The SQL projection for the fields= argument, or None.
+
+        See dokomoforms.models.util.get_fields_projection
+        """
+        fields = self._query_arg('fields', list)
+        if fields is None or self.content_type == 'csv':
+            return None
+        return get_fields_projection(self.resource_type, fields)
+
     def detail(self, model_id):
         """Return a single instance of a model."""
-        return self._specific_fields(self._get_model(model_id))
+        projection = self._projection()
+        if projection is None:
+            return self._specific_fields(self._get_model(model_id))
+        row = (
+            self.session
+            .query(*(column for _, column, _ in projection))
+            .filter(self.resource_type.id == model_id)
+            .one()
+        )
+        return _projected_dict(projection, row)
 
-    def list(self, where=None):
-        """Return a list of instances of this model.
+    def _list_query(self, where=None, projection=None):
+        """Build the filtered and ordered query for list responses.
 
-        Given a model class, build up the ORM query based on query params
-        and return the query result.
+        The result is a tuple of (query, the ORDER BY (attribute name,
+        direction) pairs, the (column, direction) pairs for the keyset cursor).
+        The keyset columns are None if the ordering uses something other than
+        the model's attributes.
+
+        :param where: an optional extra filter
+        :param projection: an optional fields= projection from _projection
         """
-        self.session.flush()
         model_cls = self.resource_type
-        query = self.session.query(model_cls, count().over())
 
-        limit = self._query_arg('limit', int)
-        offset = self._query_arg('offset', int)
         deleted = self._query_arg('show_deleted', bool, False)
         search_term = self._query_arg('search')
         regex = self._query_arg('regex', bool, False)
+        rank = self._query_arg('rank', bool, False)
         search_fields = self._query_arg(
             'search_fields', list, default=['title']
         )
         search_lang = self._query_arg('lang')
 
         default_sort = ['{}:ASC'.format(self.default_sort_column_name)]
-        order_by_text = (
+        order_by_text = [
             element.split(':') for element in self._query_arg(
                 'order_by', list, default=default_sort
             )
-        )
+        ]
+        if 'id' not in (attribute_name for attribute_name, _ in order_by_text):
+            order_by_text.append(['id', 'ASC'])
 
         type_constraint = self._query_arg('type')
         user_id = self._query_arg('user_id')
 
-        num_total = self.session.query(func.count(self.resource_type.id))
-        if user_id is not None:
-            if model_cls is Submission:
-                num_total = num_total.join(Survey.submissions)
-            num_total = (
-                num_total
-                .outerjoin(_administrator_table)
-                .filter(administrator_filter(user_id))
+        if projection is None:
+            query = self.session.query(model_cls)
+        else:
+            # Select only the requested columns, followed by the ORDER BY
+            # columns for the cursor.
+            query = (
+                self.session
+                .query(*(column for _, column, _ in projection))
+                .select_from(model_cls)
             )
-        num_total = num_total.scalar()
 
         if search_term is not None:
             for search_field in search_fields:
@@ -327,6 +646,7 @@ class BaseResource(TornadoResource, metaclass=ABCMeta):
                     search_term=search_term,
                     language=search_lang,
                     regex=regex,
+                    rank=rank,
                 )
 
         if user_id is not None:
@@ -347,31 +667,182 @@ class BaseResource(TornadoResource, metaclass=ABCMeta):
         if where is not None:
             query = query.filter(where)
 
+        # A ranked search orders by similarity first, which a cursor can't
+        # follow.
+        ranked = search_term is not None and rank
+        keyset_columns = None if ranked else []
         for attribute_name, direction in order_by_text:
             try:
                 order = getattr(model_cls, attribute_name)
             except AttributeError:
+                keyset_columns = None
                 order = text(
                     '{} {} NULLS LAST'.format(attribute_name, direction)
                 )
             else:
+                if keyset_columns is not None:
+                    keyset_columns.append((order, direction.lower()))
                 directions = {'asc': order.asc, 'desc': order.desc}
                 order = directions[direction.lower()]().nullslast()
             query = query.order_by(order)
 
+        return query, order_by_text, keyset_columns
+
+    def _seek(self, query, order_by_text, keyset_columns):
+        """Apply the after= cursor to a query from _list_query."""
+        after = self._query_arg('after')
+        if after is None:
+            return query
+        if keyset_columns is None:
+            raise ValueError('after= requires ordering by attributes')
+        values = _decode_cursor(after, order_by_text)
+        return query.filter(_keyset_filter(keyset_columns, values))
+
+    def _limit(self, query):
+        """Apply the limit= and offset= arguments to a query."""
+        limit = self._query_arg('limit', int)
+        offset = self._query_arg('offset', int)
         if limit is not None:
             query = query.limit(limit)
-
         if offset is not None:
             query = query.offset(offset)
+        return query
+
+    def _list_plan(self, where=None) -> _ListPlan:
+        """Build the queries for a list response without running them.
+
+        list runs these queries on the session and async_list runs them with
+        dokomoforms.models.async_db, and both turn the results into a
+        response with _list_result.
+        """
+        model_cls = self.resource_type
+
+        limit = self._query_arg('limit', int)
+        after = self._query_arg('after')
+        with_counts = self._query_arg('count', bool, True)
+        user_id = self._query_arg('user_id')
+
+        total = None
+        if with_counts:
+            total = self.session.query(func.count(model_cls.id))
+            if user_id is not None:
+                if model_cls is Submission:
+                    total = total.join(Survey.submissions)
+                total = (
+                    total
+                    .outerjoin(_administrator_table)
+                    .filter(administrator_filter(user_id))
+                )
+
+        projection = self._projection()
+        query, order_by_text, keyset_columns = self._list_query(
+            where, projection
+        )
+
+        if projection is not None and keyset_columns is not None:
+            query = query.add_columns(
+                *(column for column, _ in keyset_columns)
+            )
+
+        filtered = None
+        if after is not None:
+            if with_counts and keyset_columns is not None:
+                filtered = (
+                    self.session
+                    .query(func.count())
+                    .select_from(query.order_by(None).subquery())
+                )
+            query = self._seek(query, order_by_text, keyset_columns)
+        elif with_counts:
+            query = query.add_columns(count().over())
+
+        return _ListPlan(
+            total, filtered, self._limit(query), projection, order_by_text,
+            keyset_columns, with_counts and after is None, limit,
+        )
+
+    def _list_result(self, plan, num_total, num_filtered, result) -> tuple:
+        """Turn the results of the queries from _list_plan into a response.
+
+        See list for the result.
+        """
+        projection = plan.projection
+        if plan.counted_over:
+            num_filtered = result[0][-1] if result else 0
+            result = [res[:-1] for res in result]
+            if projection is None:
+                result = [res[0] for res in result]
+
+        next_cursor = None
+        limit = plan.limit
+        page_is_full = limit is not None and limit > 0 and len(result) == limit
+        if page_is_full and plan.keyset_columns is not None:
+            last = result[-1]
+            if projection is None:
+                values = [
+                    getattr(last, name) for name, _ in plan.order_by_text
+                ]
+            else:
+                values = list(last[len(projection):])
+            next_cursor = _encode_cursor(plan.order_by_text, values)
+
+        if projection is not None:
+            result = [_projected_dict(projection, row) for row in result]
+        elif result:
+            result = self._specific_fields(result, is_detail=False)
+        return num_filtered, num_total, result, next_cursor
 
-        result = query.all()
-        if result:
-            num_filtered = result[0][1]
-            models = [res[0] for res in result]
-            result = self._specific_fields(models, is_detail=False)
-            return num_filtered, num_total, result
-        return 0, num_total, []
+    def list(self, where=None):
+        """Return a list of instances of this model.
+
+        Given a model class, build up the ORM query based on query params
+        and return the query result.
+
+        The result is a tuple of (number of filtered entries, number of total
+        entries, models, cursor for the next page). The counts are None if the
+        request asked for count=false, and the cursor is None unless a limit
+        was given and the page is full.
+
+        Passing the cursor back as the after= parameter continues the listing
+        from where the page ended by seeking on the ORDER BY columns (plus the
+        id as a tiebreaker) rather than with OFFSET, so deep pages cost the
+        same as the first one.
+        """
+        self.session.flush()
+        plan = self._list_plan(where)
+        num_total = None if plan.total is None else plan.total.scalar()
+        num_filtered = (
+            None if plan.filtered is None else plan.filtered.scalar()
+        )
+        return self._list_result(
+            plan, num_total, num_filtered, plan.page.all()
+        )
+
+    @gen.coroutine
+    def async_list(self, where=None):
+        """list, with the queries run on the async pool.
+
+        Only fields= projections select plain rows, so other list requests
+        run list on the executor instead.
+        """
+        if self._projection() is None:
+            result = yield self._run(self.list, where)
+            return result
+        plan = self._list_plan(where)
+        queries = {'page': fetch_all(self.db_pool, plan.page, self.session)}
+        if plan.total is not None:
+            queries['total'] = fetch_scalar(
+                self.db_pool, plan.total, self.session
+            )
+        if plan.filtered is not None:
+            queries['filtered'] = fetch_scalar(
+                self.db_pool, plan.filtered, self.session
+            )
+        results = yield queries
+        return self._list_result(
+            plan, results.get('total'), results.get('filtered'),
+            results['page'],
+        )
 
     def update(self, model_id):
         """Update a model."""
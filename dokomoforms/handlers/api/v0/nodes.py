@@ -1,7 +1,7 @@
 """TornadoResource class for dokomoforms.models.node.Node subclasses."""
 from dokomoforms.handlers.api.v0 import BaseResource
 from dokomoforms.models import (
-    Node, Choice, construct_node
+    Node, Choice, Survey, SurveyNode, construct_node, touch_surveys
 )
 
 
@@ -34,6 +34,32 @@ class NodeResource(BaseResource):
 
         return node
 
+    def update(self, node_id):
+        """Update a node, and touch the surveys that contain it."""
+        node = super().update(node_id)
+        self._touch_surveys(node_id)
+        return node
+
+    def delete(self, node_id):
+        """Mark a node deleted, and touch the surveys that contain it."""
+        super().delete(node_id)
+        self._touch_surveys(node_id)
+
+    def _touch_surveys(self, node_id):
+        """Update the last_update_time of the surveys that contain the node.
+
+        Changing a node doesn't change the survey rows, so their snapshots
+        and ETags wouldn't change otherwise.
+        """
+        containing_ids = (
+            self.session
+            .query(SurveyNode.containing_survey_id)
+            .filter_by(node_id=node_id)
+        )
+        touch_surveys(
+            self.session, Survey.containing_id.in_(containing_ids.subquery())
+        )
+
     # def prepare(self, data):
     #     """Determine which fields to return.
 
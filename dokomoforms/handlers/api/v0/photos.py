@@ -1,30 +1,168 @@
 """TornadoResource class for dokomoforms.models.answer.Photo."""
+from base64 import b64decode
+from collections import namedtuple
+
+from restless.constants import CREATED
+
 from dokomoforms.handlers.api.v0 import BaseResource
 from dokomoforms.models import Photo, add_new_photo_to_session
 
 
+# The response of PhotoResource.image
+_PhotoImage = namedtuple(
+    '_PhotoImage', 'mime_type size chunks accel_redirect'
+)
+
+
+# A Photo's image never changes, so browsers can keep it
+_IMAGE_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
+
 class PhotoResource(BaseResource):
 
-    """Restless resource for Photos."""
+    """Restless resource for Photos.
+
+    The JSON form of a Photo is its metadata and the image_url of the image.
+    Images are sent and received as they are (not base64 encoded) at
+    /photos/<id>/image.
+    """
 
     resource_type = Photo
     default_sort_column_name = 'created_on'
     objects_key = 'photos'
 
+    http_methods = dict(
+        BaseResource.http_methods, image={'GET': 'image', 'POST': 'upload'}
+    )
+
+    def __init__(self, *args, **kwargs):
+        """Make upload return 201."""
+        super().__init__(*args, **kwargs)
+        self.status_map['upload'] = CREATED
+
     def is_authenticated(self):
         """Allow unauthenticated POSTs."""
         if self.request_method() == 'POST':
             return True
         return super().is_authenticated()
 
-    def create(self):
-        """Create a Photo. Must match an existing PhotoAnswer."""
+    def deserialize(self, method, endpoint, body):
+        """The body of an image request is the image, not JSON."""
+        if endpoint == 'image':
+            return None
+        return super().deserialize(method, endpoint, body)
+
+    def _photo_json(self, photo):
+        """The metadata of a Photo, plus the URL of its image."""
+        if not isinstance(photo, Photo):
+            # A fields= subset
+            return photo
+        result = photo._asdict()
+        result['image_url'] = (
+            self.application.reverse_url('photo_image', photo.id).rstrip('/?')
+        )
+        return result
+
+    def prepare(self, data):
+        """Add the image_url to the JSON of a Photo."""
+        return self._photo_json(data)
+
+    def wrap_list_response(self, data):
+        """Add the image_url to the JSON of each Photo in a list."""
+        photos = [self._photo_json(photo) for photo in data[2]]
+        data = tuple(data[:2]) + (photos,) + tuple(data[3:])
+        return super().wrap_list_response(data)
+
+    def _check_xsrf_if_anonymous(self):
+        """POSTs don't need a login, but they need the XSRF cookie then."""
         authenticated = super().is_authenticated()
         if not authenticated:
             self._check_xsrf_cookie()
 
-        self.data['image'] = self.data['image'].encode()
-        photo = add_new_photo_to_session(self.session, **self.data)
-        photo_dict = photo._asdict()
-        del photo_dict['image']
-        return photo_dict
+    def _add_photo(self, photo_id, image, mime_type):
+        """Store the photo with the application's photo_storage."""
+        return add_new_photo_to_session(
+            self.session,
+            id=photo_id,
+            mime_type=mime_type,
+            image=image,
+            storage=self.application.photo_storage,
+        )
+
+    def create(self):
+        """Create a Photo. Must match an existing PhotoAnswer.
+
+        The image arrives base64 encoded in the JSON body. Uploading it to
+        /photos/<id>/image instead saves the encoding.
+        """
+        self._check_xsrf_if_anonymous()
+        return self._add_photo(
+            self.data['id'], b64decode(self.data['image']),
+            self.data['mime_type'],
+        )
+
+    def upload(self, photo_id):
+        """Create a Photo from an image sent as it is.
+
+        The image is either the request body, with its Content-Type as the
+        mime_type, or the first file of a multipart/form-data request.
+        """
+        self._check_xsrf_if_anonymous()
+        request = self.r_handler.request
+        files = [
+            photo_file
+            for field_files in request.files.values()
+            for photo_file in field_files
+        ]
+        if files:
+            image = files[0]['body']
+            mime_type = files[0]['content_type']
+        else:
+            image = request.body
+            mime_type = request.headers.get('Content-Type')
+        if not image:
+            raise ValueError('No image in the request.')
+        if not mime_type:
+            raise ValueError('No Content-Type for the image.')
+        return self._add_photo(photo_id, image, mime_type)
+
+    def image(self, photo_id):
+        """Return the image of a Photo, to be streamed as it is.
+
+        The image is identified by its content hash (or, for photos stored
+        before there were hashes, its id), so a browser that has it already
+        gets a 304 Not Modified.
+        """
+        photo = self._get_model(photo_id)
+        self.ref_rh.set_header('Cache-Control', _IMAGE_CACHE_CONTROL)
+        etag = '"{}"'.format(photo.content_hash or photo.id)
+        if self._not_modified(etag):
+            return None
+        storage = self.application.photo_storages[photo.storage]
+        accel_redirect = storage.accel_redirect(photo)
+        return _PhotoImage(
+            mime_type=photo.mime_type,
+            size=photo.size,
+            chunks=None if accel_redirect else storage.chunks(photo),
+            accel_redirect=accel_redirect,
+        )
+
+    def serialize(self, method, endpoint, data):
+        """Images are not serialized."""
+        if endpoint == 'image' and method == 'GET':
+            return data
+        return super().serialize(method, endpoint, data)
+
+    def build_response(self, data, status=200):
+        """Send an image, or hand it to nginx with X-Accel-Redirect."""
+        if not isinstance(data, _PhotoImage):
+            return super().build_response(data, status=status)
+        self.ref_rh.set_status(status)
+        self.ref_rh.set_header('Content-Type', data.mime_type)
+        if data.accel_redirect is not None:
+            self.ref_rh.set_header('X-Accel-Redirect', data.accel_redirect)
+            self.ref_rh.finish()
+            return
+        if data.size is not None:
+            self.ref_rh.set_header('Content-Length', data.size)
+        return self._stream(data.chunks)
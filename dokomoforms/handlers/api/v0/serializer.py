@@ -1,9 +1,30 @@
 """The restless Serializer for the models."""
 from restless.serializers import JSONSerializer
-from dokomoforms.models import ModelJSONEncoder
+from dokomoforms.models import ModelJSONEncoder, fast_json_dumps
 import json
 
 
+class RawJSON(str):
+
+    """A string of JSON that the serializers return as it is.
+
+    For responses that are already serialized, like a cached survey.
+    """
+
+
+def _is_formatted(data) -> bool:
+    """Whether the data is a {'format': 'csv' or 'geojson', 'data': ...} dict.
+
+    The data of such a dict is already serialized (or a generator of
+    serialized chunks).
+    """
+    try:
+        content_type = data.get('format', 'json').lower()
+    except AttributeError:  # Got a model rather than a dict
+        return False
+    return content_type in {'csv', 'geojson'}
+
+
 class ModelJSONSerializer(JSONSerializer):
 
     """Drop-in replacement for the restless-supplied JSONSerializer.
@@ -23,11 +44,25 @@ class ModelJSONSerializer(JSONSerializer):
         :returns: A serialized version of the data
         :rtype: string
         """
-        try:
-            content_type = data.get('format', 'json').lower()
-        except AttributeError:  # Got a model rather than a dict
-            pass
-        else:
-            if content_type == 'csv':
-                return data['data']
+        if isinstance(data, RawJSON):
+            return data
+        if _is_formatted(data):
+            return data['data']
         return json.dumps(data, cls=ModelJSONEncoder).replace('</', '<\\/')
+
+
+class FastModelJSONSerializer(ModelJSONSerializer):
+
+    """ModelJSONSerializer that uses dokomoforms.models.fast_json_dumps.
+
+    The output is the same, but the encoding is done in one pass with the
+    converters looked up by type.
+    """
+
+    def serialize(self, data):
+        """The low-level serialization, using fast_json_dumps."""
+        if isinstance(data, RawJSON):
+            return data
+        if _is_formatted(data):
+            return data['data']
+        return fast_json_dumps(data)
@@ -1,31 +1,93 @@
 """TornadoResource class for dokomoforms.models.submission.Submission."""
+from collections import defaultdict
 from contextlib import closing
-from csv import DictWriter
+from csv import DictWriter, writer
 from io import StringIO
-from itertools import chain
+from itertools import islice
+
+import psycopg2
 
 import restless.exceptions as exc
 
+import tornado.web
+
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import with_polymorphic
+from sqlalchemy.orm.attributes import set_committed_value
+
 from dokomoforms.handlers.api.v0 import BaseResource
 from dokomoforms.models import (
-    Survey, Submission, User,
-    construct_submission, construct_answer, Answer,
-    SurveyNode, skipped_required,
-    get_model
+    Submission, User,
+    construct_submission, Answer, insert_answers,
+    Survey, SurveyNode, compile_required_check, get_survey_snapshot,
 )
-from dokomoforms.models.answer import ANSWER_TYPES
-from dokomoforms.exc import RequiredQuestionSkipped
+from dokomoforms.models.export import (
+    WIDE_SUBMISSION_COLUMNS, wide_columns, pivot_submissions
+)
+from dokomoforms.exc import DokomoError, RequiredQuestionSkipped
+
+
+CSV_FIELDNAMES = [
+    'id', 'deleted', 'answer_number', 'submission_id', 'save_time',
+    'survey_id', 'survey_node_id', 'question_id', 'type_constraint',
+    'last_update_time', 'main_answer', 'response', 'response_type',
+    'metadata'
+]
+
+
+def _answer_survey_nodes(session, raw_answers) -> list:
+    """Pair each answer with its SurveyNode.
+
+    The nodes are fetched with a single query.
+
+    :return: a list of (AnswerableSurveyNode, answer dict) tuples for
+             dokomoforms.models.answer.insert_answers
+    """
+    survey_nodes = {}
+    survey_node_ids = {answer['survey_node_id'] for answer in raw_answers}
+    if survey_node_ids:
+        survey_nodes.update(
+            (survey_node.id, survey_node) for survey_node in (
+                session
+                .query(SurveyNode)
+                .filter(SurveyNode.id.in_(survey_node_ids))
+            )
+        )
+    result = []
+    for raw_answer in raw_answers:
+        answer = dict(raw_answer)
+        survey_node_id = answer.pop('survey_node_id')
+        try:
+            survey_node = survey_nodes[survey_node_id]
+        except KeyError:
+            raise exc.BadRequest(
+                'survey_node not found: {}'.format(survey_node_id)
+            )
+        result.append((survey_node, answer))
+    return result
+
+
+def _submission_survey(self, survey_id, exception=None) -> tuple:
+    """Get the survey to submit to and its check for skipped questions.
 
+    The check comes from the survey's snapshot, so when the snapshot is in
+    the survey cache the survey tree isn't loaded: only the Survey row is,
+    and _answer_survey_nodes fetches the answered SurveyNodes in one query.
 
-def _create_answer(session, answer_dict) -> Answer:
-    survey_node_id = answer_dict['survey_node_id']
-    error = exc.BadRequest('survey_node not found: {}'.format(survey_node_id))
-    survey_node = get_model(session, SurveyNode, survey_node_id, error)
-    answer_dict['survey_node'] = survey_node
-    return construct_answer(**answer_dict)
+    :param survey_id: the UUID of the Survey
+    :param exception: the exception to raise if there is no such Survey
+    :return: a tuple of (the Survey, its compiled check for skipped
+             questions, see dokomoforms.models.survey.compile_required_check)
+    """
+    survey_cache = getattr(self.application, 'survey_cache', None)
+    snapshot = get_survey_snapshot(
+        self.session, survey_cache, survey_id, exception
+    )
+    survey = self.session.query(Survey).get(survey_id)
+    return survey, snapshot.skipped_required
 
 
-def _create_submission(self, survey):
+def _check_submission_access(self, survey):
     # Unauthenticated submissions are only allowed if the survey_type is
     # 'public'.
     authenticated = super(self.__class__, self).is_authenticated()
@@ -35,57 +97,95 @@ def _create_submission(self, survey):
         else:
             raise exc.Unauthorized()
 
+
+def _add_submission(self, survey, data, required_check=None) -> Submission:
+    """Add a submission to the session from its request data.
+
+    This must be called inside a transaction, and raises
+    RequiredQuestionSkipped if the submission is not valid.
+
+    :param survey: the survey
+    :param data: the deserialized submission
+    :param required_check: the survey's compiled check for skipped
+                           questions (see _submission_survey). It is
+                           compiled for this submission if not given.
+    """
     # If logged in, add enumerator
     if self.current_user_model is not None:
         try:
             enumerator = self._get_model(
-                self.data['enumerator_user_id'], model_cls=User
+                data['enumerator_user_id'], model_cls=User
             )
         except KeyError:
-            self.data['enumerator'] = self.current_user_model
+            data['enumerator'] = self.current_user_model
         else:
-            self.data['enumerator'] = enumerator
+            data['enumerator'] = enumerator
 
-    self.data['survey'] = survey
+    data['survey'] = survey
 
-    with self.session.begin():
-        # create a list of Answer models
-        if 'answers' in self.data:
-            raw_answers = self.data['answers']
-            answers = [
-                _create_answer(self.session, answer) for answer in raw_answers
-            ]
-            self.data['answers'] = answers
-
-        self.data['submission_type'] = survey.survey_type + '_submission'
+    # Find the survey nodes before inserting anything
+    answers = _answer_survey_nodes(self.session, data.pop('answers', []))
 
-        submission = construct_submission(**self.data)
+    data['submission_type'] = survey.survey_type + '_submission'
 
-        # add the answer models
-        # if 'answers' in self.data:
-        #    submission.answers = answers
+    try:
+        submission = construct_submission(**data)
 
-        # add the submission
+        # add the submission, then its answers
         self.session.add(submission)
         self.session.flush()
+        answers = insert_answers(self.session, submission, answers)
+    except TypeError as err:
+        # A field that submissions or answers don't have
+        raise exc.BadRequest(str(err))
 
-        for answer in submission.answers:
-            answer.main_answer = (
-                self.session
-                .query(ANSWER_TYPES[answer.answer_type].main_answer)
-                .filter_by(id=answer.id)
-                .scalar()
-            )
+    if required_check is None:
+        required_check = compile_required_check(survey)
+    skipped_question = required_check(answers)
+    if skipped_question is not None:
+        raise RequiredQuestionSkipped(
+            '{} skipped'.format(skipped_question)
+        )
+
+    self.session.add_all(answers)
+    set_committed_value(submission, 'answers', answers)
+    return submission
 
-        skipped_question = skipped_required(survey, submission.answers)
-        if skipped_question is not None:
-            raise RequiredQuestionSkipped(
-                '{} skipped'.format(skipped_question)
-            )
 
+def _create_submission(self, survey_id, exception=None):
+    survey, required_check = _submission_survey(self, survey_id, exception)
+    _check_submission_access(self, survey)
+    with self.session.begin():
+        submission = _add_submission(
+            self, survey, self.data, required_check=required_check
+        )
     return submission
 
 
+def _batch_item_error(item):
+    """Why a submission in a batch is malformed, or None if it isn't."""
+    if not isinstance(item, dict):
+        return 'A submission must be an object'
+    if not isinstance(item.get('survey_id'), str):
+        return 'A submission must have a survey_id'
+    answers = item.get('answers', [])
+    if not isinstance(answers, list):
+        return 'The answers must be a list'
+    if not all(isinstance(answer, dict) for answer in answers):
+        return 'Each answer must be an object'
+    return None
+
+
+def _batch_error(err) -> dict:
+    """The per-item result for a submission in a batch that failed."""
+    if isinstance(err, exc.HttpError):
+        return {'status': err.status, 'error': err.msg}
+    if isinstance(err, tornado.web.HTTPError):
+        # e.g. a failed XSRF check for a submission to a public survey
+        return {'status': err.status_code, 'error': err.log_message}
+    return {'status': 400, 'error': str(err)}
+
+
 class SubmissionResource(BaseResource):
 
     """Restless resource for Submissions.
@@ -99,22 +199,122 @@ class SubmissionResource(BaseResource):
     default_sort_column_name = 'save_time'
     objects_key = 'submissions'
 
+    # The number of submissions read from the database per chunk of a
+    # streamed CSV export.
+    csv_chunk_size = 500
+
+    # The number of submissions in a batch that are inserted per transaction.
+    batch_chunk_size = 100
+
+    http_methods = dict(BaseResource.http_methods, batch={'POST': 'batch'})
+
     def _csv(self, raw_answers) -> dict:
         """Return {'format': 'csv', 'data': <csv-formatted string>}."""
         answers = [answer._asdict('csv') for answer in raw_answers]
         dialect = self._query_arg('dialect', default='excel')
-        fieldnames = [
-            'id', 'deleted', 'answer_number', 'submission_id', 'save_time',
-            'survey_id', 'survey_node_id', 'question_id', 'type_constraint',
-            'last_update_time', 'main_answer', 'response', 'response_type',
-            'metadata'
-        ]
         with closing(StringIO()) as out:
-            dw = DictWriter(out, fieldnames=fieldnames, dialect=dialect)
+            dw = DictWriter(out, fieldnames=CSV_FIELDNAMES, dialect=dialect)
             dw.writeheader()
             dw.writerows(answers)
             return {'format': 'csv', 'data': out.getvalue()}
 
+    def _csv_chunks(self, where=None):
+        """Return a generator of the CSV export of the listed submissions.
+
+        The submission ids are read through a server-side cursor
+        csv_chunk_size at a time, and the answers are loaded and formatted one
+        chunk at a time, so the memory used does not grow with the number of
+        submissions. The query is built here rather than in the generator so
+        that bad arguments are reported before the response starts.
+        """
+        query, order_by_text, keyset_columns = self._list_query(where)
+        query = self._seek(query, order_by_text, keyset_columns)
+        submission_ids = self._limit(
+            query.with_entities(Submission.id)
+        ).yield_per(self.csv_chunk_size)
+        dialect = self._query_arg('dialect', default='excel')
+        answer_cls = with_polymorphic(Answer, '*')
+
+        def write(rows, header=False):
+            with closing(StringIO()) as out:
+                dw = DictWriter(
+                    out, fieldnames=CSV_FIELDNAMES, dialect=dialect
+                )
+                if header:
+                    dw.writeheader()
+                dw.writerows(rows)
+                return out.getvalue()
+
+        def chunks():
+            yield write((), header=True)
+            rows = iter(submission_ids)
+            while True:
+                chunk = [row.id for row in islice(rows, self.csv_chunk_size)]
+                if not chunk:
+                    return
+                answers = defaultdict(list)
+                answer_query = (
+                    self.session
+                    .query(answer_cls)
+                    .filter(answer_cls.submission_id.in_(chunk))
+                    .order_by(answer_cls.answer_number)
+                )
+                for answer in answer_query:
+                    answers[answer.submission_id].append(answer._asdict('csv'))
+                yield write(
+                    row for submission_id in chunk
+                    for row in answers[submission_id]
+                )
+
+        return chunks()
+
+    def _wide_csv_chunks(self, survey, where=None):
+        """Return a generator of the wide CSV export of a survey.
+
+        Each row is one submission, with a column per answerable node of the
+        survey (see dokomoforms.models.export). The rows are pivoted in one
+        query and read through a server-side cursor csv_chunk_size at a time.
+
+        :param survey: the survey, with its tree loaded
+        :param where: an extra filter for the submissions
+        """
+        columns = wide_columns(self.session, survey)
+        query, order_by_text, keyset_columns = self._list_query(where)
+        query = self._seek(query, order_by_text, keyset_columns)
+        rows = self._limit(
+            pivot_submissions(query, survey, columns)
+        ).yield_per(self.csv_chunk_size)
+        dialect = self._query_arg('dialect', default='excel')
+        header = list(WIDE_SUBMISSION_COLUMNS)
+        header.extend(column.header for column in columns)
+
+        def write(chunk):
+            with closing(StringIO()) as out:
+                writer(out, dialect=dialect).writerows(chunk)
+                return out.getvalue()
+
+        def chunks():
+            yield write([header])
+            all_rows = iter(rows)
+            while True:
+                chunk = list(islice(all_rows, self.csv_chunk_size))
+                if not chunk:
+                    return
+                yield write(chunk)
+
+        return chunks()
+
+    def list(self, where=None):
+        """Stream CSV exports rather than loading every submission at once.
+
+        For format=csv the third element of the result is a generator of CSV
+        chunks (see _csv_chunks), which BaseResource.build_response streams.
+        """
+        if self.content_type == 'csv':
+            self.session.flush()
+            return None, None, self._csv_chunks(where), None
+        return super().list(where)
+
     def wrap_list_response(self, data):
         """Allow CSV export of submission data.
 
@@ -123,9 +323,7 @@ class SubmissionResource(BaseResource):
         """
         if self.content_type == 'csv':
             self._set_filename('submissions', 'csv')
-            sub_data = data[2]
-            raw_answers = chain.from_iterable(sub.answers for sub in sub_data)
-            return self._csv(raw_answers)
+            return {'format': 'csv', 'data': data[2]}
         return super().wrap_list_response(data)
 
     def is_authenticated(self):
@@ -154,8 +352,87 @@ class SubmissionResource(BaseResource):
         error = exc.BadRequest(
             'The survey could not be found: {}'.format(survey_id)
         )
-        survey = self._get_model(survey_id, model_cls=Survey, exception=error)
-        return _create_submission(self, survey)
+        return _create_submission(self, survey_id, error)
+
+    # POST /api/submissions/batch
+    def batch(self):
+        """Create several submissions, possibly to different surveys.
+
+        The request body is {"submissions": [submission, ...]}, where each
+        submission is what create accepts. Each survey is loaded (and its
+        access checked) once, and the submissions are inserted
+        batch_chunk_size at a time, each in its own savepoint.
+
+        The response has one result per submission, in order: either
+        {"status": 201, "id": ..., "survey_id": ...} or
+        {"status": <HTTP status>, "error": ...}. A submission that fails
+        doesn't stop the others from being saved.
+        """
+        items = self.data['submissions']
+        surveys = {}
+        results = [None] * len(items)
+        # The errors that the single endpoint turns into a 400 (or its own
+        # HTTP status), rather than a 500, see BaseResource.handle_error
+        failures = (
+            exc.HttpError, tornado.web.HTTPError, KeyError, ValueError,
+            SQLAlchemyError, psycopg2.Error, DokomoError
+        )
+
+        pending = []
+        for index, item in enumerate(items):
+            malformed = _batch_item_error(item)
+            if malformed is not None:
+                results[index] = {'status': 400, 'error': malformed}
+                continue
+            data = dict(item)
+            survey_id = data.pop('survey_id')
+            if survey_id not in surveys:
+                # A survey that can't be submitted to fails the same way for
+                # each of its submissions, so the failure is kept too
+                try:
+                    surveys[survey_id] = self._batch_survey(survey_id)
+                except failures as err:
+                    surveys[survey_id] = _batch_error(err)
+            survey = surveys[survey_id]
+            if isinstance(survey, dict):
+                results[index] = survey
+            else:
+                pending.append((index,) + survey + (data,))
+
+        for start in range(0, len(pending), self.batch_chunk_size):
+            chunk = pending[start:start + self.batch_chunk_size]
+            with self.session.begin():
+                for index, survey, check, data in chunk:
+                    try:
+                        with self.session.begin_nested():
+                            submission = _add_submission(
+                                self, survey, data, required_check=check
+                            )
+                    except failures as err:
+                        results[index] = _batch_error(err)
+                    else:
+                        results[index] = {
+                            'status': 201,
+                            'id': submission.id,
+                            'survey_id': survey.id,
+                        }
+        return {'results': results}
+
+    def _batch_survey(self, survey_id) -> tuple:
+        """Load a survey for batch and check that the user can submit to it.
+
+        Raises the error for the survey's submissions if it can't be found or
+        submitted to.
+
+        :return: a tuple of (the survey, its compiled check for skipped
+                 questions)
+        """
+        error = exc.NotFound(
+            'The survey could not be found: {}'.format(survey_id)
+        )
+        survey, required_check = _submission_survey(self, survey_id, error)
+        _check_submission_access(self, survey)
+        return survey, required_check
 
 
 def get_submission_for_handler(tornado_handler, submission_id):
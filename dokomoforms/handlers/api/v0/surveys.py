@@ -1,25 +1,39 @@
 """TornadoResource class for dokomoforms.models.survey.Survey."""
 import os.path
 import datetime
+from itertools import islice
 
 import restless.exceptions as exc
 from restless.constants import CREATED
 
-from sqlalchemy import cast, Date
+from sqlalchemy import or_, select
+from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.sql import func
 
+from tornado import gen
+
 from dokomoforms.exc import SurveyAccessForbidden
 from dokomoforms.handlers.api.v0 import BaseResource
+from dokomoforms.handlers.api.v0.serializer import RawJSON
 from dokomoforms.handlers.api.v0.submissions import (
     SubmissionResource, _create_submission
 )
 from dokomoforms.models import (
     Survey, Submission, SubSurvey, Choice,
     construct_survey, construct_survey_node, construct_bucket,
-    administrator_filter, get_model,
-    Node, construct_node
+    get_model, load_survey_tree,
+    Node, construct_node, get_survey_snapshot, get_survey_version,
+    survey_etag, SurveyVersion, survey_version_query
+)
+from dokomoforms.models.async_db import fetch_all, fetch_scalar
+from dokomoforms.models.export import geojson_features
+from dokomoforms.models.map_data import (
+    WORLD, map_data_query, map_data_response
 )
 from dokomoforms.models.survey import _administrator_table
+from dokomoforms.models.submission import (
+    _survey_daily_submissions_table, _survey_statistics_table
+)
 
 
 # TODO: clean up this mess
@@ -105,11 +119,17 @@ class SurveyResource(BaseResource):
         'activity_all': {
             'GET': 'activity_all'
         },
+        'map_data': {
+            'GET': 'map_data'
+        },
         'submit': {
             'POST': 'submit'
         }
     }
 
+    # The number of Features to write at a time in a GeoJSON export
+    geojson_chunk_size = 1000
+
     def __init__(self, *args, **kwargs):
         """Make submit return 201."""
         super().__init__(*args, **kwargs)
@@ -134,27 +154,113 @@ class SurveyResource(BaseResource):
                 return True
         return super().is_authenticated()
 
-    def detail(self, survey_id):
-        """Return the given survey.
+    def survey_version(self, survey_id):
+        """Get the survey's id, version, last_update_time, survey_type and
+        default_language.
+
+        See dokomoforms.models.snapshot.get_survey_version.
+        """
+        return get_survey_version(self.session, survey_id)
+
+    def snapshot(self, survey_id, current=None):
+        """Get the SurveySnapshot of the survey, from the cache if possible.
+
+        See dokomoforms.models.snapshot.
+        """
+        return get_survey_snapshot(
+            self.session, self.survey_cache, survey_id, current=current
+        )
+
+    def _check_survey_access(self, survey_id, survey_type):
+        """Raise an exception if the current user can't see the survey.
 
         Public surveys don't require authentication.
         Enumerator-only surveys do required authentication, and the user must
         be one of the survey's enumerators or an administrator.
         """
-        result = super().detail(survey_id)
-        survey = self.session.query(Survey).get(survey_id)
-        if survey.survey_type == 'public':
-            return result
+        if survey_type == 'public':
+            return
         authenticated = super().is_authenticated(admin_only=False)
         if not authenticated:
             raise exc.Unauthorized()
-        user = self.current_user_model
-        if user.role == 'administrator':
-            return result
-        if user not in survey.enumerators:
-            raise SurveyAccessForbidden(survey.id)
+        principal = self.r_handler.current_principal
+        if principal is None or principal.is_administrator:
+            # Only Administrators can authenticate with a token
+            return
+        if survey_id not in principal.allowed_survey_ids:
+            raise SurveyAccessForbidden(survey_id)
+
+    def detail(self, survey_id):
+        """Return the given survey.
+
+        Public surveys don't require authentication.
+        Enumerator-only surveys do required authentication, and the user must
+        be one of the survey's enumerators or an administrator.
+
+        Without fields= the response is the cached JSON of the survey. It has
+        an ETag, and a request with a matching If-None-Match gets a 304 Not
+        Modified without the survey being loaded.
+        """
+        if self._query_arg('fields', list) is None:
+            current = self.survey_version(survey_id)
+            if self._not_modified(self._detail_etag(survey_id, current)):
+                return None
+            return RawJSON(self.snapshot(survey_id, current).json)
+        result = super().detail(survey_id)
+        survey_type = (
+            self.session
+            .query(Survey.survey_type)
+            .filter_by(id=survey_id)
+            .scalar()
+        )
+        self._check_survey_access(survey_id, survey_type)
         return result
 
+    def _detail_etag(self, survey_id, current):
+        """Check access to the survey and return the ETag of its JSON.
+
+        :param current: the row from survey_version
+        """
+        self._check_survey_access(survey_id, current.survey_type)
+        return survey_etag(current, self.r_handler.survey_language(current))
+
+    @gen.coroutine
+    def async_detail(self, survey_id):
+        """detail, with the survey's version looked up on the async pool.
+
+        A 304 Not Modified or a survey cache hit doesn't use the executor
+        unless the current user has to be looked up. Only a survey that
+        isn't in the cache is loaded on the executor.
+        """
+        if self._query_arg('fields', list) is not None:
+            result = yield self._run(self.detail, survey_id)
+            return result
+        rows = yield fetch_all(
+            self.db_pool, survey_version_query(self.session, survey_id),
+            self.session,
+        )
+        if not rows:
+            raise NoResultFound((Survey, survey_id))
+        current = SurveyVersion(*rows[0])
+        needs_principal = (
+            current.survey_type != 'public' or
+            self.r_handler.get_secure_cookie('user') is not None
+        )
+        if needs_principal:
+            etag = yield self._run(self._detail_etag, survey_id, current)
+        else:
+            etag = self._detail_etag(survey_id, current)
+        if self._not_modified(etag):
+            return None
+        snapshot = None
+        if self.survey_cache is not None:
+            snapshot = self.survey_cache.get(
+                survey_id, (current.version, current.last_update_time)
+            )
+        if snapshot is None:
+            snapshot = yield self._run(self.snapshot, survey_id, current)
+        return RawJSON(snapshot.json)
+
     def create(self):
         """Create a new survey.
 
@@ -171,21 +277,73 @@ class SurveyResource(BaseResource):
             survey = construct_survey(**self.data)
             self.session.add(survey)
 
+        # The survey goes at the top of the creator's menu
+        if self.menu_cache is not None:
+            self.menu_cache.invalidate(survey.creator_id)
         return survey
 
+    def update(self, survey_id):
+        """Update a survey, and drop it from the caches."""
+        survey = super().update(survey_id)
+        self._invalidate(survey_id)
+        return survey
+
+    def delete(self, survey_id):
+        """Mark a survey deleted, and drop it from the caches."""
+        super().delete(survey_id)
+        self._invalidate(survey_id)
+
+    def _invalidate(self, survey_id):
+        """Forget the cached forms of a survey after a change.
+
+        Any administrator's menu can show the survey, and the change can be
+        to its title or administrators, so all menus are dropped. The change
+        can also be to the enumerators of an enumerator-only survey, so all
+        Principals are dropped too.
+        """
+        if self.survey_cache is not None:
+            self.survey_cache.invalidate(survey_id)
+        if self.menu_cache is not None:
+            self.menu_cache.clear()
+        if self.principal_cache is not None:
+            self.principal_cache.clear()
+
     def submit(self, survey_id):
         """Submit to a survey."""
-        return _create_submission(self, self._get_model(survey_id))
+        return _create_submission(self, survey_id)
 
-    def list_submissions(self, survey_id):
-        """List all submissions for a survey."""
+    def _submission_resource(self):
+        """A SubmissionResource for this request."""
         sub_resource = SubmissionResource()
         sub_resource.ref_rh = self.ref_rh
         sub_resource.request = self.request
         sub_resource.application = self.application
+        return sub_resource
+
+    def _num_submissions_query(self, survey_id):
+        """The query for the number of submissions to the survey."""
+        return (
+            self.session
+            .query(func.count(Submission.id))
+            .filter_by(survey_id=survey_id)
+        )
+
+    def list_submissions(self, survey_id):
+        """List all submissions for a survey."""
+        if self.content_type == 'geojson':
+            return self._geojson_response(survey_id)
+        sub_resource = self._submission_resource()
         where = Submission.survey_id == survey_id
-        result = sub_resource.list(where=where)
-        response = sub_resource.wrap_list_response(result)
+        if self._query_arg('layout') == 'wide' and self.content_type == 'csv':
+            # One row per submission
+            survey = load_survey_tree(self.session, survey_id)
+            response = {
+                'format': 'csv',
+                'data': sub_resource._wide_csv_chunks(survey, where),
+            }
+        else:
+            result = sub_resource.list(where=where)
+            response = sub_resource.wrap_list_response(result)
         if sub_resource.content_type == 'csv':
             title = (
                 self.session
@@ -195,99 +353,255 @@ class SurveyResource(BaseResource):
             )
             self._set_filename('survey_{}_submissions'.format(title), 'csv')
         else:
-            response['total_entries'] = (
-                self.session
-                .query(func.count(Submission.id))
-                .filter_by(survey_id=survey_id)
-                .scalar()
-            )
+            if 'total_entries' in response:
+                response['total_entries'] = (
+                    self._num_submissions_query(survey_id).scalar()
+                )
             response['survey_id'] = survey_id
         return response
 
-    def stats(self, survey_id):
-        """Get stats for a survey."""
-        result = (
+    @gen.coroutine
+    def async_list_submissions(self, survey_id):
+        """list_submissions, with fields= lists run on the async pool.
+
+        Full submissions are serialized from their models, and the CSV and
+        geojson formats are built from them too, so those requests run
+        list_submissions on the executor.
+        """
+        sub_resource = self._submission_resource()
+        if self.content_type != 'json' or sub_resource._projection() is None:
+            result = yield self._run(self.list_submissions, survey_id)
+            return result
+        where = Submission.survey_id == survey_id
+        result = yield sub_resource.async_list(where=where)
+        response = sub_resource.wrap_list_response(result)
+        if 'total_entries' in response:
+            response['total_entries'] = yield fetch_scalar(
+                self.db_pool, self._num_submissions_query(survey_id),
+                self.session,
+            )
+        response['survey_id'] = survey_id
+        return response
+
+    def _stats_query(self, survey_id):
+        """The query for the stats of a survey."""
+        statistics = _survey_statistics_table.c
+        return (
             self.session
             .query(
-                func.max(Survey.created_on),
-                func.min(Submission.save_time),
-                func.max(Submission.save_time),
-                func.count(Submission.id),
+                Survey.created_on,
+                statistics.earliest_submission_time,
+                statistics.latest_submission_time,
+                func.coalesce(statistics.num_submissions, 0),
+            )
+            .outerjoin(
+                _survey_statistics_table, statistics.survey_id == Survey.id
             )
-            .select_from(Submission)
-            .join(Survey)
-            # TODO: ask @jmwohl what this line is supposed to do
-            # .filter(User.id == self.current_user_model.id)
-            .filter(Submission.survey_id == survey_id)
-            .one()
+            .filter(Survey.id == survey_id)
         )
 
-        response = {
+    def _stats_response(self, result):
+        return {
             "created_on": result[0],
             "earliest_submission_time": result[1],
             "latest_submission_time": result[2],
             "num_submissions": result[3]
         }
-        return response
+
+    def stats(self, survey_id):
+        """Get stats for a survey."""
+        return self._stats_response(self._stats_query(survey_id).one())
+
+    @gen.coroutine
+    def async_stats(self, survey_id):
+        """stats, with the query run on the async pool."""
+        rows = yield fetch_all(
+            self.db_pool, self._stats_query(survey_id), self.session
+        )
+        if not rows:
+            raise NoResultFound()
+        return self._stats_response(rows[0])
 
     def activity_all(self):
         """Get activity for all surveys."""
+        return self._activity_response(self._activity_all_query())
+
+    @gen.coroutine
+    def async_activity_all(self):
+        """activity_all, with the query run on the async pool."""
+        rows = yield fetch_all(
+            self.db_pool, self._activity_all_query(), self.session
+        )
+        return self._activity_response(rows)
+
+    def _activity_all_query(self):
         days = int(self.r_handler.get_argument('days', 30))
         user_id = self.r_handler.get_argument('user_id', None)
-        response = self._generate_activity_response(days, user_id=user_id)
-        return response
+        return self._activity_query(days, user_id=user_id)
 
     def activity(self, survey_id):
         """Get activity for a single survey."""
+        return self._activity_response(self._activity_survey_query(survey_id))
+
+    @gen.coroutine
+    def async_activity(self, survey_id):
+        """activity, with the query run on the async pool."""
+        rows = yield fetch_all(
+            self.db_pool, self._activity_survey_query(survey_id),
+            self.session,
+        )
+        return self._activity_response(rows)
+
+    def _activity_survey_query(self, survey_id):
         days = int(self.r_handler.get_argument('days', 30))
-        response = self._generate_activity_response(days, survey_id=survey_id)
-        return response
+        return self._activity_query(days, survey_id=survey_id)
 
-    def _generate_activity_response(self,
-                                    days=30, user_id=None, survey_id=None):
-        """Get the activity response.
+    def _activity_query(self, days=30, user_id=None, survey_id=None):
+        """Build the query for activity.
 
-        Build and execute the query for activity, specifying the number of days
-        in the past from the current date to return.
+        The query counts the submissions per day, specifying the number of
+        days in the past from the current date to return. The counts come
+        from the survey_daily_submissions rollup, so the query reads at most
+        one row per survey per day.
 
         If a survey_id is specified, only activity from that
-        survey will be returned.
+        survey will be counted.
         """
         # number of days prior to return
         today = datetime.date.today()
         from_date = today - datetime.timedelta(days=days - 1)
 
-        # truncate the datetime to just the day
-        submission_date = (
-            cast(Submission.save_time, Date).label('submission_date')
+        daily = _survey_daily_submissions_table.c
+        query = (
+            self.session
+            .query(daily.day, func.sum(daily.num_submissions))
+            .filter(daily.day >= from_date)
         )
 
-        query = self.session.query(submission_date, func.count())
-
         if user_id is not None:
+            administered = (
+                select([_administrator_table.c.survey_id])
+                .where(_administrator_table.c.user_id == user_id)
+            )
             query = (
                 query
-                .join(Survey.submissions)
-                .outerjoin(_administrator_table)
-                .filter(administrator_filter(user_id))
+                .join(Survey, Survey.id == daily.survey_id)
+                .filter(or_(
+                    Survey.creator_id == user_id,
+                    Survey.id.in_(administered),
+                ))
             )
 
-        query = query.filter(Submission.save_time >= from_date)
-
         if survey_id is not None:
-            query = query.filter(Submission.survey_id == survey_id)
+            query = query.filter(daily.survey_id == survey_id)
 
-        query = (
+        return (
             query
-            .group_by('submission_date')
-            .order_by(submission_date.desc())
+            .group_by(daily.day)
+            .order_by(daily.day.desc())
         )
 
+    def _activity_response(self, rows):
+        """Get the activity response from the rows of _activity_query."""
         # TODO: Figure out if this should use OrderedDict
         return {'activity': [
-            {'date': date, 'num_submissions': num} for date, num in query
+            {'date': date, 'num_submissions': num} for date, num in rows
         ]}
 
+    def map_data(self, survey_id, survey_node_id):
+        """Get the located answers to a SurveyNode, clustered for a map.
+
+        The query arguments are the bbox=west,south,east,north of the map and
+        its zoom level. See dokomoforms.models.map_data.
+
+        With format=geojson, all of the answers in the bbox are exported
+        instead, see _geojson_response.
+        """
+        if self.content_type == 'geojson':
+            return self._geojson_response(survey_id, survey_node_id)
+        zoom, query = self._map_data_query(survey_id, survey_node_id)
+        return map_data_response(self.session.execute(query), zoom)
+
+    @gen.coroutine
+    def async_map_data(self, survey_id, survey_node_id):
+        """map_data, with the query run on the async pool."""
+        if self.content_type == 'geojson':
+            result = yield self._run(
+                self.map_data, survey_id, survey_node_id
+            )
+            return result
+        zoom, query = self._map_data_query(survey_id, survey_node_id)
+        rows = yield fetch_all(self.db_pool, query, self.session)
+        return map_data_response(rows, zoom)
+
+    def _map_data_query(self, survey_id, survey_node_id):
+        zoom = self._query_arg('zoom', int, 0)
+        return zoom, map_data_query(
+            self.session, survey_id, survey_node_id,
+            bbox=self._bbox(WORLD), zoom=zoom,
+        )
+
+    def _bbox(self, default=None):
+        """The bbox=west,south,east,north query argument, as floats."""
+        bbox = self._query_arg('bbox', list)
+        if bbox is None:
+            return default
+        if len(bbox) != 4:
+            raise ValueError('bbox must be west,south,east,north')
+        return tuple(float(bound) for bound in bbox)
+
+    def _date_arg(self, argument_name):
+        """A YYYY-MM-DD query argument as a date, or None."""
+        value = self._query_arg(argument_name)
+        if value is None:
+            return None
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+    def _geojson_response(self, survey_id, survey_node_id=None):
+        """Stream the located answers as a GeoJSON FeatureCollection.
+
+        The optional query arguments are bbox=west,south,east,north and the
+        since= and until= dates (YYYY-MM-DD, both inclusive) of the answers'
+        save_time. See dokomoforms.models.export.geojson_features.
+
+        The query runs before the response starts, so that errors are
+        reported as such, and its rows are read through a server-side cursor
+        geojson_chunk_size at a time. Each row is the JSON of a Feature
+        already, so the rows are joined without being decoded.
+        """
+        until = self._date_arg('until')
+        if until is not None:
+            until += datetime.timedelta(days=1)
+        query = geojson_features(
+            self.session, survey_id, survey_node_id,
+            bbox=self._bbox(), since=self._date_arg('since'), until=until,
+        )
+        rows = iter(query.yield_per(self.geojson_chunk_size))
+        title = (
+            self.session
+            .query(Survey.title[Survey.default_language])
+            .filter_by(id=survey_id)
+            .scalar()
+        )
+        self._set_filename('survey_{}_locations'.format(title), 'geojson')
+
+        def chunks():
+            yield '{"type": "FeatureCollection", "features": ['
+            separator = ''
+            while True:
+                chunk = [
+                    feature for feature, in islice(
+                        rows, self.geojson_chunk_size
+                    )
+                ]
+                if not chunk:
+                    break
+                yield separator + ','.join(chunk)
+                separator = ','
+            yield ']}'
+
+        return {'format': 'geojson', 'data': chunks()}
+
     # def prepare(self, data):
     #     """Determine which fields to return.
 
@@ -299,10 +613,45 @@ class SurveyResource(BaseResource):
     #     return data
 
 
-def get_survey_for_handler(tornado_handler, survey_id):
-    """Maybe a handler needs a survey from the API."""
+def _survey_resource_for_handler(tornado_handler):
     survey_resource = SurveyResource()
     survey_resource.ref_rh = tornado_handler
     survey_resource.request = tornado_handler.request
     survey_resource.application = tornado_handler.application
-    return survey_resource.detail(survey_id)
+    return survey_resource
+
+
+def get_survey_for_handler(tornado_handler, survey_id):
+    """Maybe a handler needs a survey from the API.
+
+    This is the Survey model with its tree loaded. Handlers that only read
+    the survey should use get_survey_snapshot_for_handler.
+    """
+    survey_resource = _survey_resource_for_handler(tornado_handler)
+    survey = load_survey_tree(survey_resource.session, survey_id)
+    survey_resource._check_survey_access(survey_id, survey.survey_type)
+    return survey
+
+
+def get_survey_version_for_handler(tornado_handler, survey_id):
+    """Maybe a handler needs a survey's current version from the API.
+
+    This checks that the current user can see the survey, and returns the row
+    from dokomoforms.models.snapshot.get_survey_version.
+    """
+    survey_resource = _survey_resource_for_handler(tornado_handler)
+    current = survey_resource.survey_version(survey_id)
+    survey_resource._check_survey_access(survey_id, current.survey_type)
+    return current
+
+
+def get_survey_snapshot_for_handler(tornado_handler, survey_id, current=None):
+    """Maybe a handler needs a survey's cached SurveySnapshot from the API.
+
+    :param current: the row from get_survey_version_for_handler, if the
+                    handler already has it (and so has checked access)
+    """
+    if current is None:
+        current = get_survey_version_for_handler(tornado_handler, survey_id)
+    survey_resource = _survey_resource_for_handler(tornado_handler)
+    return survey_resource.snapshot(survey_id, current)
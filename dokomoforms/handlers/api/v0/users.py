@@ -3,7 +3,9 @@ from sqlalchemy.orm.exc import NoResultFound
 
 from dokomoforms.handlers.api.v0 import BaseResource
 from dokomoforms.exc import UserRequiresEmailError
-from dokomoforms.models import User, Email, Survey, construct_user, get_model
+from dokomoforms.models import (
+    User, Email, Survey, construct_user, get_model, touch_surveys
+)
 
 
 class UserResource(BaseResource):
@@ -54,4 +56,23 @@ class UserResource(BaseResource):
         self._modify_survey_data('allowed_surveys')
         self._modify_survey_data('admin_surveys')
         self._modify_survey_data('surveys')
-        return super().update(user_id)
+        user = super().update(user_id)
+        self._invalidate_principal(user_id)
+        return user
+
+    def delete(self, user_id):
+        """Mark a user deleted."""
+        super().delete(user_id)
+        self._invalidate_principal(user_id)
+
+    def _invalidate_principal(self, user_id):
+        """Drop the user from the principal and menu caches, and touch the
+        user's surveys, after a change.
+
+        The surveys show the creator's name and email.
+        """
+        if self.principal_cache is not None:
+            self.principal_cache.invalidate(user_id)
+        if self.menu_cache is not None:
+            self.menu_cache.invalidate(user_id)
+        touch_surveys(self.session, Survey.creator_id == user_id)
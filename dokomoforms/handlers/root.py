@@ -4,7 +4,6 @@ import tornado.gen
 import tornado.httpclient
 
 from dokomoforms.handlers.util import BaseHandler
-from dokomoforms.models import Administrator, User
 
 
 class Index(BaseHandler):
@@ -13,11 +12,11 @@ class Index(BaseHandler):
 
     def get(self, msg=''):
         """GET /."""
-        user = self.current_user_model
-        if isinstance(user, Administrator):
+        user = self.current_principal
+        if user is not None and user.is_administrator:
             self.redirect('/admin')
             return
-        if isinstance(user, User):
+        if user is not None:
             self.redirect('/enumerate')
             return
         self.render(
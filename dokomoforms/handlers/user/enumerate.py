@@ -5,9 +5,30 @@ import tornado.web
 
 from dokomoforms.exc import SurveyAccessForbidden
 from dokomoforms.handlers.util import BaseHandler, auth_redirect
-from dokomoforms.handlers.api.v0 import get_survey_for_handler
+from dokomoforms.handlers.api.v0 import (
+    get_survey_version_for_handler, get_survey_snapshot_for_handler
+)
 from dokomoforms.options import options
-from dokomoforms.models import Survey
+from dokomoforms.models import Survey, survey_etag
+
+
+def _enumerate_etag(handler, current):
+    """The ETag of the enumerate page of a survey.
+
+    Besides the survey and language, the page shows the current user and the
+    options, and loads the app's bundle.
+    """
+    user = handler.current_principal
+    if user is not None:
+        user = (user.id, user.last_update_time)
+    return survey_etag(
+        current,
+        handler.survey_language(current),
+        user,
+        options.organization,
+        options.revisit_url,
+        handler.static_url('dist/survey/js/build.bundle.js'),
+    )
 
 
 class EnumerateHomepageHandler(BaseHandler):
@@ -30,21 +51,31 @@ class Enumerate(BaseHandler):
         Render survey page for given survey id, embed JSON into to template so
         browser can cache survey in HTML.
 
+        The page has an ETag, so a reload with a matching If-None-Match gets
+        a 304 Not Modified without the survey being loaded or the template
+        rendered.
+
         Raises tornado http error.
 
         @survey_id: Requested survey id.
         """
         try:
-            survey = get_survey_for_handler(self, survey_id)
+            current = get_survey_version_for_handler(self, survey_id)
         except Unauthorized:
             return auth_redirect(self)
         except SurveyAccessForbidden:
             raise tornado.web.HTTPError(403)
 
+        self.set_header('Etag', _enumerate_etag(self, current))
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        survey = get_survey_snapshot_for_handler(self, survey_id, current)
+
         # pass in the revisit url
         self.render(
             'view_enumerate.html',
-            current_user_model=self.current_user_model,
             survey=survey,
             revisit_url=options.revisit_url
         )
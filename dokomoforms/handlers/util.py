@@ -1,5 +1,6 @@
 """Useful reusable functions for handlers, plus the BaseHandler."""
 from functools import wraps
+import logging
 
 import urllib.parse as urlparse
 from urllib.parse import urlencode
@@ -10,8 +11,8 @@ from sqlalchemy.orm.exc import NoResultFound
 import tornado.web
 from tornado.escape import to_unicode, json_encode
 
-from dokomoforms.models import User, Administrator
-from dokomoforms.models.survey import most_recent_surveys
+from dokomoforms.models import User, get_principal, menu_surveys
+from dokomoforms.models.util import statement_count
 
 
 def auth_redirect(self):
@@ -36,14 +37,37 @@ def authenticated_admin(method):
                 return auth_redirect(self)
             raise tornado.web.HTTPError(403)
         # Custom #
-        user = self.current_user_model
-        if isinstance(user, Administrator):
+        if self.current_principal.is_administrator:
             return method(self, *args, **kwargs)
         # Custom #
         raise tornado.web.HTTPError(403)
     return wrapper
 
 
+class _LazyMenuSurveys:
+
+    """The surveys for the menu in base.html, looked up if it is shown.
+
+    See dokomoforms.models.survey.menu_surveys
+    """
+
+    def __init__(self, handler, user_id):
+        self._handler = handler
+        self._user_id = user_id
+        self._surveys = None
+
+    def __iter__(self):
+        if self._surveys is None:
+            handler = self._handler
+            self._surveys = menu_surveys(
+                handler.session,
+                getattr(handler.application, 'menu_cache', None),
+                self._user_id,
+                handler.num_surveys_for_menu,
+            )
+        return iter(self._surveys)
+
+
 class BaseHandler(tornado.web.RequestHandler):
 
     """The base class for handlers.
@@ -57,26 +81,72 @@ class BaseHandler(tornado.web.RequestHandler):
     def session(self):
         """The SQLAlchemy session for interacting with the models.
 
+        Each request gets its own session from Application.session_factory,
+        which is closed when the request finishes. If the Application was
+        given a session instead, every request uses that one.
+
         :return: the SQLAlchemy session
         """
-        return self.application.session
+        try:
+            return self._session
+        except AttributeError:
+            pass
+        session_factory = self.application.session_factory
+        if session_factory is None:
+            self._session = self.application.session
+        else:
+            self._session = session_factory()
+        return self._session
 
     @property
-    def current_user_model(self):
-        """Return the current logged in User, or None."""
+    def current_principal(self):
+        """Return the Principal of the current logged in User, or None.
+
+        The Principal comes from the application's principal cache, so
+        authentication and authorization usually cost no queries. See
+        dokomoforms.models.principal
+        """
+        try:
+            return self._current_principal
+        except AttributeError:
+            pass
+        principal = None
         current_user_id = self._current_user_cookie()
         if current_user_id:
             cuid = to_unicode(current_user_id)
             try:
-                return self.session.query(User).get(cuid)
+                principal = get_principal(
+                    self.session,
+                    getattr(self.application, 'principal_cache', None),
+                    cuid,
+                )
             except StatementError:
                 self.clear_cookie('user')
-        return None
+        self._current_principal = principal
+        return principal
+
+    @property
+    def current_user_model(self):
+        """Return the current logged in User, or None.
+
+        The user is looked up once per request, and only if it is needed (see
+        current_principal).
+        """
+        try:
+            return self._current_user_model
+        except AttributeError:
+            pass
+        user = None
+        principal = self.current_principal
+        if principal is not None:
+            user = self.session.query(User).get(principal.id)
+        self._current_user_model = user
+        return user
 
     @property
     def user_default_language(self):
         """Return the logged-in User's default language, or None."""
-        user = self.current_user_model
+        user = self.current_principal
         if user:
             return user.preferences['default_language']
         return None
@@ -84,7 +154,7 @@ class BaseHandler(tornado.web.RequestHandler):
     def user_survey_language(self, survey):
         """Return the logged-in User's selected language
         for the given survey, or None if they do not have one."""
-        user = self.current_user_model
+        user = self.current_principal
         if user is None:
             return None
         try:
@@ -94,6 +164,18 @@ class BaseHandler(tornado.web.RequestHandler):
             pass
         return None
 
+    def survey_language(self, survey):
+        """Return the language the current User reads the survey in.
+
+        That is the User's selected language for the survey, their default
+        language, or the survey's default language.
+        """
+        return (
+            self.user_survey_language(survey) or
+            self.user_default_language or
+            survey.default_language
+        )
+
     def set_default_headers(self):
         """Add some security-flavored headers.
 
@@ -125,12 +207,51 @@ class BaseHandler(tornado.web.RequestHandler):
     def prepare(self):
         """Default behavior before any HTTP method.
 
-        By default, just sets up the XSRF token.
+        By default, just sets up the XSRF token and starts counting the
+        queries of the request's session for num_queries.
 
         """
+        self._statement_count_start = statement_count(self.session)
         # Just accessing the token makes the handler send it to the browser
         self.xsrf_token
 
+    @property
+    def num_queries(self):
+        """The number of SQL statements executed so far for this request.
+
+        This is None if prepare has not run.
+        """
+        try:
+            start = self._statement_count_start
+        except AttributeError:
+            return None
+        return statement_count(self.session) - start
+
+    def finish(self, chunk=None):
+        """Add an X-Query-Count header in debug mode, then finish."""
+        num_queries = self.num_queries
+        debug = self.settings.get('debug')
+        if debug and num_queries is not None and not self._headers_written:
+            self.set_header('X-Query-Count', num_queries)
+        return super().finish(chunk)
+
+    def on_finish(self):
+        """Close the request's session.
+
+        Also logs the number of queries for the request in debug mode.
+        """
+        if self.settings.get('debug') and self.num_queries is not None:
+            logging.debug(
+                '%s %s: %d queries',
+                self.request.method, self.request.uri, self.num_queries
+            )
+        own_session = (
+            self.application.session_factory is not None and
+            '_session' in self.__dict__
+        )
+        if own_session:
+            self._session.close()
+
     def get(self, *args, **kwargs):
         """404 unless this method is overridden.
 
@@ -153,7 +274,7 @@ class BaseHandler(tornado.web.RequestHandler):
 
         :return: a string containing the user name.
         """
-        user = self.current_user_model
+        user = self.current_principal
         if user:
             return user.name
         return None
@@ -165,7 +286,7 @@ class BaseHandler(tornado.web.RequestHandler):
         """
         if not self.current_user:
             return None
-        return self.current_user_model.id
+        return self.current_principal.id
 
     def _get_current_user_prefs(self):
         """Get the current user's preferences for the templates.
@@ -174,7 +295,7 @@ class BaseHandler(tornado.web.RequestHandler):
         """
         prefs = {}
         if self.current_user:
-            prefs = self.current_user_model.preferences
+            prefs = dict(self.current_principal.preferences)
         return json_encode(prefs)
 
     def _t(self, field, survey=None):
@@ -206,15 +327,13 @@ class BaseHandler(tornado.web.RequestHandler):
         @jmwohl
         """
         namespace = super().get_template_namespace()
-        user = self.current_user_model
-        surveys_for_menu = most_recent_surveys(
-            self.session, user.id, self.num_surveys_for_menu
-        ) if user else None
+        user = self.current_principal
+        surveys_for_menu = _LazyMenuSurveys(self, user.id) if user else None
         namespace.update({
             'surveys_for_menu': surveys_for_menu,
             'current_user_id': self._get_current_user_id(),
             '_t': self._t,
-            'current_user_model': self.current_user_model,
+            'current_principal': user,
             'current_user_prefs': self._get_current_user_prefs()
         })
         return namespace
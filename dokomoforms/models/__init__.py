@@ -1,7 +1,7 @@
 """All the models used in Dokomo Forms."""
 from dokomoforms.models.util import (
     Base, create_engine, jsonify, get_model, ModelJSONEncoder,
-    UUID_REGEX
+    fast_json_dumps, UUID_REGEX
 )
 from dokomoforms.models.user import User, Administrator, Email, construct_user
 from dokomoforms.models.node import (
@@ -16,26 +16,35 @@ from dokomoforms.models.survey import (
     Survey, EnumeratorOnlySurvey, SubSurvey, SurveyNode, construct_survey,
     NonAnswerableSurveyNode, AnswerableSurveyNode, construct_survey_node,
     construct_bucket, survey_type_enum, skipped_required,
-    administrator_filter, most_recent_surveys
+    administrator_filter, most_recent_surveys, load_survey_tree,
+    compile_required_check, menu_surveys
 )
 from dokomoforms.models.submission import (
     Submission, EnumeratorOnlySubmission, PublicSubmission,
     construct_submission, most_recent_submissions
 )
 from dokomoforms.models.answer import (
-    Answer, Photo, construct_answer, add_new_photo_to_session
+    Answer, Photo, construct_answer, add_new_photo_to_session, insert_answers
 )
 from dokomoforms.models.column_properties import (
     answer_min, answer_max, answer_sum, answer_avg, answer_mode,
     answer_stddev_pop, answer_stddev_samp,
     generate_question_stats
 )
+from dokomoforms.models.snapshot import (
+    SurveySnapshot, get_survey_snapshot, cached_survey_snapshot,
+    SurveyVersion, survey_version_query, get_survey_version, survey_etag,
+    touch_surveys
+)
+from dokomoforms.models.principal import (
+    Principal, get_principal, load_principal
+)
 
 
 __all__ = (
     # Util
     'Base', 'create_engine', 'jsonify', 'get_model', 'ModelJSONEncoder',
-    'UUID_REGEX',
+    'fast_json_dumps', 'UUID_REGEX',
     # User
     'User', 'Administrator', 'Email', 'construct_user',
     # Node
@@ -50,14 +59,22 @@ __all__ = (
     'construct_survey',
     'NonAnswerableSurveyNode', 'AnswerableSurveyNode', 'construct_survey_node',
     'construct_bucket', 'survey_type_enum', 'skipped_required',
-    'administrator_filter', 'most_recent_surveys',
+    'administrator_filter', 'most_recent_surveys', 'load_survey_tree',
+    'compile_required_check', 'menu_surveys',
     # Submission
     'Submission', 'EnumeratorOnlySubmission', 'PublicSubmission',
     'construct_submission', 'most_recent_submissions',
     # Answer
     'Answer', 'Photo', 'construct_answer', 'add_new_photo_to_session',
+    'insert_answers',
     # column_properties
     'answer_min', 'answer_max', 'answer_sum', 'answer_avg', 'answer_mode',
     'answer_stddev_pop', 'answer_stddev_samp',
     'generate_question_stats',
+    # snapshot
+    'SurveySnapshot', 'get_survey_snapshot', 'cached_survey_snapshot',
+    'SurveyVersion', 'survey_version_query', 'get_survey_version',
+    'survey_etag', 'touch_surveys',
+    # principal
+    'Principal', 'get_principal', 'load_principal',
 )
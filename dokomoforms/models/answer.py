@@ -1,10 +1,14 @@
 """Answer models."""
 import abc
 from collections import OrderedDict
+import uuid
 
 import sqlalchemy as sa
 from sqlalchemy.dialects import postgresql as pg
-from sqlalchemy.orm import relationship, synonym, column_property
+from sqlalchemy.orm import (
+    relationship, synonym, column_property, make_transient_to_detached,
+    deferred
+)
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.sql import func
@@ -16,6 +20,7 @@ from tornado.escape import json_decode, json_encode
 from geoalchemy2 import Geometry
 
 from dokomoforms.models import util, Base, node_type_enum
+from dokomoforms.options import options
 from dokomoforms.exc import (
     NotAnAnswerTypeError, NotAResponseTypeError, PhotoIdDoesNotExistError
 )
@@ -310,13 +315,26 @@ class PhotoAnswer(_AnswerMixin, Answer):
 
 class Photo(Base):
 
-    """A BYTEA holding an image."""
+    """An image, kept by one of the backends in dokomoforms.storage.
+
+    The storage column names the backend. The database backend keeps the
+    image in the image column, the others leave it NULL and find the image
+    by its content_hash.
+
+    The JSON form is the metadata only. The image is loaded when it is read,
+    see PhotoResource.image.
+    """
 
     __tablename__ = 'photo'
 
     id = util.pk()
-    image = sa.Column(pg.BYTEA, nullable=False)
+    image = deferred(sa.Column(pg.BYTEA))
     mime_type = sa.Column(pg.TEXT, nullable=False)
+    storage = sa.Column(
+        pg.TEXT, nullable=False, server_default='database'
+    )
+    content_hash = sa.Column(pg.TEXT)
+    size = sa.Column(sa.Integer)
     # image = sa.Column(LObject)
     created_on = sa.Column(
         pg.TIMESTAMP(timezone=True),
@@ -324,18 +342,109 @@ class Photo(Base):
         server_default=current_timestamp(),
     )
 
-    def _asdict(self) -> OrderedDict:
-        return OrderedDict((
-            ('id', self.id),
-            ('deleted', self.deleted),
-            ('image', self.image),
-            ('mime_type', self.mime_type),
-            ('created_on', self.created_on),
-        ))
+    __table_args__ = (
+        sa.CheckConstraint(
+            "(storage = 'database') = (image IS NOT NULL)",
+            name='image_only_in_database_storage',
+        ),
+        sa.CheckConstraint(
+            "(storage = 'database') OR (content_hash IS NOT NULL)",
+            name='content_hash_outside_database_storage',
+        ),
+    )
+
+    # The fields that can be selected directly in SQL.
+    # See dokomoforms.models.util.get_fields_projection
+    _projectable_fields = {
+        'id': 'id',
+        'deleted': 'deleted',
+        'mime_type': 'mime_type',
+        'size': 'size',
+        'created_on': 'created_on',
+    }
+
+    _asdict = util.fields_asdict(
+        'id', 'deleted', 'mime_type', 'size', 'created_on'
+    )
+
+
+sa.event.listen(
+    Base.metadata,
+    'after_create',
+    # Brings a photo table from before the storage backends up to date. The
+    # existing images are in the database, so their storage is 'database'.
+    # There is no ADD COLUMN IF NOT EXISTS in PostgreSQL 9.4, so each change
+    # catches the error it raises when it has been made already. Every
+    # statement here can be run again.
+    sa.DDL(
+        """
+        DO $$
+        BEGIN
+            ALTER TABLE {schema}.photo
+            ADD COLUMN storage TEXT DEFAULT 'database';
+        EXCEPTION WHEN duplicate_column THEN
+            -- The column exists already
+        END;
+        $$;
+        UPDATE {schema}.photo SET storage = 'database'
+        WHERE storage IS NULL;
+        ALTER TABLE {schema}.photo ALTER COLUMN storage SET NOT NULL;
+
+        DO $$
+        BEGIN
+            ALTER TABLE {schema}.photo ADD COLUMN content_hash TEXT;
+        EXCEPTION WHEN duplicate_column THEN
+            -- The column exists already
+        END;
+        $$;
+
+        DO $$
+        BEGIN
+            ALTER TABLE {schema}.photo ADD COLUMN size INTEGER;
+        EXCEPTION WHEN duplicate_column THEN
+            -- The column exists already
+        END;
+        $$;
+
+        ALTER TABLE {schema}.photo ALTER COLUMN image DROP NOT NULL;
+
+        DO $$
+        BEGIN
+            ALTER TABLE {schema}.photo
+            ADD CONSTRAINT image_only_in_database_storage
+            CHECK ((storage = 'database') = (image IS NOT NULL));
+        EXCEPTION WHEN duplicate_object THEN
+            -- The constraint exists already
+        END;
+        $$;
+
+        DO $$
+        BEGIN
+            ALTER TABLE {schema}.photo
+            ADD CONSTRAINT content_hash_outside_database_storage
+            CHECK ((storage = 'database') OR (content_hash IS NOT NULL));
+        EXCEPTION WHEN duplicate_object THEN
+            -- The constraint exists already
+        END;
+        $$;
+        """.format(schema=options.schema)
+    ),
+)
+
 
+def add_new_photo_to_session(session, *, id, image=None, storage=None,
+                             **kwargs):
+    """Create a new Photo and update the referenced PhotoAnswer.
 
-def add_new_photo_to_session(session, *, id, **kwargs):
-    """Create a new Photo and update the referenced PhotoAnswer."""
+    :param session: the SQLAlchemy session
+    :param id: the id of the Photo, which is the main_answer of a PhotoAnswer
+    :param image: the image. With a storage backend this is the raw image,
+                  otherwise it is stored in the Photo.image column as is.
+    :param storage: the dokomoforms.storage.PhotoStorage to store the image
+                    with, or None
+    :param kwargs: the other columns of the Photo
+    :returns: the new Photo
+    """
     try:
         answer = (
             session
@@ -346,7 +455,12 @@ def add_new_photo_to_session(session, *, id, **kwargs):
     except NoResultFound:
         raise PhotoIdDoesNotExistError(id)
     with session.begin():
-        answer.photo = Photo(id=id, **kwargs)
+        photo = Photo(id=id, **kwargs)
+        if storage is None:
+            photo.image = image
+        else:
+            storage.store(photo, image)
+        answer.photo = photo
         answer.actual_photo_id = answer.main_answer
     return answer.photo
 
@@ -592,3 +706,129 @@ def construct_answer(*, type_constraint: str, **kwargs) -> Answer:
         raise NotAnAnswerTypeError(type_constraint)
 
     return create_answer(**kwargs)
+
+
+# Leaves a column out of one row of a multi-row INSERT
+_DEFAULT = sa.literal_column('DEFAULT')
+
+
+def _synced_values(instance, local_remote_pairs, local_index) -> dict:
+    """The column values a relationship would copy from instance at flush.
+
+    :param instance: the instance on the other side of the relationship
+    :param local_remote_pairs: the relationship's local_remote_pairs
+    :param local_index: the position of the instance's columns in the pairs
+    """
+    mapper = sa.inspect(instance).mapper
+    values = {}
+    for pair in local_remote_pairs:
+        source, target = pair[local_index], pair[1 - local_index]
+        attribute_name = mapper.get_property_by_column(source).key
+        values[target] = getattr(instance, attribute_name)
+    return values
+
+
+def _insert_rows(session, table, rows, *extra_returning) -> dict:
+    """Insert the rows with one INSERT ... RETURNING.
+
+    :return: a dict of the returned rows by id
+    """
+    keys = set().union(*rows)
+    values = [{key: row.get(key, _DEFAULT) for key in keys} for row in rows]
+    statement = (
+        table.insert()
+        .values(values)
+        .returning(*(tuple(table.c) + extra_returning))
+    )
+    return {row['id']: row for row in session.execute(statement)}
+
+
+def insert_answers(session, submission, answers) -> list:
+    """Insert the answers to a submission with one INSERT per table.
+
+    This does the work of the ORM flush of Submission.answers without a round
+    trip per answer: the rows for the answer table and for each answer type's
+    table are inserted with a multi-row INSERT ... RETURNING, which also
+    reads back the values as the database stores them (e.g. PostGIS
+    geometries).
+
+    The returned answers are detached and are not in submission.answers yet,
+    so that they can be checked with skipped_required first. Add them to the
+    session and use set_committed_value to put them in submission.answers.
+
+    :param session: the SQLAlchemy session
+    :param submission: the submission, already flushed
+    :param answers: a list of (AnswerableSurveyNode, keyword arguments for
+                    construct_answer) tuples, in answer_number order
+    :return: a list of Answer
+    """
+    if not answers:
+        return []
+    answer_table = Answer.__table__
+    submission_pairs = (
+        sa.inspect(submission).mapper.relationships['answers']
+        .local_remote_pairs
+    )
+    survey_node_pairs = (
+        sa.inspect(Answer).relationships['survey_node'].local_remote_pairs
+    )
+
+    instances = []
+    answer_rows = []
+    type_rows = OrderedDict()
+    for answer_number, (survey_node, kwargs) in enumerate(answers):
+        instance = construct_answer(**kwargs)
+        mapper = sa.inspect(instance).mapper
+        values = {}
+        for column_attribute in mapper.column_attrs:
+            if column_attribute.key not in instance.__dict__:
+                continue
+            for column in column_attribute.columns:
+                if isinstance(column, sa.Column):
+                    values[column] = instance.__dict__[column_attribute.key]
+        values[answer_table.c.id] = str(uuid.uuid4())
+        values[answer_table.c.answer_number] = answer_number
+        values.update(_synced_values(submission, submission_pairs, 0))
+        values.update(_synced_values(survey_node, survey_node_pairs, 1))
+        table = mapper.local_table
+        for foreign_key in table.foreign_keys:
+            if foreign_key.column.table is answer_table:
+                values[foreign_key.parent] = values[foreign_key.column]
+
+        instances.append((instance, survey_node))
+        answer_rows.append({
+            column.key: value for column, value in values.items()
+            if column.table is answer_table
+        })
+        type_rows.setdefault(type(instance), []).append({
+            column.key: value for column, value in values.items()
+            if column.table is table
+        })
+
+    returned = {answer_table: _insert_rows(session, answer_table, answer_rows)}
+    for answer_cls, rows in type_rows.items():
+        mapper = sa.inspect(answer_cls)
+        extra_returning = ()
+        if 'geo_json' in mapper.column_attrs:
+            extra_returning = (
+                mapper.column_attrs['geo_json'].expression.label('geo_json'),
+            )
+        table = mapper.local_table
+        returned[table] = _insert_rows(session, table, rows, *extra_returning)
+
+    result = []
+    for (instance, survey_node), answer_row in zip(instances, answer_rows):
+        answer_id = answer_row['id']
+        mapper = sa.inspect(instance).mapper
+        for column_attribute in mapper.column_attrs:
+            column = column_attribute.columns[0]
+            if column_attribute.key == 'geo_json':
+                row = returned[mapper.local_table][answer_id]
+                setattr(instance, 'geo_json', row['geo_json'])
+            elif isinstance(column, sa.Column) and column.table in returned:
+                row = returned[column.table][answer_id]
+                setattr(instance, column_attribute.key, row[column.name])
+        instance.survey_node = survey_node
+        make_transient_to_detached(instance)
+        result.append(instance)
+    return result
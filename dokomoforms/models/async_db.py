@@ -0,0 +1,100 @@
+"""Non-blocking database access for read-only API requests.
+
+The queries are built with SQLAlchemy as usual, compiled for psycopg2, and
+run through momoko, which drives psycopg2's asynchronous connections from the
+Tornado IOLoop. A request waiting on one of these queries doesn't hold a
+thread or a SQLAlchemy connection.
+
+The results are plain rows rather than models, so this is only for queries
+that select columns and aggregates: fields= lists and details, stats,
+activity, map data, and the version check of a survey's detail (a 304 Not
+Modified or a survey cache hit answers without the executor). Full models,
+such as the submissions of a list without fields= and a survey that isn't
+in the survey cache, are still loaded with the ORM on the executor.
+
+momoko is optional: without it create_pool returns None and the API runs
+every query on the executor.
+"""
+import logging
+
+from sqlalchemy.dialects.postgresql.psycopg2 import PGDialect_psycopg2
+
+from tornado import gen
+
+from dokomoforms.models import util
+from dokomoforms.options import options
+
+try:
+    import momoko
+except ImportError:  # pragma: no cover
+    momoko = None
+
+
+_dialect = PGDialect_psycopg2()
+
+
+def create_pool(size: int, ioloop=None):
+    """Return a momoko.Pool configured with the options, or None.
+
+    The pool still has to be connected with pool.connect() on the IOLoop.
+
+    :param size: the number of connections. If this is 0, or momoko is not
+                 installed, return None.
+    :param ioloop: the IOLoop for the pool (defaults to the current one)
+    """
+    if not size:
+        return None
+    if momoko is None:
+        logging.warning(
+            'async_db_pool_size is set but momoko is not installed.'
+        )
+        return None
+    dsn = 'dbname={} user={} password={} host={} port={}'.format(
+        options.db_database,
+        options.db_user,
+        options.db_password,
+        options.db_host,
+        options.db_port,
+    )
+    return momoko.Pool(dsn=dsn, size=size, ioloop=ioloop)
+
+
+def compile_query(query) -> tuple:
+    """Compile a SQLAlchemy Query or selectable for psycopg2.
+
+    :param query: the query
+    :return: a tuple of (SQL string, parameter dict)
+    """
+    statement = getattr(query, 'statement', query)
+    compiled = statement.compile(dialect=_dialect)
+    return str(compiled), compiled.params
+
+
+@gen.coroutine
+def fetch_all(pool, query, session=None) -> list:
+    """Run the query on the pool and return all of the rows.
+
+    :param pool: the momoko.Pool from create_pool
+    :param query: the SQLAlchemy Query or selectable
+    :param session: the request's SQLAlchemy session, if the query should be
+                    added to its statement_count
+    :return: a list of tuples
+    """
+    sql, params = compile_query(query)
+    if session is not None:
+        util.count_statement(session)
+    cursor = yield pool.execute(sql, params)
+    return cursor.fetchall()
+
+
+@gen.coroutine
+def fetch_scalar(pool, query, session=None):
+    """Run the query on the pool and return the first column of the first row.
+
+    :param pool: the momoko.Pool from create_pool
+    :param query: the SQLAlchemy Query or selectable
+    :param session: the request's SQLAlchemy session, see fetch_all
+    :return: the value, or None if there are no rows
+    """
+    rows = yield fetch_all(pool, query, session)
+    return rows[0][0] if rows else None
@@ -13,6 +13,7 @@ from dokomoforms.models import (
     Answer, Node, Choice, Survey, Submission, AnswerableSurveyNode
 )
 from dokomoforms.models.answer import ANSWER_TYPES
+from dokomoforms.models.submission import _survey_statistics_table
 from dokomoforms.exc import InvalidTypeForOperation
 
 
@@ -42,23 +43,28 @@ Submission.survey_default_language = column_property(
 
 
 # Survey
+# These read the row of survey_statistics maintained by the triggers in
+# dokomoforms.models.submission rather than aggregating over the submissions.
 Survey.num_submissions = column_property(
-    sa.select([sa.func.count(Submission.id)])
-    .where(Submission.survey_id == Survey.id)
-    .label('num_submissions')
+    sa.func.coalesce(
+        sa.select([_survey_statistics_table.c.num_submissions])
+        .where(_survey_statistics_table.c.survey_id == Survey.id)
+        .as_scalar(),
+        0
+    ).label('num_submissions')
 )
 
 
 Survey.earliest_submission_time = column_property(
-    sa.select([sa.func.min(Submission.save_time)])
-    .where(Submission.survey_id == Survey.id)
+    sa.select([_survey_statistics_table.c.earliest_submission_time])
+    .where(_survey_statistics_table.c.survey_id == Survey.id)
     .label('earliest_submission_time')
 )
 
 
 Survey.latest_submission_time = column_property(
-    sa.select([sa.func.max(Submission.save_time)])
-    .where(Submission.survey_id == Survey.id)
+    sa.select([_survey_statistics_table.c.latest_submission_time])
+    .where(_survey_statistics_table.c.survey_id == Survey.id)
     .label('latest_submission_time')
 )
 
@@ -71,6 +77,15 @@ AnswerableSurveyNode.answer_count = column_property(
 )
 
 
+# The answer types that each statistic applies to
+_ORDERED_TYPES = {'integer', 'decimal', 'date', 'time', 'timestamp'}
+_NUMERIC_TYPES = {'integer', 'decimal'}
+_MODE_TYPES = {
+    'text', 'integer', 'decimal', 'date', 'time', 'timestamp', 'location',
+    'facility', 'multiple_choice'
+}
+
+
 def _answer_stat(survey_node: AnswerableSurveyNode,
                  allowable_types: set,
                  func: Function) -> object:
@@ -96,7 +111,7 @@ def answer_min(survey_node: AnswerableSurveyNode):
     """Get the minimum answer."""
     return _answer_stat(
         survey_node,
-        {'integer', 'decimal', 'date', 'time', 'timestamp'},
+        _ORDERED_TYPES,
         sa.func.min,
     )
 
@@ -105,7 +120,7 @@ def answer_max(survey_node: AnswerableSurveyNode):
     """Get the maximum answer."""
     return _answer_stat(
         survey_node,
-        {'integer', 'decimal', 'date', 'time', 'timestamp'},
+        _ORDERED_TYPES,
         sa.func.max,
     )
 
@@ -114,7 +129,7 @@ def answer_sum(survey_node: AnswerableSurveyNode):
     """Get the sum of the answers."""
     return _answer_stat(
         survey_node,
-        {'integer', 'decimal'},
+        _NUMERIC_TYPES,
         sa.func.sum,
     )
 
@@ -123,7 +138,7 @@ def answer_avg(survey_node: AnswerableSurveyNode):
     """Get the average of the answers."""
     return _answer_stat(
         survey_node,
-        {'integer', 'decimal'},
+        _NUMERIC_TYPES,
         sa.func.avg,
     )
 
@@ -131,11 +146,7 @@ def answer_avg(survey_node: AnswerableSurveyNode):
 def answer_mode(survey_node: AnswerableSurveyNode):
     """Get the mode of the answers."""
     type_constraint = survey_node.the_type_constraint
-    allowable_types = {
-        'text', 'integer', 'decimal', 'date', 'time', 'timestamp', 'location',
-        'facility', 'multiple_choice'
-    }
-    if type_constraint not in allowable_types:
+    if type_constraint not in _MODE_TYPES:
         raise InvalidTypeForOperation((type_constraint, 'mode'))
     answer_cls = ANSWER_TYPES[survey_node.the_type_constraint]
     result = (
@@ -163,7 +174,7 @@ def answer_stddev_pop(survey_node: AnswerableSurveyNode):
     """Get the population standard deviation of the answers."""
     return _answer_stat(
         survey_node,
-        {'integer', 'decimal'},
+        _NUMERIC_TYPES,
         sa.func.stddev_pop,
     )
 
@@ -172,34 +183,125 @@ def answer_stddev_samp(survey_node: AnswerableSurveyNode):
     """Get the sample standard deviation of the answers."""
     return _answer_stat(
         survey_node,
-        {'integer', 'decimal'},
+        _NUMERIC_TYPES,
         sa.func.stddev_samp,
     )
 
 
-def _question_stats(survey_node):
-    yield {'query': 'count', 'result': survey_node.answer_count}
-    aggregators = (
-        (answer_min, 'min'),
-        (answer_max, 'max'),
-        (answer_sum, 'sum'),
-        (answer_avg, 'avg'),
-        (answer_mode, 'mode'),
-        (answer_stddev_pop, 'stddev_pop'),
-        (answer_stddev_samp, 'stddev_samp'),
+def _mode(answer_cls):
+    return sa.literal_column(
+        'MODE() WITHIN GROUP (ORDER BY {}.main_answer)'
+        .format(answer_cls.__tablename__)
+    )
+
+
+# (name, aggregate function of the main_answer column, allowable types) in
+# the order the statistics are displayed
+_AGGREGATORS = (
+    ('min', lambda answer_cls: sa.func.min(answer_cls.main_answer),
+     _ORDERED_TYPES),
+    ('max', lambda answer_cls: sa.func.max(answer_cls.main_answer),
+     _ORDERED_TYPES),
+    ('sum', lambda answer_cls: sa.func.sum(answer_cls.main_answer),
+     _NUMERIC_TYPES),
+    ('avg', lambda answer_cls: sa.func.avg(answer_cls.main_answer),
+     _NUMERIC_TYPES),
+    ('mode', _mode, _MODE_TYPES),
+    ('stddev_pop',
+     lambda answer_cls: sa.func.stddev_pop(answer_cls.main_answer),
+     _NUMERIC_TYPES),
+    ('stddev_samp',
+     lambda answer_cls: sa.func.stddev_samp(answer_cls.main_answer),
+     _NUMERIC_TYPES),
+)
+
+
+def _batched_stats(session, type_constraint: str,
+                   survey_node_ids: list) -> dict:
+    """Compute the statistics for several nodes of the same type at once.
+
+    :returns: a dictionary of survey node id: list of (name, result) pairs.
+              Nodes without answers are missing from the dictionary.
+    """
+    answer_cls = ANSWER_TYPES[type_constraint]
+    aggregators = [
+        (name, aggregate)
+        for name, aggregate, allowable_types in _AGGREGATORS
+        if type_constraint in allowable_types
+    ]
+    names = ['count'] + [name for name, _ in aggregators]
+    query = (
+        sa.select(
+            [Answer.survey_node_id, sa.func.count(Answer.id)] +
+            [aggregate(answer_cls) for _, aggregate in aggregators]
+        )
+        .select_from(Answer.__table__.join(
+            answer_cls.__table__, Answer.id == answer_cls.id
+        ))
+        .where(Answer.survey_node_id.in_(survey_node_ids))
+        .group_by(Answer.survey_node_id)
     )
-    for func, name in aggregators:
-        try:
-            yield {'query': name, 'result': func(survey_node)}
-        except InvalidTypeForOperation:
-            pass
+    return {
+        row[0]: list(zip(names, row[1:]))
+        for row in session.execute(query)
+    }
+
+
+def _empty_stats(type_constraint: str) -> list:
+    return [('count', 0)] + [
+        (name, None) for name, _, allowable_types in _AGGREGATORS
+        if type_constraint in allowable_types
+    ]
 
 
 def generate_question_stats(survey):
-    """Get answer statistics for the nodes in a survey."""
-    answerable_survey_nodes = survey._sequentialize(
+    """Get answer statistics for the nodes in a survey.
+
+    The statistics are computed with one GROUP BY query per answer type in
+    the survey (plus one to look up the modes of multiple choice questions)
+    rather than with separate queries for every node.
+    """
+    answerable_survey_nodes = list(survey._sequentialize(
         include_non_answerable=False
-    )
+    ))
+    session = object_session(survey)
+
+    survey_node_ids = {}
+    for survey_node in answerable_survey_nodes:
+        type_constraint = survey_node.the_type_constraint
+        survey_node_ids.setdefault(type_constraint, []).append(survey_node.id)
+    stats = {}
+    for type_constraint, ids in survey_node_ids.items():
+        stats.update(_batched_stats(session, type_constraint, ids))
+
+    choice_ids = {
+        str(result)
+        for survey_node_id in survey_node_ids.get('multiple_choice', ())
+        for name, result in stats.get(survey_node_id, ())
+        if name == 'mode' and result
+    }
+    choices = {}
+    if choice_ids:
+        choices = {
+            choice.id: choice for choice in
+            session.query(Choice).filter(Choice.id.in_(choice_ids))
+        }
+
     for survey_node in answerable_survey_nodes:  # pragma: no branch
-        stats = list(_question_stats(survey_node))
-        yield {'survey_node': survey_node, 'stats': stats}
+        type_constraint = survey_node.the_type_constraint
+        node_stats = stats.get(survey_node.id)
+        if node_stats is None:
+            node_stats = _empty_stats(type_constraint)
+        if type_constraint == 'multiple_choice':
+            node_stats = [
+                (name, choices[str(result)])
+                if name == 'mode' and result else (name, result)
+                for name, result in node_stats
+            ]
+        yield {
+            'survey_node': survey_node,
+            'stats': [
+                {'query': name, 'result': result}
+                for name, result in node_stats
+            ],
+        }
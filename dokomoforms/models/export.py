@@ -0,0 +1,257 @@
+"""Queries for exporting submissions."""
+from collections import namedtuple
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql as pg
+from sqlalchemy.sql import func
+
+from dokomoforms.models.answer import (
+    Answer, ANSWER_TYPES, FacilityAnswer, LocationAnswer,
+    MultipleChoiceAnswer
+)
+from dokomoforms.models.node import Choice
+from dokomoforms.models.submission import Submission
+
+
+# The submission columns at the start of each row of a wide export.
+WIDE_SUBMISSION_COLUMNS = (
+    'submission_id', 'save_time', 'submission_time', 'submitter_name',
+    'submitter_email',
+)
+
+
+WideColumn = namedtuple('WideColumn', 'header survey_node_id index')
+
+
+def _location_json(geometry):
+    return sa.cast(
+        func.json_build_object(
+            'lng', func.ST_X(geometry), 'lat', func.ST_Y(geometry)
+        ),
+        pg.TEXT,
+    )
+
+
+def _type_value(answer_cls, language):
+    """The main answer of one answer type as TEXT."""
+    table = answer_cls.__table__
+    if answer_cls is LocationAnswer:
+        return sa.case(
+            [(table.c.main_answer.isnot(None),
+              _location_json(table.c.main_answer))]
+        )
+    if answer_cls is FacilityAnswer:
+        return sa.case([(
+            table.c.main_answer.isnot(None),
+            sa.cast(
+                func.json_build_object(
+                    'facility_id', table.c.facility_id,
+                    'facility_name', table.c.facility_name,
+                    'facility_sector', table.c.facility_sector,
+                    'lng', func.ST_X(table.c.main_answer),
+                    'lat', func.ST_Y(table.c.main_answer),
+                ),
+                pg.TEXT,
+            )
+        )])
+    if answer_cls is MultipleChoiceAnswer:
+        return (
+            sa.select([Choice.choice_text[language].astext])
+            .where(Choice.id == table.c.main_answer)
+            .as_scalar()
+        )
+    return sa.cast(table.c.main_answer, pg.TEXT)
+
+
+def answer_values(survey_id, language):
+    """A subquery of the answers to a survey with their values as TEXT.
+
+    The per-type answer tables are all LEFT JOINed to the answer table, so
+    exactly one of them matches each answer and the value is whichever of the
+    answer, "other" and "don't know" columns is not NULL. Multiple choice
+    answers are given as the choice text in the supplied language.
+
+    The idx column numbers the answers to the same node within a submission
+    (1, 2, ...) for repeatable and allow_multiple nodes.
+
+    :param survey_id: the id of the survey
+    :param language: the language for multiple choice answers
+    """
+    answer = Answer.__table__
+    joined = answer
+    values = []
+    others = []
+    dont_knows = []
+    for answer_cls in ANSWER_TYPES.values():
+        table = answer_cls.__table__
+        joined = joined.outerjoin(table, table.c.id == answer.c.id)
+        values.append(_type_value(answer_cls, language))
+        others.append(table.c.other)
+        dont_knows.append(table.c.dont_know)
+    return (
+        sa.select([
+            answer.c.submission_id,
+            answer.c.survey_node_id,
+            func.row_number().over(
+                partition_by=(answer.c.submission_id, answer.c.survey_node_id),
+                order_by=answer.c.answer_number,
+            ).label('idx'),
+            func.coalesce(*(values + others + dont_knows)).label('value'),
+        ])
+        .select_from(joined)
+        .where(answer.c.survey_id == survey_id)
+        .alias('answer_value')
+    )
+
+
+def wide_columns(session, survey) -> list:
+    """The answer columns of a wide export of a survey's submissions.
+
+    There is one column per AnswerableSurveyNode in Survey._sequentialize
+    order. Nodes that can have several answers per submission (the node
+    allows multiple answers or is in a repeatable sub-survey) get as many
+    indexed columns as the largest number of answers to them in any
+    submission.
+
+    :param session: the SQLAlchemy session
+    :param survey: the survey, with its tree loaded (see load_survey_tree)
+    :returns: a list of WideColumn
+    """
+    survey_nodes = list(survey._sequentialize(include_non_answerable=False))
+    indexed = [
+        survey_node.id for survey_node in survey_nodes
+        if survey_node.allow_multiple or survey_node.the_sub_survey_repeatable
+    ]
+    widths = {}
+    if indexed:
+        counts = (
+            session
+            .query(
+                Answer.survey_node_id,
+                func.count(Answer.id).label('num_answers'),
+            )
+            .filter(Answer.survey_id == survey.id)
+            .filter(Answer.survey_node_id.in_(indexed))
+            .group_by(Answer.submission_id, Answer.survey_node_id)
+            .subquery()
+        )
+        widths = dict(
+            session
+            .query(counts.c.survey_node_id, func.max(counts.c.num_answers))
+            .group_by(counts.c.survey_node_id)
+        )
+
+    language = survey.default_language
+    columns = []
+    for survey_node in survey_nodes:
+        title = survey_node.node.title
+        header = title.get(language) or next(iter(title.values()), '')
+        if survey_node.id in indexed:
+            columns.extend(
+                WideColumn('{} [{}]'.format(header, index), survey_node.id,
+                           index)
+                for index in range(1, widths.get(survey_node.id, 1) + 1)
+            )
+        else:
+            columns.append(WideColumn(header, survey_node.id, 1))
+    return columns
+
+
+def pivot_submissions(query, survey, columns):
+    """Turn a query of a survey's submissions into a wide export query.
+
+    The result has one row per submission: the WIDE_SUBMISSION_COLUMNS
+    followed by one value for each of the columns. The pivot is a single
+    GROUP BY over the submissions and their answers, with a filtered max()
+    for each column, so it keeps the filters and ORDER BY of the given query.
+
+    :param query: a query of Submission, filtered to the survey's submissions
+    :param survey: the survey
+    :param columns: the columns from wide_columns
+    """
+    values = answer_values(survey.id, survey.default_language)
+    pivoted = [
+        sa.funcfilter(
+            func.max(values.c.value),
+            values.c.survey_node_id == column.survey_node_id,
+            values.c.idx == column.index,
+        ).label('column_{}'.format(number))
+        for number, column in enumerate(columns)
+    ]
+    return (
+        query
+        .outerjoin(values, values.c.submission_id == Submission.id)
+        .with_entities(
+            Submission.id, Submission.save_time, Submission.submission_time,
+            Submission.submitter_name, Submission.submitter_email,
+            *pivoted
+        )
+        .group_by(Submission.id)
+    )
+
+
+def _geojson_properties(answer_cls):
+    properties = [
+        'submission_id', answer_cls.submission_id,
+        'survey_node_id', answer_cls.survey_node_id,
+        'save_time', answer_cls.save_time,
+    ]
+    if answer_cls is FacilityAnswer:
+        properties.extend((
+            'facility_id', answer_cls.facility_id,
+            'facility_name', answer_cls.facility_name,
+            'facility_sector', answer_cls.facility_sector,
+        ))
+    return func.json_build_object(*properties)
+
+
+def geojson_features(session, survey_id, survey_node_id=None, *,
+                     bbox=None, since=None, until=None):
+    """A query of the GeoJSON Features of a survey's located answers.
+
+    Each row is one location or facility answer as the TEXT of a GeoJSON
+    Feature, built in SQL with ST_AsGeoJSON and json_build_object so that
+    the rows can be written out as they are. The id of a Feature is the id
+    of the answer, and its properties are the ids of the submission and the
+    survey node, the save_time and, for facilities, the facility's id, name
+    and sector.
+
+    The bbox filter is the && operator, which the GiST indexes that
+    geoalchemy2 creates on the main_answer columns serve.
+
+    :param session: the SQLAlchemy session
+    :param survey_id: the UUID of the Survey
+    :param survey_node_id: the UUID of one SurveyNode, or None for all of them
+    :param bbox: (west, south, east, north) in degrees, or None
+    :param since: the earliest save_time, or None
+    :param until: the save_time to stop before, or None
+    """
+    queries = []
+    for answer_cls in (LocationAnswer, FacilityAnswer):
+        feature = func.json_build_object(
+            'type', 'Feature',
+            'id', answer_cls.id,
+            'geometry', sa.cast(
+                func.ST_AsGeoJSON(answer_cls.main_answer), pg.JSON
+            ),
+            'properties', _geojson_properties(answer_cls),
+        )
+        query = (
+            session
+            .query(sa.cast(feature, pg.TEXT).label('feature'))
+            .select_from(answer_cls)
+            .filter(answer_cls.survey_id == survey_id)
+            .filter(answer_cls.main_answer.isnot(None))
+        )
+        if survey_node_id is not None:
+            query = query.filter(answer_cls.survey_node_id == survey_node_id)
+        if bbox is not None:
+            query = query.filter(answer_cls.main_answer.intersects(
+                func.ST_MakeEnvelope(*bbox + (4326,))
+            ))
+        if since is not None:
+            query = query.filter(answer_cls.save_time >= since)
+        if until is not None:
+            query = query.filter(answer_cls.save_time < until)
+        queries.append(query)
+    return queries[0].union_all(*queries[1:])
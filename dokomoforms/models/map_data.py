@@ -0,0 +1,108 @@
+"""Location and facility answers aggregated for maps.
+
+A survey can have far more located answers than a map can show, so the map
+asks for the answers in its bounding box at its zoom level. Below
+POINTS_ZOOM, the answers are snapped to a grid in PostGIS and only the
+number of answers in each cell (and their centroid) is returned. The grid
+gets finer as the map zooms in, and from POINTS_ZOOM on the individual
+answers are returned.
+
+The bounding box filter is the && operator, which the GiST indexes on the
+main_answer columns serve.
+"""
+from collections import namedtuple
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql as pg
+from sqlalchemy.sql import func
+
+from dokomoforms.models.answer import LocationAnswer, FacilityAnswer
+
+
+# The zoom level from which individual answers are returned
+POINTS_ZOOM = 16
+
+# The number of grid cells along the side of a 256 pixel map tile
+CELLS_PER_TILE = 4
+
+# The whole world, as (west, south, east, north)
+WORLD = (-180, -90, 180, 90)
+
+
+MapCluster = namedtuple('MapCluster', 'lng lat count')
+
+
+MapPoint = namedtuple('MapPoint', 'submission_id lng lat facility_name')
+
+
+def grid_size(zoom: int) -> float:
+    """The side of a grid cell at the zoom level, in degrees."""
+    return 360 / (2 ** zoom) / CELLS_PER_TILE
+
+
+def _located_answers(session, survey_id, survey_node_id, bbox):
+    """The location and facility answers to a SurveyNode in the bbox."""
+    west, south, east, north = bbox
+    envelope = func.ST_MakeEnvelope(west, south, east, north, 4326)
+    queries = []
+    for answer_cls in (LocationAnswer, FacilityAnswer):
+        facility_name = getattr(
+            answer_cls, 'facility_name', sa.cast(sa.null(), pg.TEXT)
+        )
+        queries.append(
+            session
+            .query(
+                answer_cls.submission_id.label('submission_id'),
+                answer_cls.main_answer.label('location'),
+                facility_name.label('facility_name'),
+            )
+            .select_from(answer_cls)
+            .filter(answer_cls.survey_id == survey_id)
+            .filter(answer_cls.survey_node_id == survey_node_id)
+            .filter(answer_cls.main_answer.intersects(envelope))
+        )
+    return sa.union_all(*(query.statement for query in queries)).alias()
+
+
+def map_data_query(session, survey_id, survey_node_id, *,
+                   bbox=WORLD, zoom=0):
+    """The query for the located answers to a SurveyNode on a map.
+
+    The rows are MapCluster fields below POINTS_ZOOM and MapPoint fields
+    from POINTS_ZOOM on. See map_data_response.
+
+    :param session: the SQLAlchemy session
+    :param survey_id: the UUID of the Survey
+    :param survey_node_id: the UUID of the location or facility SurveyNode
+    :param bbox: the (west, south, east, north) bounds of the map, in
+                 degrees
+    :param zoom: the zoom level of the map
+    :returns: a SQLAlchemy selectable
+    """
+    located = _located_answers(session, survey_id, survey_node_id, bbox)
+    location = located.c.location
+    if zoom >= POINTS_ZOOM:
+        return sa.select([
+            located.c.submission_id,
+            func.ST_X(location),
+            func.ST_Y(location),
+            located.c.facility_name,
+        ])
+    centroid = func.ST_Centroid(func.ST_Collect(location))
+    return (
+        sa.select([func.ST_X(centroid), func.ST_Y(centroid), func.count()])
+        .group_by(func.ST_SnapToGrid(location, grid_size(zoom)))
+    )
+
+
+def map_data_response(rows, zoom=0) -> dict:
+    """The JSON form of the result of map_data_query.
+
+    Either clusters (lng, lat and count) or points (submission_id, lng, lat
+    and, for facilities, facility_name) is empty, depending on the zoom.
+    """
+    if zoom >= POINTS_ZOOM:
+        clusters, points = [], [MapPoint(*row)._asdict() for row in rows]
+    else:
+        clusters, points = [MapCluster(*row)._asdict() for row in rows], []
+    return {'zoom': zoom, 'clusters': clusters, 'points': points}
@@ -45,6 +45,19 @@ class Node(Base):
     logic = util.json_column('logic', default='{}')
     last_update_time = util.last_update_time()
 
+    # The fields that can be selected directly in SQL.
+    # See dokomoforms.models.util.get_fields_projection
+    _projectable_fields = {
+        'id': 'id',
+        'deleted': 'deleted',
+        'languages': 'languages',
+        'title': ('title', util.sorted_dict),
+        'hint': 'hint',
+        'type_constraint': 'type_constraint',
+        'logic': 'logic',
+        'last_update_time': 'last_update_time',
+    }
+
     __mapper_args__ = {'polymorphic_on': type_constraint}
     __table_args__ = (
         sa.CheckConstraint(
@@ -79,17 +92,10 @@ class Note(Node):
         ),
     )
 
-    def _asdict(self) -> OrderedDict:
-        return OrderedDict((
-            ('id', self.id),
-            ('deleted', self.deleted),
-            ('languages', self.languages),
-            ('title', self.title),
-            ('hint', self.hint),
-            ('type_constraint', self.type_constraint),
-            ('logic', self.logic),
-            ('last_update_time', self.last_update_time),
-        ))
+    _asdict = util.fields_asdict(
+        'id', 'deleted', 'languages', 'title', 'hint', 'type_constraint',
+        'logic', 'last_update_time',
+    )
 
 
 class Question(Node):
@@ -0,0 +1,101 @@
+"""Immutable summaries of users for authentication and authorization.
+
+Every request with a user cookie needs to know who the user is, what role
+they have and which surveys they may see. A Principal holds exactly that,
+detached from any session, so the application can keep Principals in its
+principal cache (see get_principal) and answer those questions without a
+query.
+
+Handlers that change a user have to invalidate the cache explicitly. The
+cache's time to live bounds how long changes made elsewhere (e.g. by another
+process) can go unnoticed.
+"""
+from collections import namedtuple
+from types import MappingProxyType
+
+from dokomoforms.models.user import User, Email
+from dokomoforms.models.survey import _enumerator_table
+
+
+class Principal(namedtuple('Principal', (
+        'id name role preferences emails allowed_survey_ids'
+        ' last_update_time'))):
+
+    """The cached, read-only form of a User.
+
+    preferences is a read-only view of the user's preferences.
+    emails is a tuple of the user's e-mail addresses in order.
+    allowed_survey_ids is the frozenset of the ids of the enumerator-only
+    surveys the user may submit to.
+    """
+
+    __slots__ = ()
+
+    @property
+    def is_administrator(self) -> bool:
+        """Whether the user is an Administrator."""
+        return self.role == 'administrator'
+
+
+def load_principal(session, user_id) -> Principal:
+    """Build the Principal of a user from the database.
+
+    :param session: the SQLAlchemy session
+    :param user_id: the UUID of the User
+    :returns: the Principal, or None if there is no such User
+    """
+    user = (
+        session
+        .query(
+            User.id, User.name, User.role, User.preferences,
+            User.last_update_time,
+        )
+        .filter_by(id=user_id)
+        .first()
+    )
+    if user is None:
+        return None
+    # In the same order as User.emails, so that emails[0] is the address
+    # that user.emails[0] would be
+    emails = (
+        session
+        .query(Email.address)
+        .filter_by(user_id=user_id)
+        .order_by(*User.emails.property.order_by)
+    )
+    allowed_surveys = (
+        session
+        .query(_enumerator_table.c.enumerator_only_survey_id)
+        .filter(_enumerator_table.c.user_id == user_id)
+    )
+    return Principal(
+        id=user.id,
+        name=user.name,
+        role=user.role,
+        preferences=MappingProxyType(user.preferences),
+        emails=tuple(address for address, in emails),
+        allowed_survey_ids=frozenset(
+            survey_id for survey_id, in allowed_surveys
+        ),
+        last_update_time=user.last_update_time,
+    )
+
+
+def get_principal(session, cache, user_id) -> Principal:
+    """Get the Principal of a user, from the cache if it is there.
+
+    A hit costs no queries.
+
+    :param session: the SQLAlchemy session
+    :param cache: the dokomoforms.cache.LRUCache of Principals, or None
+    :param user_id: the UUID of the User
+    :returns: the Principal, or None if there is no such User
+    """
+    if cache is not None:
+        principal = cache.get(user_id)
+        if principal is not None:
+            return principal
+    principal = load_principal(session, user_id)
+    if principal is not None and cache is not None:
+        cache.put(user_id, principal)
+    return principal
@@ -0,0 +1,260 @@
+"""Immutable, fully-loaded copies of surveys for caching.
+
+Building a Survey's tree takes several queries (see load_survey_tree) and
+serializing it walks every node, so the handlers that only read a survey use
+a SurveySnapshot from the application's survey cache instead. A snapshot
+holds the survey's JSON, an index of its answerable SurveyNodes, the
+buckets of each SurveyNode's SubSurveys, and the compiled check for skipped
+required questions. Nothing in it is attached to a session.
+
+A snapshot is stored with the survey's (version, last_update_time) and is
+rebuilt when either of them changes. Changes that show in the survey's JSON
+without touching the survey row (e.g. updating a Node or the creator) have to
+call touch_surveys.
+
+The same two columns make the survey's ETag (see survey_etag), so a
+conditional GET can be answered without loading the snapshot at all.
+"""
+from collections import namedtuple
+import hashlib
+from types import MappingProxyType
+
+from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.sql.functions import current_timestamp
+
+from dokomoforms.models.survey import (
+    Survey, load_survey_tree, compile_required_check
+)
+from dokomoforms.models.util import fast_json_dumps
+
+
+SnapshotNode = namedtuple(
+    'SnapshotNode',
+    'id node_id type_constraint required allow_dont_know allow_multiple'
+    ' allow_other logic sub_survey_repeatable choice_ids'
+)
+
+
+SnapshotBucket = namedtuple(
+    'SnapshotBucket', 'sub_survey_id sub_survey_number bucket_type bucket'
+)
+
+
+class SurveySnapshot(namedtuple('SurveySnapshot', (
+        'id version last_update_time survey_type title default_language'
+        ' languages url_slug creator_email json survey_nodes buckets'
+        ' skipped_required'))):
+
+    """The cached, read-only form of a Survey.
+
+    survey_nodes maps the id of each AnswerableSurveyNode to a SnapshotNode.
+    buckets maps the id of each SurveyNode with SubSurveys to a tuple of
+    SnapshotBucket. A range bucket's bucket is the Range, and a multiple
+    choice bucket's bucket is the choice id.
+
+    skipped_required(answers) returns the id of the first required
+    AnswerableSurveyNode that the answers skip, or None (see
+    dokomoforms.models.survey.compile_required_check).
+
+    str() gives the survey's JSON, so a snapshot can be put into a template
+    in place of the Survey.
+    """
+
+    __slots__ = ()
+
+    def __str__(self) -> str:
+        """Return the JSON of the survey."""
+        return self.json
+
+
+def _snapshot_bucket(sub_survey, bucket):
+    if bucket.bucket_type == 'multiple_choice':
+        value = bucket.choice_id
+    else:
+        value = bucket.bucket
+    return SnapshotBucket(
+        sub_survey.id, sub_survey.sub_survey_number, bucket.bucket_type, value
+    )
+
+
+def make_survey_snapshot(survey) -> SurveySnapshot:
+    """Build the snapshot of a Survey.
+
+    :param survey: the Survey, with its tree loaded (see load_survey_tree)
+    :returns: the SurveySnapshot
+    """
+    survey_nodes = {}
+    buckets = {}
+    for survey_node in survey._sequentialize(include_non_answerable=False):
+        node = survey_node.node
+        choice_ids = None
+        if survey_node.type_constraint == 'multiple_choice':
+            choice_ids = frozenset(choice.id for choice in node.choices)
+        survey_nodes[survey_node.id] = SnapshotNode(
+            survey_node.id,
+            survey_node.node_id,
+            survey_node.type_constraint,
+            survey_node.required,
+            survey_node.allow_dont_know,
+            survey_node.allow_multiple,
+            survey_node.allow_other,
+            survey_node.logic,
+            survey_node.the_sub_survey_repeatable,
+            choice_ids,
+        )
+        if survey_node.sub_surveys:
+            buckets[survey_node.id] = tuple(
+                _snapshot_bucket(sub_survey, bucket)
+                for sub_survey in survey_node.sub_surveys
+                for bucket in sub_survey.buckets
+            )
+    emails = survey.creator.emails
+    return SurveySnapshot(
+        id=survey.id,
+        version=survey.version,
+        last_update_time=survey.last_update_time,
+        survey_type=survey.survey_type,
+        title=survey.title,
+        default_language=survey.default_language,
+        languages=survey.languages,
+        url_slug=survey.url_slug,
+        creator_email=emails[0].address if emails else None,
+        json=fast_json_dumps(survey),
+        survey_nodes=MappingProxyType(survey_nodes),
+        buckets=MappingProxyType(buckets),
+        skipped_required=compile_required_check(survey),
+    )
+
+
+# A row from survey_version_query. Rows that don't come from the session
+# (see dokomoforms.models.async_db) are plain tuples, so they are wrapped in
+# this to be used like the rows from get_survey_version.
+SurveyVersion = namedtuple(
+    'SurveyVersion', 'id version last_update_time survey_type default_language'
+)
+
+
+def survey_version_query(session, survey_id):
+    """The query for get_survey_version.
+
+    :param session: the SQLAlchemy session
+    :param survey_id: the UUID of the Survey
+    :returns: the query for the columns of SurveyVersion
+    """
+    return (
+        session
+        .query(
+            Survey.id, Survey.version, Survey.last_update_time,
+            Survey.survey_type, Survey.default_language,
+        )
+        .filter_by(id=survey_id)
+    )
+
+
+def get_survey_version(session, survey_id, exception=None):
+    """Get the columns of a Survey that identify its current version.
+
+    :param session: the SQLAlchemy session
+    :param survey_id: the UUID of the Survey
+    :param exception: the exception to raise if there is no such Survey.
+                      Defaults to sqlalchemy.orm.exc.NoResultFound
+    :returns: a row of the survey's id, version, last_update_time,
+              survey_type and default_language
+    """
+    current = survey_version_query(session, survey_id).first()
+    if current is None:
+        if exception is None:
+            exception = NoResultFound((Survey, survey_id))
+        raise exception
+    return current
+
+
+def survey_etag(current, *parts) -> str:
+    """A strong ETag for a representation of a Survey.
+
+    The tag changes with the survey's version and last_update_time, and with
+    anything else the representation depends on (e.g. the language).
+
+    :param current: the row from get_survey_version
+    :param parts: the other values the representation depends on
+    :returns: the quoted ETag
+    """
+    values = (current.id, current.version, current.last_update_time) + parts
+    digest = hashlib.sha1(
+        '\x00'.join(str(value) for value in values).encode()
+    )
+    return '"{}"'.format(digest.hexdigest())
+
+
+def touch_surveys(session, *criteria) -> None:
+    """Set the last_update_time of the matching surveys to now.
+
+    This changes their ETags and makes the survey caches of every process
+    rebuild their snapshots.
+
+    :param session: the SQLAlchemy session
+    :param criteria: the filter criteria for Survey
+    """
+    with session.begin():
+        (
+            session
+            .query(Survey)
+            .filter(*criteria)
+            .update(
+                {Survey.last_update_time: current_timestamp()},
+                synchronize_session=False,
+            )
+        )
+
+
+def get_survey_snapshot(session, cache, survey_id,
+                        exception=None, current=None) -> SurveySnapshot:
+    """Get the snapshot of a Survey, from the cache if it is up to date.
+
+    A hit costs one query for the survey's version and last_update_time, or
+    none if the caller already has them.
+
+    :param session: the SQLAlchemy session
+    :param cache: the dokomoforms.cache.LRUCache of snapshots, or None
+    :param survey_id: the UUID of the Survey
+    :param exception: the exception to raise if there is no such Survey.
+                      Defaults to sqlalchemy.orm.exc.NoResultFound
+    :param current: the row from get_survey_version, if the caller has it
+    :returns: the SurveySnapshot
+    """
+    if current is None:
+        current = get_survey_version(session, survey_id, exception)
+    version = (current.version, current.last_update_time)
+    if cache is not None:
+        snapshot = cache.get(survey_id, version)
+        if snapshot is not None:
+            return snapshot
+    snapshot = make_survey_snapshot(
+        load_survey_tree(session, survey_id, exception)
+    )
+    if cache is not None:
+        cache.put(
+            survey_id, snapshot, (snapshot.version, snapshot.last_update_time)
+        )
+    return snapshot
+
+
+def cached_survey_snapshot(cache, survey) -> SurveySnapshot:
+    """Get the snapshot of a Survey that has been loaded already.
+
+    This is the cached snapshot if it is up to date, otherwise the snapshot
+    is built from the survey and cached.
+
+    :param cache: the dokomoforms.cache.LRUCache of snapshots, or None
+    :param survey: the Survey, with its tree loaded (see load_survey_tree)
+    :returns: the SurveySnapshot
+    """
+    version = (survey.version, survey.last_update_time)
+    if cache is not None:
+        snapshot = cache.get(survey.id, version)
+        if snapshot is not None:
+            return snapshot
+    snapshot = make_survey_snapshot(survey)
+    if cache is not None:
+        cache.put(survey.id, snapshot, version)
+    return snapshot
@@ -8,6 +8,7 @@ from sqlalchemy.orm import relationship
 from sqlalchemy.sql.functions import current_timestamp
 from sqlalchemy.ext.orderinglist import ordering_list
 
+from dokomoforms.options import options
 from dokomoforms.models import util, Base, survey_type_enum
 from dokomoforms.models.survey import (
     Survey, _administrator_table, administrator_filter
@@ -74,8 +75,26 @@ class Submission(Base):
         sa.UniqueConstraint(
             'id', 'survey_containing_id', 'save_time', 'survey_id'
         ),
+        # For recomputing survey_statistics when a submission is removed
+        sa.Index('submission_survey_id_save_time', 'survey_id', 'save_time'),
     )
 
+    # The fields that can be selected directly in SQL.
+    # See dokomoforms.models.util.get_fields_projection
+    _projectable_fields = {
+        'id': 'id',
+        'deleted': 'deleted',
+        'survey_id': 'survey_id',
+        'start_time': 'start_time',
+        'save_time': 'save_time',
+        'submission_time': 'submission_time',
+        'last_update_time': 'last_update_time',
+        'submitter_name': 'submitter_name',
+        'submitter_email': 'submitter_email',
+        'survey_title': 'survey_title',
+        'survey_default_language': 'survey_default_language',
+    }
+
     def _default_asdict(self) -> OrderedDict:
         return OrderedDict((
             ('id', self.id),
@@ -198,3 +217,185 @@ def most_recent_submissions(session, user_id, limit=None):
         .order_by(Submission.save_time.desc())
         .limit(limit)
     )
+
+
+_survey_statistics_table = sa.Table(
+    'survey_statistics',
+    Base.metadata,
+    sa.Column('survey_id', pg.UUID, util.fk('survey.id'), primary_key=True),
+    sa.Column(
+        'num_submissions', sa.Integer, nullable=False, server_default='0'
+    ),
+    sa.Column('earliest_submission_time', pg.TIMESTAMP(timezone=True)),
+    sa.Column('latest_submission_time', pg.TIMESTAMP(timezone=True)),
+)
+
+
+sa.event.listen(
+    Base.metadata,
+    'after_create',
+    # survey_statistics is kept up to date by triggers on survey and
+    # submission. Every statement here can be run again, and the INSERT fills
+    # in the statistics for surveys created before the table existed.
+    sa.DDL(
+        """
+        CREATE OR REPLACE FUNCTION {schema}.add_survey_statistics()
+        RETURNS TRIGGER AS $$
+        BEGIN
+            INSERT INTO {schema}.survey_statistics (survey_id)
+            VALUES (NEW.id);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS add_survey_statistics ON {schema}.survey;
+        CREATE TRIGGER add_survey_statistics
+        AFTER INSERT ON {schema}.survey
+        FOR EACH ROW EXECUTE PROCEDURE {schema}.add_survey_statistics();
+
+        CREATE OR REPLACE FUNCTION {schema}.update_survey_statistics()
+        RETURNS TRIGGER AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                UPDATE {schema}.survey_statistics SET
+                    num_submissions = num_submissions - 1,
+                    earliest_submission_time = CASE
+                        WHEN earliest_submission_time < OLD.save_time
+                        THEN earliest_submission_time
+                        ELSE (
+                            SELECT MIN(save_time)
+                            FROM {schema}.submission
+                            WHERE survey_id = OLD.survey_id
+                        )
+                    END,
+                    latest_submission_time = CASE
+                        WHEN latest_submission_time > OLD.save_time
+                        THEN latest_submission_time
+                        ELSE (
+                            SELECT MAX(save_time)
+                            FROM {schema}.submission
+                            WHERE survey_id = OLD.survey_id
+                        )
+                    END
+                WHERE survey_id = OLD.survey_id;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                UPDATE {schema}.survey_statistics SET
+                    num_submissions = num_submissions + 1,
+                    earliest_submission_time = LEAST(
+                        earliest_submission_time, NEW.save_time
+                    ),
+                    latest_submission_time = GREATEST(
+                        latest_submission_time, NEW.save_time
+                    )
+                WHERE survey_id = NEW.survey_id;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS update_survey_statistics
+            ON {schema}.submission;
+        CREATE TRIGGER update_survey_statistics
+        AFTER INSERT OR DELETE OR UPDATE OF survey_id, save_time
+        ON {schema}.submission
+        FOR EACH ROW EXECUTE PROCEDURE {schema}.update_survey_statistics();
+
+        INSERT INTO {schema}.survey_statistics (
+            survey_id, num_submissions,
+            earliest_submission_time, latest_submission_time
+        )
+        SELECT
+            survey.id, COUNT(submission.id),
+            MIN(submission.save_time), MAX(submission.save_time)
+        FROM {schema}.survey
+        LEFT JOIN {schema}.submission ON submission.survey_id = survey.id
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {schema}.survey_statistics
+            WHERE survey_statistics.survey_id = survey.id
+        )
+        GROUP BY survey.id;
+        """.format(schema=options.schema)
+    ),
+)
+
+
+_survey_daily_submissions_table = sa.Table(
+    'survey_daily_submissions',
+    Base.metadata,
+    sa.Column('survey_id', pg.UUID, util.fk('survey.id'), primary_key=True),
+    sa.Column('day', sa.Date, primary_key=True),
+    sa.Column('num_submissions', sa.Integer, nullable=False),
+)
+
+
+sa.event.listen(
+    Base.metadata,
+    'after_create',
+    # survey_daily_submissions counts the submissions to each survey on each
+    # day (CAST(save_time AS DATE), as the activity endpoints count them), so
+    # activity costs a row per day rather than a row per submission. Days
+    # without submissions have no row. A trigger on submission keeps the
+    # counts up to date. Every statement here can be run again, and the
+    # INSERT fills in the counts for surveys that have none yet.
+    sa.DDL(
+        """
+        CREATE OR REPLACE FUNCTION {schema}.update_survey_daily_submissions()
+        RETURNS TRIGGER AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                UPDATE {schema}.survey_daily_submissions SET
+                    num_submissions = num_submissions - 1
+                WHERE survey_id = OLD.survey_id
+                AND day = CAST(OLD.save_time AS DATE);
+                DELETE FROM {schema}.survey_daily_submissions
+                WHERE survey_id = OLD.survey_id
+                AND day = CAST(OLD.save_time AS DATE)
+                AND num_submissions <= 0;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                -- There is no INSERT ... ON CONFLICT in PostgreSQL 9.4
+                LOOP
+                    UPDATE {schema}.survey_daily_submissions SET
+                        num_submissions = num_submissions + 1
+                    WHERE survey_id = NEW.survey_id
+                    AND day = CAST(NEW.save_time AS DATE);
+                    EXIT WHEN FOUND;
+                    BEGIN
+                        INSERT INTO {schema}.survey_daily_submissions (
+                            survey_id, day, num_submissions
+                        )
+                        VALUES (NEW.survey_id, CAST(NEW.save_time AS DATE), 1);
+                        EXIT;
+                    EXCEPTION WHEN unique_violation THEN
+                        -- Another transaction added the day first
+                    END;
+                END LOOP;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS update_survey_daily_submissions
+            ON {schema}.submission;
+        CREATE TRIGGER update_survey_daily_submissions
+        AFTER INSERT OR DELETE OR UPDATE OF survey_id, save_time
+        ON {schema}.submission
+        FOR EACH ROW EXECUTE PROCEDURE
+            {schema}.update_survey_daily_submissions();
+
+        INSERT INTO {schema}.survey_daily_submissions (
+            survey_id, day, num_submissions
+        )
+        SELECT
+            submission.survey_id, CAST(submission.save_time AS DATE),
+            COUNT(submission.id)
+        FROM {schema}.submission
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {schema}.survey_daily_submissions
+            WHERE survey_daily_submissions.survey_id = submission.survey_id
+        )
+        GROUP BY submission.survey_id, CAST(submission.save_time AS DATE);
+        """.format(schema=options.schema)
+    ),
+)
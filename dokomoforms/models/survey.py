@@ -1,16 +1,21 @@
 """Survey models."""
 import abc
-from collections import OrderedDict
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, namedtuple
+from functools import partial
+from operator import itemgetter
 
 import sqlalchemy as sa
 from sqlalchemy.sql.functions import current_timestamp
 from sqlalchemy.sql.elements import quoted_name
 from sqlalchemy.dialects import postgresql as pg
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, joinedload, with_polymorphic
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.ext.orderinglist import ordering_list
 
-from dokomoforms.models import util, Base, node_type_enum
+from dokomoforms.models import util, Base, node_type_enum, Node, Choice
 from dokomoforms.exc import NoSuchBucketTypeError
 
 
@@ -139,6 +144,26 @@ class Survey(Base):
         ),
     )
 
+    # The fields that can be selected directly in SQL.
+    # See dokomoforms.models.util.get_fields_projection
+    _projectable_fields = {
+        'id': 'id',
+        'deleted': 'deleted',
+        'languages': 'languages',
+        'title': ('title', util.sorted_dict),
+        'url_slug': 'url_slug',
+        'default_language': 'default_language',
+        'survey_type': 'survey_type',
+        'version': 'version',
+        'creator_id': 'creator_id',
+        'metadata': 'survey_metadata',
+        'created_on': 'created_on',
+        'last_update_time': 'last_update_time',
+        'num_submissions': 'num_submissions',
+        'earliest_submission_time': 'earliest_submission_time',
+        'latest_submission_time': 'latest_submission_time',
+    }
+
     def _asdict(self) -> OrderedDict:
         return OrderedDict((
             ('id', self.id),
@@ -198,6 +223,52 @@ def most_recent_surveys(session, user_id, limit=None):
     )
 
 
+# An entry in the menu of an administrator's surveys, see menu_surveys
+MenuSurvey = namedtuple('MenuSurvey', 'id title default_language url_slug')
+
+
+def menu_surveys(session, cache, user_id, limit=None) -> tuple:
+    """Get the columns of an administrator's most recent surveys for a menu.
+
+    This selects only what a menu shows, and checks the survey_administrator
+    table with a subquery rather than a join, so each survey appears once.
+    The result is cached by user id. Creating a survey, or changing a
+    survey's or a user's administrators, has to invalidate the cache.
+
+    :param session: the SQLAlchemy session
+    :param cache: a dokomoforms.cache.LRUCache, or None
+    :param user_id: the UUID of the Administrator
+    :param limit: the maximum number of surveys
+    :returns: a tuple of MenuSurvey, most recently created first
+    """
+    if cache is not None:
+        surveys = cache.get(user_id)
+        if surveys is not None:
+            return surveys
+    administered = (
+        sa.select([_administrator_table.c.survey_id])
+        .where(_administrator_table.c.user_id == user_id)
+    )
+    surveys = tuple(
+        MenuSurvey(*row) for row in (
+            session
+            .query(
+                Survey.id, Survey.title, Survey.default_language,
+                Survey.url_slug,
+            )
+            .filter(sa.or_(
+                Survey.creator_id == user_id,
+                Survey.id.in_(administered),
+            ))
+            .order_by(Survey.created_on.desc())
+            .limit(limit)
+        )
+    )
+    if cache is not None:
+        cache.put(user_id, surveys)
+    return surveys
+
+
 _enumerator_table = sa.Table(
     'enumerator',
     Base.metadata,
@@ -783,56 +854,275 @@ def construct_survey_node(**kwargs) -> SurveyNode:
     # return survey_node
 
 
-def skipped_required(survey, answers) -> str:
-    """Return the id of a skipped AnswerableSurveyNode, or None."""
-    if not survey.nodes:
-        return None
+def load_survey_tree(session, survey_id, exception=None) -> Survey:
+    """Get a Survey with its whole tree of nodes loaded.
 
-    answer_stack = list(reversed(answers))
-    answer = answer_stack.pop() if answer_stack else None
+    Lazily loading the tree costs a query per SurveyNode, SubSurvey, Node,
+    and Bucket. Every SurveyNode and SubSurvey in the tree carries the
+    survey's containing_id, so instead this fetches each level with one
+    query and fills in the relationships with the results.
 
-    survey_node_stack = [(0, survey.nodes)]
+    :param session: the SQLAlchemy session
+    :param survey_id: the UUID of the Survey
+    :param exception: the exception to raise if there is no such Survey.
+                      Defaults to sqlalchemy.orm.exc.NoResultFound
+    :returns: the Survey
+    """
+    survey = (
+        session
+        .query(Survey)
+        .options(joinedload(Survey.creator))
+        .get(survey_id)
+    )
+    if survey is None:
+        if exception is None:
+            exception = NoResultFound((Survey, survey_id))
+        raise exception
 
-    while survey_node_stack:
-        survey_node_index, survey_nodes = survey_node_stack.pop()
-        try:
-            survey_node = survey_nodes[survey_node_index]
-        except IndexError:
-            continue
+    survey_nodes = (
+        session
+        .query(with_polymorphic(SurveyNode, '*'))
+        .filter(SurveyNode.containing_survey_id == survey.containing_id)
+        .order_by(SurveyNode.node_number)
+        .all()
+    )
+    sub_surveys = (
+        session
+        .query(SubSurvey)
+        .filter(SubSurvey.containing_survey_id == survey.containing_id)
+        .order_by(SubSurvey.sub_survey_number)
+        .all()
+    )
+    sub_survey_ids = [sub_survey.id for sub_survey in sub_surveys]
+    buckets = []
+    if sub_survey_ids:
+        buckets = (
+            session
+            .query(with_polymorphic(Bucket, '*'))
+            .filter(Bucket.sub_survey_id.in_(sub_survey_ids))
+            .all()
+        )
+    node_ids = {survey_node.node_id for survey_node in survey_nodes}
+    nodes = {}
+    choices = []
+    if node_ids:
+        nodes = {
+            node.id: node for node in (
+                session
+                .query(with_polymorphic(Node, '*'))
+                .filter(Node.id.in_(node_ids))
+            )
+        }
+        choices = (
+            session
+            .query(Choice)
+            .filter(Choice.question_id.in_(node_ids))
+            .order_by(Choice.choice_number)
+            .all()
+        )
+
+    choices_by_question = {node_id: [] for node_id in nodes}
+    choices_by_id = {}
+    for choice in choices:
+        choices_by_question[choice.question_id].append(choice)
+        choices_by_id[choice.id] = choice
+        set_committed_value(choice, 'question', nodes[choice.question_id])
+    for node in nodes.values():
+        if node.type_constraint == 'multiple_choice':
+            set_committed_value(node, 'choices', choices_by_question[node.id])
+
+    buckets_by_sub_survey = {
+        sub_survey_id: [] for sub_survey_id in sub_survey_ids
+    }
+    for bucket in buckets:
+        buckets_by_sub_survey[bucket.sub_survey_id].append(bucket)
+        if bucket.bucket_type == 'multiple_choice':
+            choice = choices_by_id[bucket.choice_id]
+            set_committed_value(bucket, 'bucket', choice)
+
+    survey_nodes_by_parent = {survey.id: []}
+    sub_surveys_by_parent = {}
+    for sub_survey in sub_surveys:
+        survey_nodes_by_parent[sub_survey.id] = []
+        sub_surveys_by_parent.setdefault(
+            sub_survey.parent_survey_node_id, []
+        ).append(sub_survey)
+        set_committed_value(
+            sub_survey, 'buckets', buckets_by_sub_survey[sub_survey.id]
+        )
+    for survey_node in survey_nodes:
+        parent_id = survey_node.root_survey_id or survey_node.sub_survey_id
+        survey_nodes_by_parent[parent_id].append(survey_node)
+        node = nodes[survey_node.node_id]
+        set_committed_value(survey_node, 'the_node', node)
+        set_committed_value(survey_node, 'node', node)
+        if isinstance(survey_node, AnswerableSurveyNode):
+            set_committed_value(
+                survey_node,
+                'sub_surveys',
+                sub_surveys_by_parent.get(survey_node.id, []),
+            )
+
+    set_committed_value(survey, 'nodes', survey_nodes_by_parent[survey.id])
+    for sub_survey in sub_surveys:
+        set_committed_value(
+            sub_survey, 'nodes', survey_nodes_by_parent[sub_survey.id]
+        )
+
+    return survey
+
+
+# The compiled form of a survey for skipped_required. Each list of
+# SurveyNodes becomes a _Block of _Steps. next_required[i] is the index of the
+# first required step at or after i (or len(steps)) and positions maps each
+# node id to the sorted indices of its steps, so finding the step an answer
+# belongs to is a lookup rather than a walk. A step's sub-surveys are indexed
+# by choice id for multiple choice questions, and by the sorted lower bounds
+# of their ranges for the others. A range bucket can't overlap the other
+# buckets of the same SurveyNode, so only the last range starting at or
+# before the answer can contain it.
+_Block = namedtuple('_Block', 'steps next_required positions')
+_Step = namedtuple('_Step', 'id node_id required choices range_keys ranges')
+
+
+def _range_key(bucket_range):
+    if bucket_range.lower_inf:
+        return (0,)
+    return (1, bucket_range.lower, 0 if bucket_range.lower_inc else 1)
+
+
+def _compile_step(survey_node, compile_block) -> _Step:
+    required = False
+    choices = None
+    ranges = []
+    if isinstance(survey_node, AnswerableSurveyNode):
+        required = survey_node.required
+        is_mc = survey_node.type_constraint == 'multiple_choice'
+        if is_mc:
+            choices = {}
+        for sub_survey in survey_node.sub_surveys:
+            block = compile_block(sub_survey.nodes)
+            branch = (block, sub_survey.repeatable)
+            for bucket in sub_survey.buckets:
+                if is_mc:
+                    choices.setdefault(bucket.choice_id, []).append(branch)
+                else:
+                    bucket_range = bucket.bucket
+                    ranges.append((
+                        _range_key(bucket_range), bucket_range,
+                        block, sub_survey.repeatable
+                    ))
+        ranges.sort(key=itemgetter(0))
+    return _Step(
+        survey_node.id,
+        survey_node.node_id,
+        required,
+        choices,
+        [entry[0] for entry in ranges],
+        tuple(ranges),
+    )
 
-        answerable = isinstance(survey_node, AnswerableSurveyNode)
-        required = survey_node.required if answerable else False
+
+def _compile_block(survey_nodes) -> _Block:
+    steps = tuple(
+        _compile_step(survey_node, _compile_block)
+        for survey_node in survey_nodes
+    )
+    next_required = [len(steps)] * (len(steps) + 1)
+    for index in reversed(range(len(steps))):
+        if steps[index].required:
+            next_required[index] = index
+        else:
+            next_required[index] = next_required[index + 1]
+    positions = {}
+    for index, step in enumerate(steps):
+        positions.setdefault(step.node_id, []).append(index)
+    return _Block(steps, tuple(next_required), positions)
+
+
+def _branches(step, main_answer):
+    """The (block, repeatable) sub-surveys that an answer leads into."""
+    if main_answer is None:
+        return ()
+    if step.choices is not None:
+        return step.choices.get(main_answer, ())
+    index = bisect_right(step.range_keys, (1, main_answer, 0)) - 1
+    if index < 0:
+        return ()
+    _, bucket_range, block, repeatable = step.ranges[index]
+    if main_answer in bucket_range:
+        return ((block, repeatable),)
+    return ()
+
+
+def _run_required_check(program, answers) -> str:
+    """Execute a compiled survey, see compile_required_check."""
+    answers = iter(answers)
+    answer = next(answers, None)
+    # Each frame is [block, index, number of times left to run the block]
+    stack = [[program, 0, 1]]
+    while stack:
+        frame = stack[-1]
+        block, index, repeats = frame
+        steps = block.steps
 
         if answer is None:
-            if required:
-                return survey_node.id
-            # See https://bitbucket.org/ned/coveragepy/issues/198/
-            continue  # pragma: no cover
-
-        answer_matches_node = survey_node.node_id == answer.question_id
-        if not answer_matches_node and required:
-            return survey_node.id
-
-        survey_node_stack.append((survey_node_index + 1, survey_nodes))
-
-        if answer_matches_node and answerable:
-            for sub_survey in survey_node.sub_surveys:
-                for bucket in sub_survey.buckets:
-                    main_ans = answer.main_answer
-                    not_none = main_ans is not None
-                    if answer.answer_type == 'multiple_choice':
-                        bucket_match = main_ans == bucket.bucket.id
-                    else:
-                        bucket_match = not_none and main_ans in bucket.bucket
-                    if bucket_match:
-                        survey_nodes = sub_survey.nodes
-                        if sub_survey.repeatable:
-                            for _ in range(main_ans):
-                                survey_node_stack.append((0, survey_nodes))
-                        else:
-                            survey_node_stack.append((0, survey_nodes))
-
-        if answer_matches_node:
-            answer = answer_stack.pop() if answer_stack else None
+            # Only the next step of each pending block needs checking
+            if index < len(steps) and steps[index].required:
+                return steps[index].id
+            if repeats > 1 and steps and steps[0].required:
+                return steps[0].id
+            stack.pop()
+            continue
+
+        positions = block.positions.get(answer.question_id, ())
+        position = bisect_left(positions, index)
+        match = positions[position] if position < len(positions) else None
+        required = block.next_required[index]
+        if match is None or required < match:
+            if required < len(steps):
+                return steps[required].id
+            if repeats > 1 and index > 0:
+                # Start the next repetition
+                frame[1:] = [0, repeats - 1]
+            else:
+                # The other repetitions would skip the answer the same way
+                stack.pop()
+            continue
+
+        step = steps[match]
+        frame[1] = match + 1
+        main_answer = answer.main_answer
+        answer = next(answers, None)
+        for sub_block, repeatable in _branches(step, main_answer):
+            times = main_answer if repeatable else 1
+            if times > 0:
+                stack.append([sub_block, 0, times])
 
     return None
+
+
+def compile_required_check(survey):
+    """Compile a survey into a function for finding skipped questions.
+
+    The function takes the answers to the survey, in order, and returns the
+    id of the first required AnswerableSurveyNode that was skipped, or None.
+    The survey's branching is precompiled, so the function takes time
+    proportional to the number of answers, and a repeatable sub-survey is
+    one stack frame with a count however many times it repeats.
+
+    The function doesn't refer to the survey or the session, so it can be
+    kept with the survey's snapshot (see dokomoforms.models.snapshot).
+
+    :param survey: the Survey, ideally with its tree loaded
+    :returns: a function of the answers
+    """
+    return partial(_run_required_check, _compile_block(survey.nodes))
+
+
+def skipped_required(survey, answers) -> str:
+    """Return the id of a skipped AnswerableSurveyNode, or None.
+
+    See compile_required_check.
+    """
+    return compile_required_check(survey)(answers)
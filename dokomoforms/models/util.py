@@ -14,6 +14,7 @@ import datetime
 import json
 from collections import OrderedDict
 from decimal import Decimal
+from operator import attrgetter, methodcaller
 
 import sqlalchemy as sa
 import sqlalchemy.engine
@@ -84,10 +85,19 @@ class Base(declarative_base(metadata=metadata, metaclass=_Meta)):
         In addition, consider returning an instance of collections.OrderedDict
         instead of a regular dict so that the restless serializer and __str__
         method always return the keys in the same order.
+
+        If the representation is just some of the column attributes, set
+        _asdict = fields_asdict(...) instead, which lets fast_json_dumps
+        serialize the model without calling _asdict.
         """
 
+    # Whether __str__ uses fast_json_dumps instead of json.dumps.
+    _fast_json = True
+
     def __str__(self) -> str:
         """Return the string representation of this model."""
+        if self._fast_json:
+            return fast_json_dumps(self, indent=4)
         return (
             json.dumps(self, cls=ModelJSONEncoder, indent=4)
             .replace('</', '<\\/')
@@ -110,11 +120,64 @@ sa.event.listen(
         'CREATE EXTENSION IF NOT EXISTS "postgis";'  # Geometry columns
         'CREATE EXTENSION IF NOT EXISTS "btree_gist"'  # Exclusion constraints
         ' WITH SCHEMA pg_catalog;'
+        'CREATE EXTENSION IF NOT EXISTS "pg_trgm"'  # Search indexes
+        ' WITH SCHEMA pg_catalog;'
         .format(db=options.db_database, schema=options.schema)
     ),
 )
 
 
+def _trigram_index(name, table, expression) -> str:
+    """A statement that creates a pg_trgm GIN index unless it exists.
+
+    CREATE INDEX IF NOT EXISTS is new in PostgreSQL 9.5, so this catches the
+    error instead.
+    """
+    return """
+        DO $$
+        BEGIN
+            CREATE INDEX "{name}" ON {schema}.{table}
+            USING GIN (({expression}) gin_trgm_ops);
+        EXCEPTION WHEN duplicate_table THEN
+            -- The index exists already
+        END;
+        $$;
+        """.format(
+        name=name.replace('"', '""'), schema=options.schema, table=table,
+        expression=expression,
+    )
+
+
+def _trigram_indexes() -> str:
+    """The statements that create the indexes used by column_search.
+
+    Translated titles are indexed as title->>'<language>' for each of the
+    search_languages, and survey titles also as title->>default_language.
+    """
+    indexes = [
+        ('survey_title_trgm', 'survey', 'title->>default_language'),
+        ('auth_user_name_trgm', 'auth_user', 'name'),
+        ('email_address_trgm', 'email', 'address'),
+        ('submission_submitter_name_trgm', 'submission', 'submitter_name'),
+    ]
+    for language in options.search_languages:
+        title = "title->>'{}'".format(language.replace("'", "''"))
+        indexes.extend((
+            ('survey_title_trgm_{}'.format(language.lower()), 'survey', title),
+            ('node_title_trgm_{}'.format(language.lower()), 'node', title),
+        ))
+    return ''.join(_trigram_index(*index) for index in indexes)
+
+
+sa.event.listen(
+    Base.metadata,
+    'after_create',
+    # The indexes are created after the tables, and for an existing database
+    # on the next startup.
+    sa.DDL(_trigram_indexes()),
+)
+
+
 UUID_REGEX = (
     '[a-f0-9]{8}-?[a-f0-9]{4}-?4[a-f0-9]{3}-?[89ab][a-f0-9]{3}-?[a-f0-9]{12}'
 )
@@ -173,6 +236,152 @@ class ModelJSONEncoder(json.JSONEncoder):
             return super().default(obj)
 
 
+# The fast path for JSON encoding. json.dumps with ModelJSONEncoder creates
+# a new encoder for every call and runs the isinstance chain in jsonify for
+# every value the json module can't handle natively. Instead, the converters
+# for those values are looked up by the exact type of the value. The lookup
+# for a new type goes through its MRO once and the result is stored in the
+# table, so each model class gets its converter compiled on first use.
+def _range_str(obj) -> str:
+    left, right = obj._bounds
+    return '{}{},{}{}'.format(left, obj.lower, obj.upper, right)
+
+
+_JSON_CONVERTERS = {
+    bytes: bytes.decode,
+    datetime.date: methodcaller('isoformat'),
+    datetime.time: methodcaller('isoformat'),
+    datetime.datetime: methodcaller('isoformat'),
+    Decimal: float,
+    Range: _range_str,
+}
+
+
+def fields_asdict(*names):
+    """Return an _asdict method that maps the names to the attributes.
+
+    Use this for a model whose dictionary representation is just some of
+    its column attributes:
+
+        class Photo(Base):
+            ...
+            _asdict = util.fields_asdict('id', 'deleted', 'mime_type')
+
+    fast_json_dumps compiles a plan for such a model instead of calling
+    _asdict (see _compile_model_plan).
+    """
+    def _asdict(self) -> OrderedDict:
+        return OrderedDict((name, getattr(self, name)) for name in names)
+    _asdict.fields = names
+    return _asdict
+
+
+def _column_python_type(model_cls, name):
+    """The Python type of a column attribute's values, or None."""
+    try:
+        return sa.inspect(model_cls).columns[name].type.python_type
+    except (KeyError, NotImplementedError):
+        return None
+
+
+def _compile_model_plan(model_cls, names):
+    """Return the converter for a model with an _asdict from fields_asdict.
+
+    The plan is a getter for each column attribute and the converter for the
+    column's type, if there is one. A value of another type (e.g. one that
+    hasn't been flushed yet) is left for _convert.
+    """
+    plan = []
+    for name in names:
+        value_type = _column_python_type(model_cls, name)
+        plan.append((
+            name, attrgetter(name),
+            value_type, _JSON_CONVERTERS.get(value_type),
+        ))
+
+    def convert(obj):
+        result = OrderedDict()
+        for name, get_value, value_type, convert_value in plan:
+            value = get_value(obj)
+            if convert_value is not None and type(value) is value_type:
+                value = convert_value(value)
+            result[name] = value
+        return result
+    return convert
+
+
+def _compile_converter(obj_type):
+    """Find and remember the converter for a type the table doesn't have."""
+    if issubclass(obj_type, Base):
+        fields = getattr(obj_type._asdict, 'fields', None)
+        if fields is None:
+            # The representation is computed, so the plan is to call _asdict
+            converter = obj_type._asdict
+        else:
+            converter = _compile_model_plan(obj_type, fields)
+    else:
+        for base in obj_type.__mro__[1:]:
+            if base in _JSON_CONVERTERS:
+                converter = _JSON_CONVERTERS[base]
+                break
+        else:
+            raise TypeError('{!r} is not JSON serializable'.format(obj_type))
+    _JSON_CONVERTERS[obj_type] = converter
+    return converter
+
+
+def _convert(obj):
+    """The default function for the fast encoders."""
+    obj_type = type(obj)
+    try:
+        converter = _JSON_CONVERTERS[obj_type]
+    except KeyError:
+        converter = _compile_converter(obj_type)
+    return converter(obj)
+
+
+def _make_fast_encoder(indent):
+    """Return a function which encodes an object into a str.
+
+    Without an indent, json.JSONEncoder uses the C encoder from the json
+    module.
+    """
+    encoder = json.JSONEncoder(
+        default=_convert, indent=indent, check_circular=False
+    )
+    return encoder.encode
+
+
+_fast_encoders = {}
+
+
+def fast_json_dumps(obj, *, indent: int=None) -> str:
+    """Serialize obj to a JSON string with '</' escaped.
+
+    The output is the same as that of
+
+        json.dumps(obj, cls=ModelJSONEncoder, indent=indent)
+        .replace('</', '<\\/')
+
+    but the encoder is only built once, and the conversion of models and
+    other special values is a table lookup on their type.
+
+    :param obj: the object to serialize
+    :param indent: the number of spaces to indent nested values with. The
+                   output is on one line if this is None.
+    :return: the JSON string
+    """
+    try:
+        encode = _fast_encoders[indent]
+    except KeyError:
+        encode = _fast_encoders[indent] = _make_fast_encoder(indent)
+    result = encode(obj)
+    if '</' in result:
+        # This way the JSON can go into a <script> element
+        return result.replace('</', '<\\/')
+    return result
+
+
 def create_engine(pool_size: int=None,
                   max_overflow: int=None,
                   echo: bool=None) -> sqlalchemy.engine.Engine:
@@ -199,7 +408,52 @@ def create_engine(pool_size: int=None,
         engine_params['pool_size'] = pool_size
     if max_overflow is not None:
         engine_params['max_overflow'] = max_overflow
-    return sa.create_engine(connection_string, **engine_params)
+    engine = sa.create_engine(connection_string, **engine_params)
+    # See statement_count
+    sa.event.listen(engine, 'before_cursor_execute', _count_statement)
+    return engine
+
+
+def _count_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    if context is None:
+        return
+    info = context.execution_options.get('statement_count_info')
+    if info is not None:
+        info['statement_count'] += 1
+
+
+def statement_count(session) -> int:
+    """The number of SQL statements the session has executed so far.
+
+    The count is kept in session.info and starts at 0 on the first call,
+    which rebinds the session to a copy of its bind that counts the
+    statements executed through it (the bind must come from create_engine).
+    Take the difference between two calls to count the statements executed
+    in between. Other sessions' statements are not counted.
+
+    :param session: the SQLAlchemy session
+    :return: the number of statements since the first call
+    """
+    info = session.info
+    if 'statement_count' not in info:
+        info['statement_count'] = 0
+        session.bind = session.bind.execution_options(
+            statement_count_info=info
+        )
+    return info['statement_count']
+
+
+def count_statement(session) -> None:
+    """Add a statement that didn't go through the session to its count.
+
+    For the queries of the session's request that run elsewhere, like on the
+    async pool (see dokomoforms.models.async_db). See statement_count.
+
+    :param session: the SQLAlchemy session
+    """
+    statement_count(session)
+    session.info['statement_count'] += 1
 
 
 def pk(*foreign_key_column_names: str) -> sa.Column:
@@ -325,51 +579,61 @@ def get_model(session, model_cls, model_id, exception=None):
 
 def column_search(query, *,
                   model_cls, column_name, search_term,
-                  language=None, regex=False) -> 'query':
+                  language=None, regex=False, rank=False) -> 'query':
     """Modify a query to search a column's values (JSONB or TEXT).
 
-    TODO: document this
-
-    :param query: a
-    :param model_cls: aa
-    :param column: b
-    :param search_term: c
-    :param language: d
-    :param regex: r
+    A plain search matches the values that contain search_term, ignoring
+    case. A regex search matches the values against search_term as a
+    case-insensitive POSIX regular expression. The value of a JSONB column of
+    translations is its translation in the given language.
+
+    Both filters compare the same expression that the pg_trgm GIN indexes
+    cover (column->>language or the TEXT column), so PostgreSQL can use an
+    index instead of scanning every row. Terms shorter than three characters
+    can't use a trigram index.
+
+    With rank=True, values that are merely similar to search_term match too,
+    which tolerates typos, and the results are ordered by their similarity to
+    search_term, most similar first.
+
+    :param query: the query to modify
+    :param model_cls: the model class that has the column
+    :param column_name: the name of the JSONB or TEXT column to search
+    :param search_term: the string (or regular expression) to search for
+    :param language: the language to search in a JSONB column. Defaults to
+                     the model's default_language.
+    :param regex: whether search_term is a regular expression
+    :param rank: whether to match similar values and order by similarity
     :return: The modified query.
+    :raises ValueError: if both regex and rank are True
     """
+    if regex and rank:
+        raise ValueError('A regular expression search cannot be ranked.')
     column = getattr(model_cls, column_name)
-    if not regex:
-        search_term = search_term.translate(str.maketrans(
-            {'%': '\%', '_': '\_', '\\': r'\\'}
-        ))
     # JSONB column
     if str(column.type) == 'JSONB':
         if language is None:
             # note that Node has no default_language
             language = model_cls.default_language
-        # Search for a specific language
-        if regex:
-            return (
-                query
-                .filter(sa.text("{}->>:lang ~* :search_term".format(column)))
-                .params(lang=language, search_term=search_term)
-            )
-        return (
-            query
-            .filter(column[language].astext.ilike('%{}%'.format(search_term)))
-        )
-
+        value = column[language].astext
     # TEXT column
+    else:
+        value = column
     if regex:
-        return (
-            query
-            .filter(sa.text('{} ~* :search_term'.format(column)))
-            .params(search_term=search_term)
-        )
+        return query.filter(value.op('~*')(search_term))
+    escaped_term = search_term.translate(str.maketrans(
+        {'%': '\%', '_': '\_', '\\': r'\\'}
+    ))
+    contains = value.ilike('%{}%'.format(escaped_term))
+    if not rank:
+        return query.filter(contains)
+    # The pg_trgm similarity operator, escaped for psycopg2. PostgreSQL
+    # parses % with the precedence of modulo, so ->> needs parentheses.
+    similar = value.op('%%', precedence=8, is_comparison=True)
     return (
         query
-        .filter(column.ilike('%{}%'.format(search_term)))
+        .filter(sa.or_(contains, similar(search_term)))
+        .order_by(func.similarity(value, search_term).desc())
     )
 
 
@@ -386,3 +650,46 @@ def get_fields_subset(model: Base, fields: list) -> OrderedDict:
     return OrderedDict(
         (name, _get_field(model, name)) for name in fields if name
     )
+
+
+def sorted_dict(dictionary: dict) -> OrderedDict:
+    """Return an OrderedDict of the given dict, sorted by key."""
+    return OrderedDict(sorted(dictionary.items()))
+
+
+def _identity(value):
+    return value
+
+
+def get_fields_projection(model_cls, fields: list) -> list:
+    """Return the SQL expressions for the given fields, or None.
+
+    This is the counterpart of get_fields_subset for when the fields can be
+    selected directly instead of loading the whole model. A model class lists
+    the fields that it can project in its _projectable_fields dict, which maps
+    a key of the model's _asdict to the name of the attribute it comes from,
+    or to a tuple of the attribute name and a function to apply to the
+    selected value.
+
+    :param model_cls: the model class
+    :param fields: the requested field names (empty names are skipped)
+    :return: a list of (field name, SQL expression, conversion function)
+             tuples, or None if any of the fields can't be projected
+    """
+    projectable = getattr(model_cls, '_projectable_fields', None)
+    if projectable is None:
+        return None
+    projection = []
+    for name in fields:
+        if not name:
+            continue
+        try:
+            spec = projectable[name]
+        except KeyError:
+            return None
+        if isinstance(spec, tuple):
+            attribute_name, convert = spec
+        else:
+            attribute_name, convert = spec, _identity
+        projection.append((name, getattr(model_cls, attribute_name), convert))
+    return projection or None
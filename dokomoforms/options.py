@@ -62,6 +62,98 @@ max_overflow_help = (
 )
 define('max_overflow', default=None, help=max_overflow_help, type=int)
 
+db_executor_workers_help = (
+    'the number of threads that run database-bound API requests off of the'
+    ' IOLoop. Use 0 to run them on the IOLoop. Keep this below pool_size +'
+    ' max_overflow.'
+)
+define(
+    'db_executor_workers', default=4, help=db_executor_workers_help, type=int
+)
+
+async_db_pool_size_help = (
+    'the number of non-blocking database connections for read-only API'
+    ' requests like stats, activity and fields= lists. Requires momoko. Use 0'
+    ' to run those requests on the executor too.'
+)
+define(
+    'async_db_pool_size', default=0, help=async_db_pool_size_help, type=int
+)
+
+survey_cache_size_help = (
+    'the number of surveys to keep in memory, fully loaded, for the survey'
+    ' pages and API. Use 0 to load them from the database every time.'
+)
+define(
+    'survey_cache_size', default=128, help=survey_cache_size_help, type=int
+)
+
+survey_cache_ttl_help = (
+    'the number of seconds before a cached survey is dropped. Each use'
+    ' already checks its version and last update time, so this only bounds'
+    ' how long unused surveys stay in memory.'
+)
+define('survey_cache_ttl', default=3600, help=survey_cache_ttl_help, type=int)
+
+principal_cache_size_help = (
+    'the number of logged-in users whose name, role, preferences, allowed'
+    ' surveys and survey menu are kept in memory. Use 0 to look them up on'
+    ' every request.'
+)
+define(
+    'principal_cache_size', default=1024, help=principal_cache_size_help,
+    type=int
+)
+
+principal_cache_ttl_help = (
+    'the number of seconds before a cached user is looked up again, which'
+    ' bounds how long changes made by another process go unnoticed'
+)
+define(
+    'principal_cache_ttl', default=300, help=principal_cache_ttl_help,
+    type=int
+)
+
+token_cache_size_help = (
+    'the number of verified API tokens to remember, so that bcrypt only runs'
+    ' on the first request with a token. Use 0 to verify every request.'
+)
+define('token_cache_size', default=1024, help=token_cache_size_help, type=int)
+
+token_cache_ttl_help = (
+    'the number of seconds to remember a verified API token for'
+)
+define('token_cache_ttl', default=600, help=token_cache_ttl_help, type=int)
+
+photo_storage_help = (
+    "where to keep the images of new photos: 'filesystem' (a directory, see"
+    " photo_directory) or 'database'"
+)
+define('photo_storage', default='filesystem', help=photo_storage_help)
+
+photo_directory_help = (
+    'the directory for photos in filesystem storage. Defaults to the photos'
+    ' directory next to webapp.py'
+)
+define('photo_directory', help=photo_directory_help)
+
+photo_accel_redirect_help = (
+    'the nginx internal location that serves photo_directory. If this is set,'
+    ' photos are sent by nginx with X-Accel-Redirect instead of by the'
+    ' application'
+)
+define('photo_accel_redirect', help=photo_accel_redirect_help)
+
+search_languages_help = (
+    'the languages of survey and node titles to index for search=, separated'
+    ' by commas. Titles in other languages can be searched too, but without'
+    ' an index.'
+)
+define(
+    'search_languages', default=['English'], help=search_languages_help,
+    multiple=True
+)
+
 kill_help = 'whether to drop the existing schema before starting'
 define('kill', default=False, help=kill_help, type=bool)
 
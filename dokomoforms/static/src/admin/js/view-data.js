@@ -7,13 +7,13 @@ var $ = require('jquery'),
 
 var ViewData = (function() {
     var maps = {},
-        map_data = {};
+        survey_id;
 
-    function init(_map_data) {
+    function init(_survey_id) {
         base.init();
         // TODO: is this check necessary?
         if (window.CURRENT_USER_ID !== 'None') {
-            map_data = _map_data;
+            survey_id = _survey_id;
             utils.populateDates(window.DATETIMES);
             setupEventHandlers();
         }
@@ -35,53 +35,96 @@ var ViewData = (function() {
             if ($el.hasClass('question-type-location') || $el.hasClass('question-type-facility')) {
                 if (!maps[id]) {
                     console.log(id);
-                    drawMap(id, map_data[id]);
+                    drawMap(id, mapUrl(id));
                 }
             }
         });
     }
 
-    function drawMap(element_id, map_data) {
-        var markers = [];
+    function mapUrl(element_id) {
+        var survey_node_id = element_id.replace('location-map-', '');
+        return '/api/v0/surveys/' + survey_id + '/nodes/' + survey_node_id + '/map';
+    }
 
+    // The server sends clustered counts for the visible part of the map, and
+    // the individual answers once the map is zoomed in far enough.
+    function drawMap(element_id, url) {
         var map = L.map(element_id, {
             dragging: true,
-            zoom: 14,
             // zoomControl: false,
             // doubleClickZoom: false,
             attributionControl: false
         });
 
-        maps[element_id] = map;
+        var markers_group = L.featureGroup().addTo(map);
 
-        markers = [];
+        maps[element_id] = map;
 
         L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {}).addTo(map);
 
-        _.each(map_data.map_data, function(answer) {
-            var coordinates = answer.coordinates,
-                marker = new L.marker([coordinates.lat, coordinates.lng], {
-                    riseOnHover: true
-                });
+        function clusterMarker(cluster) {
+            var marker = new L.marker([cluster.lat, cluster.lng], {
+                icon: new L.divIcon({
+                    className: 'location-map-cluster',
+                    html: String(cluster.count),
+                    iconSize: [30, 30]
+                })
+            });
+            marker.on('click', function() {
+                map.setView([cluster.lat, cluster.lng], map.getZoom() + 2);
+            });
+            return marker;
+        }
+
+        function pointMarker(point) {
+            var marker = new L.marker([point.lat, point.lng], {
+                riseOnHover: true,
+                title: point.facility_name || ''
+            });
             marker.options.icon = new L.icon({
                 iconUrl: '/static/dist/admin/img/icons/normal_base.png',
                 iconAnchor: [15, 48]
             });
             marker.on('click', function() {
-                new SubmissionModal({submission_id: answer.submission_id}).open();
+                new SubmissionModal({submission_id: point.submission_id}).open();
             });
-            markers.push(marker);
-        });
+            return marker;
+        }
 
-        if (markers.length) {
-            var markers_group = new L.featureGroup(markers);
-            markers_group.addTo(map);
+        function load(params, callback) {
+            $.getJSON(url, params, function(resp) {
+                markers_group.clearLayers();
+                _.each(resp.clusters, function(cluster) {
+                    markers_group.addLayer(clusterMarker(cluster));
+                });
+                _.each(resp.points, function(point) {
+                    markers_group.addLayer(pointMarker(point));
+                });
+                if (callback) {
+                    callback();
+                }
+            });
+        }
+
+        function loadBounds() {
+            load({
+                bbox: map.getBounds().toBBoxString(),
+                zoom: map.getZoom()
+            });
+        }
+
+        // Fit the map to the coarsest clusters, then follow the map around.
+        load({}, function() {
+            if (!markers_group.getLayers().length) {
+                map.setView([0, 0], 1);
+                console.log('No submissions include location.');
+                return;
+            }
+            map.on('moveend', loadBounds);
             map.fitBounds(markers_group.getBounds(), {
                 padding: [40, 40]
             });
-        } else {
-            console.log('No submissions include location.');
-        }
+        });
     }
 
     return {
@@ -837,42 +837,43 @@ var Application = React.createClass({
         // Get all unsynced facilities
         var unsynced_facilities = JSON.parse(localStorage['unsynced_facilities'] || '[]');
 
-        // Post surveys to Dokomoforms
+        // Post surveys to Dokomoforms, all in one request
         unsynced_submissions.forEach(function(survey) {
             // Update submit time
             survey.submission_time = new Date().toISOString();
+        });
+
+        if (unsynced_submissions.length) {
             $.ajax({
-                url: '/api/v0/surveys/' + survey.survey_id + '/submit',
+                url: '/api/v0/submissions/batch',
                 type: 'POST',
                 contentType: 'application/json',
                 processData: false,
-                data: JSON.stringify(survey),
+                data: JSON.stringify({submissions: unsynced_submissions}),
                 headers: {
                     'X-XSRFToken': cookies.getCookie('_xsrf')
                 },
                 dataType: 'json',
-                success: function(survey, anything, hey) {
-                    console.log('success', anything, hey);
-                    // Get all unsynced surveys
-                    var unsynced_surveys = JSON.parse(localStorage['unsynced'] || '{}');
-                    // Get array of unsynced submissions to this survey
-                    var unsynced_submissions = unsynced_surveys[survey.survey_id] || [];
-
-                    // Find unsynced_submission
-                    var idx = -1;
-                    unsynced_submissions.forEach(function(usurvey, i) {
-                        if (Date(usurvey.save_time) === Date(survey.save_time)) {
-                            idx = i;
+                success: function(response) {
+                    console.log('success', response);
+                    // Find the save times of the submissions that were saved
+                    var synced = {};
+                    response.results.forEach(function(result, i) {
+                        if (result.status === 201) {
+                            synced[unsynced_submissions[i].save_time] = true;
+                        } else {
+                            console.log('Failed to post survey', result, unsynced_submissions[i]);
                         }
                     });
 
-                    // Not sure what happened, do not update localStorage
-                    if (idx === -1)
-                        return;
-
-                    unsynced_submissions.splice(idx, 1);
-
-                    unsynced_surveys[survey.survey_id] = unsynced_submissions;
+                    // Get all unsynced surveys
+                    var unsynced_surveys = JSON.parse(localStorage['unsynced'] || '{}');
+                    // Keep only the submissions to this survey that failed
+                    unsynced_surveys[self.props.survey.id] = (
+                        unsynced_surveys[self.props.survey.id] || []
+                    ).filter(function(usurvey) {
+                        return !synced[usurvey.save_time];
+                    });
                     localStorage['unsynced'] = JSON.stringify(unsynced_surveys);
 
                     // Update splash page if still on it
@@ -881,28 +882,24 @@ var Application = React.createClass({
                 },
 
                 error: function(err) {
-                    console.log('Failed to post survey', err, survey);
+                    console.log('Failed to post surveys', err, unsynced_submissions);
                 }
             });
 
-            console.log('synced submission:', survey);
-            console.log('survey', '/api/v0/surveys/' + survey.survey_id + '/submit');
-        });
+            console.log('syncing submissions:', unsynced_submissions);
+        }
 
         // Post photos to dokomoforms
         unsynced_photos.forEach(function(photo) {
             if (photo.surveyID === self.props.survey.id) {
-                PhotoAPI.getBase64(self.state.db, photo.photoID, function(err, base64) {
+                PhotoAPI.getBlob(self.state.db, photo.photoID, function(err, blob) {
+                    // Send the image as it is rather than as base64 in JSON
                     $.ajax({
-                        url: '/api/v0/photos',
+                        url: '/api/v0/photos/' + photo.photoID + '/image',
                         type: 'POST',
-                        contentType: 'application/json',
+                        contentType: blob.type || 'image/png',
                         processData: false,
-                        data: JSON.stringify({
-                            'id': photo.photoID,
-                            'mime_type': 'image/png',
-                            'image': base64
-                        }),
+                        data: blob,
                         headers: {
                             'X-XSRFToken': cookies.getCookie('_xsrf')
                         },
@@ -0,0 +1,149 @@
+"""Where the images of Photos are kept.
+
+A Photo row holds the metadata of an image: its mime_type, size, the SHA-256
+content_hash of the image and the name of the storage backend that has it.
+The backends are
+
+- filesystem (the default): a content-addressed directory. Each image is
+  written once to <directory>/<hash[:2]>/<hash[2:4]>/<hash>, so identical
+  photos share a file. If nginx serves the directory as an internal
+  location, the image can be handed off with X-Accel-Redirect instead of
+  being read by the application.
+- database: the image goes in the Photo.image BYTEA column as base64 text,
+  the way photos were stored before there were backends.
+
+Photos are read with the backend named in their storage column, so changing
+the photo_storage option only affects new photos.
+"""
+from abc import ABCMeta, abstractmethod
+from base64 import b64decode, b64encode
+import hashlib
+import os
+import tempfile
+
+
+class PhotoStorage(metaclass=ABCMeta):
+
+    """A storage backend for the images of Photos."""
+
+    # The chunk size for reading images
+    chunk_size = 64 * 1024
+
+    @property  # pragma: no cover
+    @abstractmethod
+    def name(self):
+        """The name of the backend, which goes in Photo.storage."""
+
+    def store(self, photo, image: bytes) -> None:
+        """Store the image of a new Photo and fill in its metadata.
+
+        :param photo: the Photo
+        :param image: the raw (not base64 encoded) image
+        """
+        photo.content_hash = hashlib.sha256(image).hexdigest()
+        photo.size = len(image)
+        photo.storage = self.name
+        self._save(photo, image)
+
+    @abstractmethod
+    def _save(self, photo, image: bytes) -> None:
+        """Write the image, after store has filled in the metadata."""
+
+    @abstractmethod
+    def chunks(self, photo):
+        """Generate the raw image of a Photo as chunks of bytes."""
+
+    def accel_redirect(self, photo) -> str:
+        """The X-Accel-Redirect location of the image, or None."""
+        return None
+
+
+class DatabasePhotoStorage(PhotoStorage):
+
+    """Keep images in the Photo.image column as base64 text."""
+
+    name = 'database'
+
+    def _save(self, photo, image):
+        photo.image = b64encode(image)
+
+    def chunks(self, photo):
+        """Generate the image decoded from Photo.image, in one chunk."""
+        yield b64decode(photo.image)
+
+
+class FilesystemPhotoStorage(PhotoStorage):
+
+    """Keep images in a content-addressed directory."""
+
+    name = 'filesystem'
+
+    def __init__(self, directory: str, accel_redirect_prefix: str=None):
+        """Use the given directory, which is created if necessary.
+
+        :param directory: the root of the photo files
+        :param accel_redirect_prefix: the nginx internal location that serves
+                                      the directory, if there is one
+        """
+        self.directory = directory
+        self.accel_redirect_prefix = accel_redirect_prefix
+
+    def _relative_path(self, content_hash) -> str:
+        return os.path.join(content_hash[:2], content_hash[2:4], content_hash)
+
+    def path(self, photo) -> str:
+        """The path of the file holding the Photo's image."""
+        return os.path.join(
+            self.directory, self._relative_path(photo.content_hash)
+        )
+
+    def _save(self, photo, image):
+        path = self.path(photo)
+        if os.path.exists(path):
+            # Same content, same file
+            return
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file and rename it so that a reader never sees
+        # a partial image.
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(file_descriptor, 'wb') as photo_file:
+                photo_file.write(image)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+
+    def chunks(self, photo):
+        """Generate the image from its file chunk_size bytes at a time."""
+        with open(self.path(photo), 'rb') as photo_file:
+            while True:
+                chunk = photo_file.read(self.chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    def accel_redirect(self, photo):
+        """The location under accel_redirect_prefix, if that is set."""
+        if self.accel_redirect_prefix is None:
+            return None
+        return '{}/{}'.format(
+            self.accel_redirect_prefix.rstrip('/'),
+            self._relative_path(photo.content_hash).replace(os.sep, '/'),
+        )
+
+
+def photo_storages(directory: str, accel_redirect_prefix: str=None) -> dict:
+    """All of the storage backends, by name.
+
+    :param directory: the directory for the filesystem backend
+    :param accel_redirect_prefix: the nginx internal location that serves
+                                  the directory, if there is one
+    """
+    return {
+        DatabasePhotoStorage.name: DatabasePhotoStorage(),
+        FilesystemPhotoStorage.name: FilesystemPhotoStorage(
+            directory, accel_redirect_prefix
+        ),
+    }
@@ -2,12 +2,15 @@
 from base64 import b64encode
 from collections import OrderedDict
 from contextlib import closing
-from csv import DictReader
+from csv import DictReader, reader
 from datetime import datetime, date, timedelta
 from io import StringIO
+import hashlib
 import json
 import os
+import unittest
 import uuid
+from unittest.mock import patch
 
 import dateutil.parser
 
@@ -22,11 +25,14 @@ from tests.python.util import (
     DokoFixtureTest, DokoHTTPTest, setUpModule, tearDownModule
 )
 
+from dokomoforms.cache import LRUCache
 from dokomoforms.models import Submission, Survey, Node, Administrator, User
 import dokomoforms.models as models
+from dokomoforms.models import async_db
 from dokomoforms.models.answer import PhotoAnswer
 from dokomoforms.handlers.api.v0.base import BaseResource
 from dokomoforms.handlers.api.v0.nodes import NodeResource
+from dokomoforms.handlers.api.v0.submissions import SubmissionResource
 
 utils = (setUpModule, tearDownModule)
 
@@ -169,6 +175,46 @@ class TestAuthentication(DokoHTTPTest):
 
         self.assertTrue(BaseResource.is_authenticated(fake_resource))
 
+    def test_is_authenticated_api_token_cached(self):
+        user = (
+            self.session
+            .query(Administrator)
+            .get('b7becd02-1a3f-4c1d-a0e1-286ba121aef4')
+        )
+        with self.session.begin():
+            user.token = bcrypt_sha256.encrypt('a').encode()
+            user.token_expiration = datetime.now() + timedelta(days=1)
+            self.session.add(user)
+
+        fake_resource = lambda: None
+        fake_r_handler = lambda: None
+        fake_r_handler.current_user = None
+        fake_request = lambda: None
+        fake_request.headers = {
+            'Token': 'a',
+            'Email': 'test_creator@fixtures.com',
+        }
+        fake_r_handler.request = fake_request
+        fake_resource.r_handler = fake_r_handler
+        fake_resource.session = self.session
+        fake_application = lambda: None
+        fake_application.token_cache = LRUCache(2)
+        fake_resource.application = fake_application
+
+        self.assertTrue(BaseResource.is_authenticated(fake_resource))
+        self.assertEqual(len(fake_application.token_cache), 1)
+
+        # The second request doesn't need bcrypt
+        with patch.object(bcrypt_sha256, 'verify') as verify:
+            self.assertTrue(BaseResource.is_authenticated(fake_resource))
+            self.assertFalse(verify.called)
+
+        # A new token makes the old one fail right away
+        with self.session.begin():
+            user.token = bcrypt_sha256.encrypt('b').encode()
+            self.session.add(user)
+        self.assertFalse(BaseResource.is_authenticated(fake_resource))
+
     def test_is_authenticated_wrong_user(self):
         fake_resource = lambda: None
         fake_r_handler = lambda: None
@@ -464,6 +510,79 @@ class TestSurveyApi(DokoHTTPTest):
         num_subs = [s['num_submissions'] for s in surveys]
         self.assertListEqual(num_subs, list(reversed(sorted(num_subs))))
 
+    def test_list_surveys_with_cursor(self):
+        url = self.api_root + '/surveys'
+        query_params = {
+            'limit': 5,
+            'order_by': 'num_submissions:DESC',
+        }
+        seen = []
+        next_url = self.append_query_params(url, query_params)
+        while True:
+            response = self.fetch(next_url, method='GET')
+            self.assertEqual(response.code, 200, msg=response.body)
+            survey_dict = json_decode(response.body)
+            self.assertEqual(survey_dict['total_entries'], TOTAL_SURVEYS)
+            seen.extend(s['id'] for s in survey_dict['surveys'])
+            if 'next_cursor' not in survey_dict:
+                break
+            query_params['after'] = survey_dict['next_cursor']
+            next_url = self.append_query_params(url, query_params)
+
+        self.assertEqual(len(seen), TOTAL_SURVEYS)
+        self.assertEqual(len(set(seen)), TOTAL_SURVEYS)
+
+        query_params = {'order_by': 'num_submissions:DESC'}
+        url = self.append_query_params(url, query_params)
+        response = self.fetch(url, method='GET')
+        all_surveys = json_decode(response.body)['surveys']
+        self.assertListEqual(seen, [s['id'] for s in all_surveys])
+
+    def test_list_surveys_with_cursor_filtered_entries(self):
+        url = self.api_root + '/surveys?limit=2'
+        response = self.fetch(url, method='GET')
+        cursor = json_decode(response.body)['next_cursor']
+
+        url = self.api_root + '/surveys?limit=2&after=' + cursor
+        response = self.fetch(url, method='GET')
+        survey_dict = json_decode(response.body)
+        self.assertEqual(len(survey_dict['surveys']), 2)
+        self.assertEqual(survey_dict['filtered_entries'], TOTAL_SURVEYS)
+
+    def test_list_surveys_with_cursor_for_different_order(self):
+        url = self.api_root + '/surveys?limit=2'
+        response = self.fetch(url, method='GET')
+        cursor = json_decode(response.body)['next_cursor']
+
+        url = (
+            self.api_root + '/surveys?limit=2&order_by=title:ASC&after=' +
+            cursor
+        )
+        response = self.fetch(url, method='GET')
+        self.assertEqual(response.code, 400, msg=response.body)
+        self.assertIn('cursor', json_decode(response.body)['error'])
+
+    def test_list_surveys_with_bogus_cursor(self):
+        url = self.api_root + '/surveys?after=bogus'
+        response = self.fetch(url, method='GET')
+        self.assertEqual(response.code, 400, msg=response.body)
+        self.assertIn('cursor', json_decode(response.body)['error'])
+
+    def test_list_surveys_no_cursor_on_last_page(self):
+        url = self.api_root + '/surveys?limit={}'.format(TOTAL_SURVEYS + 1)
+        response = self.fetch(url, method='GET')
+        survey_dict = json_decode(response.body)
+        self.assertEqual(len(survey_dict['surveys']), TOTAL_SURVEYS)
+        self.assertNotIn('next_cursor', survey_dict)
+
+    def test_list_surveys_without_counts(self):
+        url = self.api_root + '/surveys?count=false'
+        response = self.fetch(url, method='GET')
+        survey_dict = json_decode(response.body)
+        self.assertEqual(len(survey_dict['surveys']), TOTAL_SURVEYS)
+        self.assertNotIn('total_entries', survey_dict)
+        self.assertNotIn('filtered_entries', survey_dict)
+
     def test_get_single_survey(self):
         survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
         # url to tests
@@ -491,6 +610,149 @@ class TestSurveyApi(DokoHTTPTest):
 
         self.assertFalse("error" in survey_dict)
 
+    def test_get_single_survey_cached(self):
+        survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
+        url = self.api_root + '/surveys/' + survey_id
+        first = self.fetch(url, method='GET')
+        self.assertEqual(first.code, 200)
+        self.assertEqual(self.app.survey_cache.stats()['misses'], 1)
+
+        second = self.fetch(url, method='GET')
+        self.assertEqual(second.code, 200)
+        self.assertEqual(self.app.survey_cache.stats()['hits'], 1)
+        self.assertEqual(second.body, first.body)
+        self.assertLess(
+            int(second.headers['X-Query-Count']),
+            int(first.headers['X-Query-Count'])
+        )
+
+    def test_get_single_survey_not_modified(self):
+        survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
+        url = self.api_root + '/surveys/' + survey_id
+        response = self.fetch(url, method='GET')
+        etag = response.headers['Etag']
+
+        not_modified = self.fetch(
+            url, method='GET', headers={'If-None-Match': etag}
+        )
+        self.assertEqual(not_modified.code, 304, msg=not_modified.body)
+        self.assertEqual(not_modified.body, b'')
+        # The survey wasn't looked up in the cache
+        self.assertEqual(self.app.survey_cache.stats()['hits'], 0)
+        self.assertLessEqual(int(not_modified.headers['X-Query-Count']), 2)
+
+        with self.session.begin():
+            survey = self.session.query(Survey).get(survey_id)
+            survey.version = 2
+        modified = self.fetch(
+            url, method='GET', headers={'If-None-Match': etag}
+        )
+        self.assertEqual(modified.code, 200)
+        self.assertNotEqual(modified.headers['Etag'], etag)
+
+    def test_get_single_survey_node_updated(self):
+        survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
+        url = self.api_root + '/surveys/' + survey_id
+        response = self.fetch(url, method='GET')
+        etag = response.headers['Etag']
+
+        node_id = (
+            self.session
+            .query(models.SurveyNode.node_id)
+            .filter_by(root_survey_id=survey_id)
+            .first()
+            .node_id
+        )
+        node_url = self.api_root + '/nodes/' + node_id
+        updated = self.fetch(
+            node_url, method='PUT',
+            body=json_encode({'title': {'English': 'new title'}})
+        )
+        self.assertEqual(updated.code, 202, msg=updated.body)
+
+        # The survey row didn't change, but its JSON did
+        modified = self.fetch(
+            url, method='GET', headers={'If-None-Match': etag}
+        )
+        self.assertEqual(modified.code, 200)
+        self.assertNotEqual(modified.headers['Etag'], etag)
+        self.assertIn('new title', modified.body.decode())
+
+    def test_update_survey_invalidates_cache(self):
+        survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
+        url = self.api_root + '/surveys/' + survey_id
+        self.fetch(url, method='GET')
+        self.assertEqual(len(self.app.survey_cache), 1)
+
+        response = self.fetch(
+            url, method='PUT', body=json_encode({'deleted': True})
+        )
+        self.assertEqual(response.code, 202)
+        self.assertEqual(len(self.app.survey_cache), 0)
+
+        survey_dict = json_decode(self.fetch(url, method='GET').body)
+        self.assertTrue(survey_dict['deleted'])
+
+    def test_delete_survey_invalidates_principals(self):
+        survey_id = 'c0816b52-204f-41d4-aaf0-ac6ae2970925'
+        enumerator_id = 'a7becd02-1a3f-4c1d-a0e1-286ba121aef3'
+        url = self.api_root + '/surveys/' + survey_id
+        response = self.fetch(url, _logged_in_user=enumerator_id)
+        self.assertEqual(response.code, 200, msg=response.body)
+        self.assertIsNotNone(self.app.principal_cache.get(enumerator_id))
+
+        response = self.fetch(url, method='DELETE')
+        self.assertEqual(response.code, 204, msg=response.body)
+        self.assertIsNone(self.app.principal_cache.get(enumerator_id))
+
+    def _last_update_times(self, *survey_ids):
+        return [
+            self.session.query(Survey.last_update_time)
+            .filter_by(id=survey_id).scalar()
+            for survey_id in survey_ids
+        ]
+
+    def test_update_node_touches_containing_surveys(self):
+        survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
+        other_survey_id = 'd0816b52-204f-41d4-aaf0-ac6ae2970923'
+        before = self._last_update_times(survey_id, other_survey_id)
+
+        node_id = (
+            self.session
+            .query(models.SurveyNode.node_id)
+            .filter_by(root_survey_id=survey_id)
+            .first()
+            .node_id
+        )
+        response = self.fetch(
+            self.api_root + '/nodes/' + node_id, method='PUT',
+            body=json_encode({'title': {'English': 'new title'}})
+        )
+        self.assertEqual(response.code, 202, msg=response.body)
+        after = self._last_update_times(survey_id, other_survey_id)
+        self.assertNotEqual(after[0], before[0])
+        self.assertEqual(after[1], before[1])
+
+    def test_update_creator_touches_surveys(self):
+        survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
+        other_survey_id = 'd0816b52-204f-41d4-aaf0-ac6ae2970923'
+        url = self.api_root + '/surveys/' + survey_id
+        self.fetch(url, method='GET')
+        before = self._last_update_times(survey_id, other_survey_id)
+
+        creator_id = 'b7becd02-1a3f-4c1d-a0e1-286ba121aef4'
+        response = self.fetch(
+            self.api_root + '/users/' + creator_id, method='PUT',
+            body=json_encode({'name': 'new name'})
+        )
+        self.assertEqual(response.code, 202, msg=response.body)
+        after = self._last_update_times(survey_id, other_survey_id)
+        self.assertNotEqual(after[0], before[0])
+        self.assertEqual(after[1], before[1])
+
+        survey_dict = json_decode(self.fetch(url, method='GET').body)
+        self.assertEqual(survey_dict['creator_name'], 'new name')
+
     def test_get_single_public_survey_without_logging_in(self):
         survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
         # url to tests
@@ -1128,6 +1390,35 @@ class TestSurveyApi(DokoHTTPTest):
             submission_dict['answers'][0]['response_type'], 'answer')
         self.assertEqual(submission_dict['answers'][0]['response'], 3)
 
+    def test_submit_to_survey_reuses_snapshot(self):
+        survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
+        url = self.api_root + '/surveys/' + survey_id + '/submit'
+        body = {
+            "submitter_name": "regular",
+            "submission_type": "public_submission",
+            "answers": [
+                {
+                    "survey_node_id": "60e56824-910c-47aa-b5c0-71493277b43f",
+                    "type_constraint": "integer",
+                    "response": {
+                        "response_type": "answer",
+                        "response": 3
+                    }
+                }
+            ]
+        }
+        first = self.fetch(url, method='POST', body=json_encode(body))
+        self.assertEqual(first.code, 201, msg=first.body)
+        self.assertEqual(self.app.survey_cache.stats()['misses'], 1)
+
+        second = self.fetch(url, method='POST', body=json_encode(body))
+        self.assertEqual(second.code, 201, msg=second.body)
+        self.assertEqual(self.app.survey_cache.stats()['hits'], 1)
+        self.assertLess(
+            int(second.headers['X-Query-Count']),
+            int(first.headers['X-Query-Count'])
+        )
+
     def test_submit_to_survey_with_location_answer_response(self):
         survey_node = (
             self.session
@@ -1514,6 +1805,172 @@ class TestSurveyApi(DokoHTTPTest):
             desired_id
         )
 
+    def test_get_photo_image(self):
+        survey = (
+            self.session
+            .query(Survey)
+            .filter(Survey.title['English'].astext == 'photo_survey')
+            .one()
+        )
+        desired_id = str(uuid.uuid4())
+        body = {
+            "submitter_name": "regular",
+            "submission_type": "public_submission",
+            "answers": [
+                {
+                    "survey_node_id": survey.nodes[0].id,
+                    "type_constraint": "photo",
+                    "response": {
+                        "response_type": "answer",
+                        "response": desired_id,
+                    }
+                }
+            ]
+        }
+        submit_url = self.api_root + '/surveys/' + survey.id + '/submit'
+        response = self.fetch(
+            submit_url, method='POST', body=json_encode(body)
+        )
+        self.assertEqual(response.code, 201, msg=response.body)
+
+        photo_path = os.path.join(
+            os.path.abspath('.'),
+            'dokomoforms/static/src/common/img/favicon.png'
+        )
+        with open(photo_path, 'rb') as photo_file:
+            photo_bytes = photo_file.read()
+        body = {
+            'id': desired_id,
+            'mime_type': 'image/png',
+            'image': b64encode(photo_bytes).decode(),
+        }
+        photo_response = self.fetch(
+            self.api_root + '/photos', method='POST', body=json_encode(body),
+            _logged_in_user=None
+        )
+        self.assertEqual(photo_response.code, 201, msg=photo_response.body)
+
+        photo = self.session.query(models.Photo).one()
+        self.assertEqual(photo.storage, 'filesystem')
+        self.assertIsNone(photo.image)
+        self.assertEqual(photo.size, len(photo_bytes))
+        self.assertEqual(
+            photo.content_hash, hashlib.sha256(photo_bytes).hexdigest()
+        )
+
+        image_url = self.api_root + '/photos/' + desired_id + '/image'
+        response = self.fetch(image_url)
+        self.assertEqual(response.code, 200, msg=response.body)
+        self.assertEqual(response.headers['Content-Type'], 'image/png')
+        self.assertEqual(response.body, photo_bytes)
+
+        self.assertIn('immutable', response.headers['Cache-Control'])
+
+        response = self.fetch(
+            image_url, headers={'If-None-Match': response.headers['Etag']}
+        )
+        self.assertEqual(response.code, 304, msg=response.body)
+
+        response = self.fetch(image_url, _logged_in_user=None)
+        self.assertEqual(response.code, 401, msg=response.body)
+
+    def test_upload_photo_binary(self):
+        survey = (
+            self.session
+            .query(Survey)
+            .filter(Survey.title['English'].astext == 'photo_survey')
+            .one()
+        )
+        raw_id, multipart_id = str(uuid.uuid4()), str(uuid.uuid4())
+        submit_url = self.api_root + '/surveys/' + survey.id + '/submit'
+        for photo_id in (raw_id, multipart_id):
+            body = {
+                "submitter_name": "regular",
+                "submission_type": "public_submission",
+                "answers": [
+                    {
+                        "survey_node_id": survey.nodes[0].id,
+                        "type_constraint": "photo",
+                        "response": {
+                            "response_type": "answer",
+                            "response": photo_id,
+                        }
+                    }
+                ]
+            }
+            response = self.fetch(
+                submit_url, method='POST', body=json_encode(body)
+            )
+            self.assertEqual(response.code, 201, msg=response.body)
+
+        photo_path = os.path.join(
+            os.path.abspath('.'),
+            'dokomoforms/static/src/common/img/favicon.png'
+        )
+        with open(photo_path, 'rb') as photo_file:
+            photo_bytes = photo_file.read()
+
+        # The image as the request body
+        raw_url = self.api_root + '/photos/' + raw_id + '/image'
+        response = self.fetch(
+            raw_url, method='POST', body=photo_bytes,
+            headers={'Content-Type': 'image/png'}, _logged_in_user=None
+        )
+        self.assertEqual(response.code, 201, msg=response.body)
+        photo_dict = json_decode(response.body)
+        self.assertEqual(photo_dict['id'], raw_id)
+        self.assertEqual(photo_dict['mime_type'], 'image/png')
+        self.assertEqual(photo_dict['size'], len(photo_bytes))
+        self.assertEqual(photo_dict['image_url'], raw_url)
+        self.assertNotIn('image', photo_dict)
+
+        # The image in a multipart/form-data request
+        boundary = uuid.uuid4().hex
+        multipart_body = b''.join((
+            '--{}\r\n'.format(boundary).encode(),
+            b'Content-Disposition: form-data; name="image";'
+            b' filename="favicon.png"\r\n',
+            b'Content-Type: image/png\r\n\r\n',
+            photo_bytes,
+            '\r\n--{}--\r\n'.format(boundary).encode(),
+        ))
+        multipart_url = self.api_root + '/photos/' + multipart_id + '/image'
+        response = self.fetch(
+            multipart_url, method='POST', body=multipart_body,
+            headers={
+                'Content-Type':
+                'multipart/form-data; boundary={}'.format(boundary),
+            },
+        )
+        self.assertEqual(response.code, 201, msg=response.body)
+
+        for photo_id in (raw_id, multipart_id):
+            response = self.fetch(
+                self.api_root + '/photos/' + photo_id + '/image'
+            )
+            self.assertEqual(response.code, 200, msg=response.body)
+            self.assertEqual(response.body, photo_bytes)
+
+        # JSON is metadata only
+        response = self.fetch(self.api_root + '/photos')
+        self.assertEqual(response.code, 200, msg=response.body)
+        photos = json_decode(response.body)['photos']
+        self.assertEqual(len(photos), 2)
+        for photo_dict in photos:
+            self.assertNotIn('image', photo_dict)
+            self.assertEqual(
+                photo_dict['image_url'],
+                self.api_root + '/photos/' + photo_dict['id'] + '/image'
+            )
+
+    def test_upload_photo_binary_empty(self):
+        url = self.api_root + '/photos/' + str(uuid.uuid4()) + '/image'
+        response = self.fetch(
+            url, method='POST', body=b'',
+            headers={'Content-Type': 'image/png'}, _logged_in_user=None
+        )
+        self.assertEqual(response.code, 400, msg=response.body)
+
     def test_submit_to_survey_bogus_id_photo(self):
         survey = (
             self.session
@@ -1812,6 +2269,32 @@ class TestSurveyApi(DokoHTTPTest):
         self.assertEqual(len(subs), 101)
         self.assertEqual(len([s['answers'] for s in subs if s['answers']]), 1)
 
+    def test_list_submissions_to_survey_with_cursor(self):
+        survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
+        url = self.api_root + '/surveys/' + survey_id + '/submissions'
+        query_params = {
+            'limit': 40,
+            'order_by': 'save_time:DESC',
+            'count': 'false',
+        }
+        seen = []
+        pages = 0
+        next_url = self.append_query_params(url, query_params)
+        while True:
+            response = self.fetch(next_url, method='GET')
+            self.assertEqual(response.code, 200, msg=response.body)
+            submission_list = json_decode(response.body)
+            self.assertNotIn('total_entries', submission_list)
+            pages += 1
+            seen.extend(s['id'] for s in submission_list['submissions'])
+            if 'next_cursor' not in submission_list:
+                break
+            query_params['after'] = submission_list['next_cursor']
+            next_url = self.append_query_params(url, query_params)
+
+        self.assertEqual(pages, 3)
+        self.assertEqual(len(set(seen)), 101)
+
     def test_list_submissions_to_survey_csv(self):
         survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
         # url to test
@@ -1873,33 +2356,191 @@ class TestSurveyApi(DokoHTTPTest):
         self.assertEqual(chunks[1], 'submissions')
         self.assertEqual(chunks[3], 'modified')
 
-    def test_get_stats_for_survey(self):
+    def test_list_submissions_to_survey_csv_wide(self):
         survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
-        # url to test
-        url = self.api_root + '/surveys/' + survey_id + '/stats'
-        # http method
-        method = 'GET'
-        # make request
-        response = self.fetch(url, method=method)
-
-        stats = json_decode(response.body)
+        url = '{}/surveys/{}/submissions?format=csv&layout=wide'.format(
+            self.api_root, survey_id
+        )
+        response = self.fetch(url, method='GET')
 
-        # test response
-        today = date.today()
-        self.assertTrue(
-            stats['latest_submission_time'].startswith(today.isoformat())
+        self.assertEqual(response.code, 200, msg=response.body)
+        self.assertEqual(
+            response.headers['Content-Type'], 'text/csv; charset=UTF-8'
         )
-        self.assertTrue(stats['created_on'].startswith(today.isoformat()))
-        self.assertTrue(
-            stats['earliest_submission_time'].startswith(
-                (today - timedelta(days=99)).isoformat()
-            )
+        cd = response.headers['Content-Disposition']
+        self.assertNotIn('modified', cd)
+
+        with closing(StringIO(response.body.decode())) as csv_data:
+            header, *rows = list(reader(csv_data))
+
+        survey = self.session.query(Survey).get(survey_id)
+        self.assertEqual(
+            header,
+            [
+                'submission_id', 'save_time', 'submission_time',
+                'submitter_name', 'submitter_email',
+                survey.nodes[0].node.title['English'],
+            ]
         )
-        self.assertEqual(stats['num_submissions'], 101)
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0][0], survey.submissions[0].id)
+        self.assertEqual(rows[0][5], '3')
 
-    def test_get_stats_for_survey_not_logged_in(self):
-        survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
-        # url to test
+    def test_list_submissions_to_survey_csv_wide_indexed_columns(self):
+        user = (
+            self.session
+            .query(Administrator)
+            .get('b7becd02-1a3f-4c1d-a0e1-286ba121aef4')
+        )
+        with self.session.begin():
+            survey = models.construct_survey(
+                survey_type='public',
+                title={'English': 'wide export'},
+                nodes=[
+                    models.construct_survey_node(
+                        node=models.construct_node(
+                            type_constraint='integer',
+                            title={'English': 'how many?'},
+                        ),
+                        sub_surveys=[
+                            models.SubSurvey(
+                                repeatable=True,
+                                buckets=[
+                                    models.construct_bucket(
+                                        bucket_type='integer',
+                                        bucket='[,]',
+                                    ),
+                                ],
+                                nodes=[
+                                    models.construct_survey_node(
+                                        repeatable=True,
+                                        node=models.construct_node(
+                                            type_constraint='text',
+                                            title={'English': 'name?'},
+                                        ),
+                                    ),
+                                ],
+                            ),
+                        ],
+                    ),
+                    models.construct_survey_node(
+                        node=models.construct_node(
+                            type_constraint='multiple_choice',
+                            title={'English': 'colour?'},
+                            allow_multiple=True,
+                            choices=[
+                                models.Choice(choice_text={'English': 'red'}),
+                                models.Choice(
+                                    choice_text={'English': 'blue'}
+                                ),
+                            ],
+                        ),
+                    ),
+                ],
+            )
+            user.surveys.append(survey)
+            self.session.add(user)
+        how_many = survey.nodes[0]
+        name = how_many.sub_surveys[0].nodes[0]
+        colour = survey.nodes[1]
+        red, blue = colour.node.choices
+        with self.session.begin():
+            self.session.add_all([
+                models.construct_submission(
+                    submission_type='public_submission',
+                    survey=survey,
+                    submitter_name='first',
+                    answers=[
+                        models.construct_answer(
+                            type_constraint='integer',
+                            survey_node=how_many,
+                            answer=2,
+                        ),
+                        models.construct_answer(
+                            type_constraint='text',
+                            survey_node=name,
+                            answer='Ann',
+                        ),
+                        models.construct_answer(
+                            type_constraint='text',
+                            survey_node=name,
+                            answer='Bob',
+                        ),
+                        models.construct_answer(
+                            type_constraint='multiple_choice',
+                            survey_node=colour,
+                            answer=blue.id,
+                        ),
+                    ],
+                ),
+                models.construct_submission(
+                    submission_type='public_submission',
+                    survey=survey,
+                    submitter_name='second',
+                    answers=[
+                        models.construct_answer(
+                            type_constraint='multiple_choice',
+                            survey_node=colour,
+                            answer=red.id,
+                        ),
+                        models.construct_answer(
+                            type_constraint='multiple_choice',
+                            survey_node=colour,
+                            answer=blue.id,
+                        ),
+                    ],
+                ),
+            ])
+
+        url = '{}/surveys/{}/submissions?format=csv&layout=wide'.format(
+            self.api_root, survey.id
+        )
+        with patch.object(SubmissionResource, 'csv_chunk_size', 1):
+            response = self.fetch(url + '&order_by=submitter_name:ASC')
+
+        self.assertEqual(response.code, 200, msg=response.body)
+        with closing(StringIO(response.body.decode())) as csv_data:
+            header, *rows = list(reader(csv_data))
+        self.assertEqual(
+            header[5:],
+            [
+                'how many?', 'name? [1]', 'name? [2]',
+                'colour? [1]', 'colour? [2]',
+            ]
+        )
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0][3], 'first')
+        self.assertEqual(rows[0][5:], ['2', 'Ann', 'Bob', 'blue', ''])
+        self.assertEqual(rows[1][3], 'second')
+        self.assertEqual(rows[1][5:], ['', '', '', 'red', 'blue'])
+
+    def test_get_stats_for_survey(self):
+        survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
+        # url to test
+        url = self.api_root + '/surveys/' + survey_id + '/stats'
+        # http method
+        method = 'GET'
+        # make request
+        response = self.fetch(url, method=method)
+
+        stats = json_decode(response.body)
+
+        # test response
+        today = date.today()
+        self.assertTrue(
+            stats['latest_submission_time'].startswith(today.isoformat())
+        )
+        self.assertTrue(stats['created_on'].startswith(today.isoformat()))
+        self.assertTrue(
+            stats['earliest_submission_time'].startswith(
+                (today - timedelta(days=99)).isoformat()
+            )
+        )
+        self.assertEqual(stats['num_submissions'], 101)
+
+    def test_get_stats_for_survey_not_logged_in(self):
+        survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
+        # url to test
         url = self.api_root + '/surveys/' + survey_id + '/stats'
         # http method
         method = 'GET'
@@ -2008,6 +2649,189 @@ class TestSurveyApi(DokoHTTPTest):
         self.assertTrue('activity' in activity)
         self.assertEqual(len(activity['activity']), 10)
 
+    def _add_location_answers(self, *locations):
+        location_survey = (
+            self.session
+            .query(Survey)
+            .filter(Survey.title['English'].astext == 'location_survey')
+            .one()
+        )
+        survey_node = location_survey.nodes[0]
+        with self.session.begin():
+            self.session.add_all(
+                models.construct_submission(
+                    submission_type='public_submission',
+                    survey=location_survey,
+                    answers=[
+                        models.construct_answer(
+                            type_constraint='location',
+                            answer={'lng': lng, 'lat': lat},
+                            survey_node=survey_node,
+                        ),
+                    ],
+                ) for lng, lat in locations
+            )
+        return (
+            self.api_root + '/surveys/' + location_survey.id + '/nodes/' +
+            survey_node.id + '/map'
+        )
+
+    def test_map_data_clusters(self):
+        url = self._add_location_answers(
+            (10, 10), (10.001, 10.001), (-50, -20)
+        )
+        response = self.fetch(url, method='GET')
+        self.assertEqual(response.code, 200, msg=response.body)
+        map_data = json_decode(response.body)
+        self.assertEqual(map_data['zoom'], 0)
+        self.assertEqual(map_data['points'], [])
+        clusters = sorted(
+            map_data['clusters'], key=lambda cluster: cluster['count']
+        )
+        self.assertEqual(
+            [cluster['count'] for cluster in clusters], [1, 2]
+        )
+        self.assertAlmostEqual(clusters[0]['lng'], -50)
+        self.assertAlmostEqual(clusters[0]['lat'], -20)
+        self.assertAlmostEqual(clusters[1]['lng'], 10.0005)
+        self.assertAlmostEqual(clusters[1]['lat'], 10.0005)
+
+    def test_map_data_points_in_bbox(self):
+        url = self._add_location_answers(
+            (10, 10), (10.001, 10.001), (-50, -20)
+        )
+        url = self.append_query_params(url, {'bbox': '9,9,11,11', 'zoom': 16})
+        response = self.fetch(url, method='GET')
+        self.assertEqual(response.code, 200, msg=response.body)
+        map_data = json_decode(response.body)
+        self.assertEqual(map_data['clusters'], [])
+        self.assertEqual(
+            sorted(
+                (point['lng'], point['lat']) for point in map_data['points']
+            ),
+            [(10, 10), (10.001, 10.001)]
+        )
+        self.assertTrue(all(
+            point['facility_name'] is None for point in map_data['points']
+        ))
+
+    def test_map_data_bad_bbox(self):
+        url = self._add_location_answers()
+        url = self.append_query_params(url, {'bbox': '9,9'})
+        response = self.fetch(url, method='GET')
+        self.assertEqual(response.code, 400, msg=response.body)
+
+    def test_map_data_not_logged_in(self):
+        url = self._add_location_answers()
+        response = self.fetch(url, method='GET', _logged_in_user=None)
+        self.assertEqual(response.code, 401)
+
+    def test_map_data_geojson(self):
+        url = self._add_location_answers(
+            (10, 10), (10.001, 10.001), (-50, -20)
+        )
+        url = self.append_query_params(
+            url, {'format': 'geojson', 'bbox': '9,9,11,11'}
+        )
+        response = self.fetch(url, method='GET')
+        self.assertEqual(response.code, 200, msg=response.body)
+        self.assertEqual(
+            response.headers['Content-Type'],
+            'application/geo+json; charset=UTF-8'
+        )
+        self.assertIn('.geojson', response.headers['Content-Disposition'])
+        collection = json_decode(response.body)
+        self.assertEqual(collection['type'], 'FeatureCollection')
+        features = collection['features']
+        self.assertEqual(
+            sorted(
+                feature['geometry']['coordinates'] for feature in features
+            ),
+            [[10, 10], [10.001, 10.001]]
+        )
+        submission_ids = {
+            feature['properties']['submission_id'] for feature in features
+        }
+        self.assertEqual(
+            (
+                self.session
+                .query(sa.func.count(Submission.id))
+                .filter(Submission.id.in_(submission_ids))
+                .scalar()
+            ),
+            2
+        )
+
+    def test_list_submissions_geojson(self):
+        facility_survey = (
+            self.session
+            .query(Survey)
+            .filter(Survey.title['English'].astext == 'facility_survey')
+            .one()
+        )
+        with self.session.begin():
+            self.session.add(models.construct_submission(
+                submission_type='public_submission',
+                survey=facility_survey,
+                answers=[
+                    models.construct_answer(
+                        type_constraint='facility',
+                        answer={
+                            'lng': 0,
+                            'lat': 1,
+                            'facility_id': '1',
+                            'facility_name': 'a',
+                            'facility_sector': 'health',
+                        },
+                        survey_node=facility_survey.nodes[0],
+                    ),
+                ],
+            ))
+        url = (
+            self.api_root + '/surveys/' + facility_survey.id + '/submissions'
+        )
+        today = date.today().isoformat()
+        response = self.fetch(
+            self.append_query_params(
+                url, {'format': 'geojson', 'since': today, 'until': today}
+            ),
+            method='GET'
+        )
+        self.assertEqual(response.code, 200, msg=response.body)
+        features = json_decode(response.body)['features']
+        self.assertEqual(len(features), 1)
+        feature = features[0]
+        self.assertEqual(feature['type'], 'Feature')
+        self.assertEqual(
+            feature['geometry'], {'type': 'Point', 'coordinates': [0, 1]}
+        )
+        self.assertEqual(feature['properties']['facility_name'], 'a')
+        self.assertEqual(
+            feature['properties']['survey_node_id'],
+            facility_survey.nodes[0].id
+        )
+
+        tomorrow = (date.today() + timedelta(days=1)).isoformat()
+        response = self.fetch(
+            self.append_query_params(
+                url, {'format': 'geojson', 'since': tomorrow}
+            ),
+            method='GET'
+        )
+        self.assertEqual(
+            json_decode(response.body),
+            {'type': 'FeatureCollection', 'features': []}
+        )
+
+    def test_list_submissions_geojson_bad_date(self):
+        survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
+        url = self.api_root + '/surveys/' + survey_id + '/submissions'
+        url = self.append_query_params(
+            url, {'format': 'geojson', 'since': 'yesterday'}
+        )
+        response = self.fetch(url, method='GET')
+        self.assertEqual(response.code, 400, msg=response.body)
+
     # TODO: We probably eventually want surveys not to be totally public.
     # def test_survey_access_denied_for_unauthorized_user(self):
     #    # this survey is owned by a different creator
@@ -2194,6 +3018,95 @@ class TestSurveyApi(DokoHTTPTest):
             ))
         )
 
+    def test_list_surveys_with_projected_fields(self):
+        url = self.api_root + '/surveys'
+        response = self.fetch(url, method='GET')
+        full_surveys = json_decode(response.body)['surveys']
+
+        query_params = {'fields': 'id,title,num_submissions,metadata'}
+        url = self.append_query_params(url, query_params)
+        response = self.fetch(url, method='GET')
+        survey_dict = json.loads(
+            response.body.decode(), object_pairs_hook=OrderedDict
+        )
+        self.assertEqual(survey_dict['total_entries'], TOTAL_SURVEYS)
+        self.assertEqual(survey_dict['filtered_entries'], TOTAL_SURVEYS)
+        surveys = survey_dict['surveys']
+        self.assertListEqual(
+            [list(survey) for survey in surveys],
+            [['id', 'title', 'num_submissions', 'metadata']] * TOTAL_SURVEYS
+        )
+        self.assertListEqual(
+            [
+                (s['id'], s['title'], s['metadata'])
+                for s in surveys
+            ],
+            [
+                (s['id'], s['title'], s['metadata'])
+                for s in full_surveys
+            ]
+        )
+        num_submissions = {
+            s.id: s.num_submissions for s in self.session.query(Survey)
+        }
+        for survey in surveys:
+            self.assertEqual(
+                survey['num_submissions'], num_submissions[survey['id']]
+            )
+
+    def test_list_surveys_with_projected_fields_and_cursor(self):
+        url = self.api_root + '/surveys'
+        query_params = {
+            'fields': 'id',
+            'limit': 4,
+            'order_by': 'num_submissions:DESC',
+        }
+        seen = []
+        next_url = self.append_query_params(url, query_params)
+        while True:
+            response = self.fetch(next_url, method='GET')
+            self.assertEqual(response.code, 200, msg=response.body)
+            survey_dict = json_decode(response.body)
+            for survey in survey_dict['surveys']:
+                self.assertListEqual(list(survey), ['id'])
+                seen.append(survey['id'])
+            if 'next_cursor' not in survey_dict:
+                break
+            query_params['after'] = survey_dict['next_cursor']
+            next_url = self.append_query_params(url, query_params)
+
+        url = self.append_query_params(
+            url, {'order_by': 'num_submissions:DESC'}
+        )
+        response = self.fetch(url, method='GET')
+        all_surveys = json_decode(response.body)['surveys']
+        self.assertListEqual(seen, [s['id'] for s in all_surveys])
+
+    def test_get_single_survey_with_projected_fields(self):
+        survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
+        url = self.api_root + '/surveys/' + survey_id
+        url = self.append_query_params(
+            url, {'fields': 'id,title,num_submissions'}
+        )
+        response = self.fetch(url, method='GET')
+        survey_dict = json.loads(
+            response.body.decode(), object_pairs_hook=OrderedDict
+        )
+        self.assertEqual(
+            survey_dict,
+            OrderedDict((
+                ('id', survey_id),
+                ('title', OrderedDict((('English', 'single_survey'),))),
+                ('num_submissions', 101),
+            ))
+        )
+
+    def test_get_single_survey_with_projected_fields_not_found(self):
+        url = self.api_root + '/surveys/' + str(uuid.uuid4())
+        url = self.append_query_params(url, {'fields': 'id'})
+        response = self.fetch(url, method='GET')
+        self.assertEqual(response.code, 404, msg=response.body)
+
 
 class TestSubmissionApi(DokoHTTPTest):
     def test_list_submissions(self):
@@ -2215,6 +3128,35 @@ class TestSubmissionApi(DokoHTTPTest):
 
         self.assertFalse("error" in submission_dict)
 
+    def test_list_submissions_with_projected_fields(self):
+        url = self.api_root + '/submissions'
+        query_params = {
+            'fields': 'id,survey_id,save_time,survey_title',
+            'order_by': 'save_time:ASC',
+        }
+        url = self.append_query_params(url, query_params)
+        response = self.fetch(url, method='GET')
+        self.assertEqual(response.code, 200, msg=response.body)
+        submission_dict = json_decode(response.body)
+        self.assertEqual(submission_dict['total_entries'], TOTAL_SUBMISSIONS)
+        submissions = submission_dict['submissions']
+        self.assertEqual(len(submissions), TOTAL_SUBMISSIONS)
+        expected = (
+            self.session
+            .query(Submission)
+            .order_by(Submission.save_time, Submission.id)
+        )
+        for projected, submission in zip(submissions, expected):
+            self.assertEqual(projected['id'], submission.id)
+            self.assertEqual(projected['survey_id'], submission.survey_id)
+            self.assertEqual(
+                dateutil.parser.parse(projected['save_time']),
+                submission.save_time
+            )
+            self.assertEqual(
+                projected['survey_title'], submission.survey_title
+            )
+
     def test_list_submissions_csv(self):
         decimal_survey = (
             self.session
@@ -2280,6 +3222,61 @@ class TestSubmissionApi(DokoHTTPTest):
         self.assertEqual(data[2]['main_answer'], '4.4')
         self.assertEqual(data[2]['response'], '4.4')
 
+    def test_list_submissions_csv_streamed_in_chunks(self):
+        url = self.api_root + '/submissions?format=csv'
+        response = self.fetch(url, method='GET')
+        self.assertEqual(response.code, 200, msg=response.body)
+
+        with patch.object(SubmissionResource, 'csv_chunk_size', 3):
+            chunked_response = self.fetch(url, method='GET')
+
+        self.assertEqual(chunked_response.code, 200)
+        self.assertEqual(
+            chunked_response.headers['Content-Type'],
+            'text/csv; charset=UTF-8'
+        )
+        self.assertEqual(chunked_response.body, response.body)
+        body = chunked_response.body.decode()
+        self.assertEqual(body.count('id,deleted,answer_number'), 1)
+        with closing(StringIO(body)) as csv_data:
+            data = list(DictReader(csv_data))
+        num_answers = (
+            self.session
+            .query(sa.func.count(models.Answer.id))
+            .join(Submission, models.Answer.submission_id == Submission.id)
+            .filter(~Submission.deleted)
+            .scalar()
+        )
+        self.assertEqual(len(data), num_answers)
+
+    def test_list_submissions_csv_with_limit_and_cursor(self):
+        url = self.api_root + '/submissions?limit=5'
+        cursor = json_decode(self.fetch(url).body)['next_cursor']
+        expected = [
+            submission['id'] for submission in json_decode(
+                self.fetch(url + '&after=' + cursor).body
+            )['submissions']
+        ]
+
+        with patch.object(SubmissionResource, 'csv_chunk_size', 2):
+            response = self.fetch(url + '&format=csv&after=' + cursor)
+
+        self.assertEqual(response.code, 200, msg=response.body)
+        with closing(StringIO(response.body.decode())) as csv_data:
+            submission_ids = [
+                row['submission_id'] for row in DictReader(csv_data)
+            ]
+        self.assertEqual(
+            sorted(set(submission_ids), key=submission_ids.index),
+            [sub_id for sub_id in expected if sub_id in submission_ids],
+        )
+        self.assertLessEqual(set(submission_ids), set(expected))
+
+    def test_list_submissions_csv_with_bogus_cursor(self):
+        url = self.api_root + '/submissions?format=csv&after=bogus'
+        response = self.fetch(url, method='GET')
+        self.assertEqual(response.code, 400, msg=response.body)
+
     def test_list_submissions_search_submitter_name(self):
         search_term = 'singular'
         # url to test
@@ -3271,56 +4268,198 @@ class TestSubmissionApi(DokoHTTPTest):
         response = self.fetch(url, method=method, body=json_encode(body))
         self.assertEqual(response.code, 400)
 
-        submission_dict = json_decode(response.body)
-        self.assertIn('survey_node not found', submission_dict['error'])
+        submission_dict = json_decode(response.body)
+        self.assertIn('survey_node not found', submission_dict['error'])
+
+    def test_create_public_submission_with_integer_answer(self):
+        # url to test
+        url = self.api_root + '/submissions'
+        # http method
+        method = 'POST'
+        # body
+        body = {
+            "survey_id": "b0816b52-204f-41d4-aaf0-ac6ae2970923",
+            "submitter_name": "regular",
+            "submission_type": "public_submission",
+            "start_time": "2015-09-17T20:42:20",
+            "answers": [
+                {
+                    "survey_node_id": "60e56824-910c-47aa-b5c0-71493277b43f",
+                    "type_constraint": "integer",
+                    "answer": 3
+                }
+            ]
+        }
+        # make request
+        response = self.fetch(url, method=method, body=json_encode(body))
+        self.assertEqual(response.code, 201)
+
+        submission_dict = json_decode(response.body)
+
+        self.assertTrue('save_time' in submission_dict)
+        self.assertTrue('start_time' in submission_dict)
+        self.assertTrue('deleted' in submission_dict)
+        self.assertTrue('id' in submission_dict)
+        self.assertTrue('submitter_email' in submission_dict)
+        self.assertTrue('answers' in submission_dict)
+        self.assertTrue('submitter_name' in submission_dict)
+        self.assertTrue('last_update_time' in submission_dict)
+        self.assertTrue('submission_time' in submission_dict)
+        self.assertTrue('survey_id' in submission_dict)
+
+        self.assertEqual(len(submission_dict['answers']), 1)
+
+        self.assertTrue(
+            submission_dict['start_time'].startswith(
+                "2015-09-17T20:42:20"
+            ),
+            msg=submission_dict['start_time']
+        )
+        self.assertEqual(
+            submission_dict['answers'][0]['response'],
+            3
+        )
+
+    def test_create_submission_batch(self):
+        survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
+        num_submissions = (
+            self.session
+            .query(models.Submission)
+            .filter_by(survey_id=survey_id)
+            .count()
+        )
+        good = {
+            "survey_id": survey_id,
+            "submitter_name": "regular",
+            "answers": [
+                {
+                    "survey_node_id": "60e56824-910c-47aa-b5c0-71493277b43f",
+                    "type_constraint": "integer",
+                    "answer": 3
+                }
+            ]
+        }
+        bogus_survey = {
+            "survey_id": str(uuid.uuid4()),
+            "submitter_name": "regular",
+        }
+        bogus_node = {
+            "survey_id": survey_id,
+            "submitter_name": "regular",
+            "answers": [
+                {
+                    'survey_node_id': str(uuid.uuid4()),
+                    "type_constraint": "integer",
+                    "answer": 3,
+                }
+            ]
+        }
+        body = {'submissions': [good, bogus_survey, bogus_node, good]}
+        with patch.object(SubmissionResource, 'batch_chunk_size', 2):
+            response = self.fetch(
+                self.api_root + '/submissions/batch',
+                method='POST', body=json_encode(body)
+            )
+        self.assertEqual(response.code, 200, msg=response.body)
+
+        results = json_decode(response.body)['results']
+        self.assertEqual(
+            [result['status'] for result in results], [201, 404, 400, 201]
+        )
+        self.assertIn('survey_node not found', results[2]['error'])
+        self.assertEqual(results[0]['survey_id'], survey_id)
+        self.assertNotEqual(results[0]['id'], results[3]['id'])
+        self.assertEqual(
+            (
+                self.session
+                .query(models.Submission)
+                .filter_by(survey_id=survey_id)
+                .count()
+            ),
+            num_submissions + 2
+        )
+        answer = (
+            self.session
+            .query(models.Answer)
+            .filter_by(submission_id=results[3]['id'])
+            .one()
+        )
+        self.assertEqual(answer.response['response'], 3)
+
+    def test_create_submission_batch_malformed(self):
+        survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
+        body = {'submissions': [
+            'not a submission',
+            {"submitter_name": "regular"},
+            {"survey_id": survey_id, "answers": {}},
+            {"survey_id": survey_id, "answers": [3]},
+            {"survey_id": survey_id, "no_such_field": 3},
+            {"survey_id": survey_id, "submitter_name": "regular"},
+        ]}
+        response = self.fetch(
+            self.api_root + '/submissions/batch',
+            method='POST', body=json_encode(body)
+        )
+        self.assertEqual(response.code, 200, msg=response.body)
+        results = json_decode(response.body)['results']
+        self.assertEqual(
+            [result['status'] for result in results],
+            [400, 400, 400, 400, 400, 201]
+        )
+
+    def test_create_submission_batch_survey_failure_memoized(self):
+        bogus_survey = {
+            "survey_id": str(uuid.uuid4()),
+            "submitter_name": "regular",
+        }
+        body = {'submissions': [bogus_survey, bogus_survey, bogus_survey]}
+        with patch.object(
+                SubmissionResource, '_batch_survey',
+                autospec=True, side_effect=SubmissionResource._batch_survey,
+        ) as batch_survey:
+            response = self.fetch(
+                self.api_root + '/submissions/batch',
+                method='POST', body=json_encode(body)
+            )
+        self.assertEqual(response.code, 200, msg=response.body)
+        results = json_decode(response.body)['results']
+        self.assertEqual(
+            [result['status'] for result in results], [404, 404, 404]
+        )
+        self.assertEqual(batch_survey.call_count, 1)
+
+    def test_create_submission_batch_enum_only_not_logged_in(self):
+        body = {'submissions': [{
+            "survey_id": "c0816b52-204f-41d4-aaf0-ac6ae2970925",
+            "submitter_name": "regular",
+        }]}
+        response = self.fetch(
+            self.api_root + '/submissions/batch', method='POST',
+            body=json_encode(body), _logged_in_user=None,
+        )
+        self.assertEqual(response.code, 200, msg=response.body)
+        results = json_decode(response.body)['results']
+        self.assertEqual(results[0]['status'], 401)
 
-    def test_create_public_submission_with_integer_answer(self):
-        # url to test
-        url = self.api_root + '/submissions'
-        # http method
-        method = 'POST'
-        # body
-        body = {
+    def test_create_submission_batch_no_xsrf_token(self):
+        public_item = {
             "survey_id": "b0816b52-204f-41d4-aaf0-ac6ae2970923",
             "submitter_name": "regular",
-            "submission_type": "public_submission",
-            "start_time": "2015-09-17T20:42:20",
-            "answers": [
-                {
-                    "survey_node_id": "60e56824-910c-47aa-b5c0-71493277b43f",
-                    "type_constraint": "integer",
-                    "answer": 3
-                }
-            ]
         }
-        # make request
-        response = self.fetch(url, method=method, body=json_encode(body))
-        self.assertEqual(response.code, 201)
-
-        submission_dict = json_decode(response.body)
-
-        self.assertTrue('save_time' in submission_dict)
-        self.assertTrue('start_time' in submission_dict)
-        self.assertTrue('deleted' in submission_dict)
-        self.assertTrue('id' in submission_dict)
-        self.assertTrue('submitter_email' in submission_dict)
-        self.assertTrue('answers' in submission_dict)
-        self.assertTrue('submitter_name' in submission_dict)
-        self.assertTrue('last_update_time' in submission_dict)
-        self.assertTrue('submission_time' in submission_dict)
-        self.assertTrue('survey_id' in submission_dict)
-
-        self.assertEqual(len(submission_dict['answers']), 1)
-
-        self.assertTrue(
-            submission_dict['start_time'].startswith(
-                "2015-09-17T20:42:20"
-            ),
-            msg=submission_dict['start_time']
+        enum_only_item = {
+            "survey_id": "c0816b52-204f-41d4-aaf0-ac6ae2970925",
+            "submitter_name": "regular",
+        }
+        body = {'submissions': [enum_only_item, public_item]}
+        response = self.fetch(
+            self.api_root + '/submissions/batch', method='POST',
+            body=json_encode(body), _logged_in_user=None,
+            _disable_xsrf=False,
         )
+        self.assertEqual(response.code, 200, msg=response.body)
+        results = json_decode(response.body)['results']
         self.assertEqual(
-            submission_dict['answers'][0]['response'],
-            3
+            [result['status'] for result in results], [401, 403]
         )
 
     def test_submit_to_blank_survey(self):
@@ -4766,6 +5905,121 @@ class TestSubmissionApi(DokoHTTPTest):
         self.assertEqual(response.code, 400, msg=response.body)
         self.assertIn('skipped', json_decode(response.body)['error'])
 
+    def test_repeatable_required_huge_repeat_count(self):
+        user = (
+            self.session
+            .query(Administrator)
+            .get('b7becd02-1a3f-4c1d-a0e1-286ba121aef4')
+        )
+        with self.session.begin():
+            user.surveys.append(
+                models.construct_survey(
+                    survey_type='public',
+                    title={'English': 'repeatable required'},
+                    nodes=[
+                        models.construct_survey_node(
+                            required=True,
+                            node=models.construct_node(
+                                type_constraint='integer',
+                                title={'English': 'how many?'},
+                            ),
+                            sub_surveys=[
+                                models.SubSurvey(
+                                    repeatable=True,
+                                    buckets=[
+                                        models.construct_bucket(
+                                            bucket_type='integer',
+                                            bucket='[,]',
+                                        ),
+                                    ],
+                                    nodes=[
+                                        models.construct_survey_node(
+                                            repeatable=True,
+                                            required=True,
+                                            node=models.construct_node(
+                                                allow_multiple=True,
+                                                type_constraint='integer',
+                                                title={'English': 'age?'},
+                                            ),
+                                        ),
+                                        models.construct_survey_node(
+                                            repeatable=True,
+                                            required=True,
+                                            node=models.construct_node(
+                                                allow_multiple=True,
+                                                type_constraint='text',
+                                                title={'English': 'name?'},
+                                            ),
+                                        ),
+                                    ],
+                                )
+                            ],
+                        ),
+                        models.construct_survey_node(
+                            required=True,
+                            node=models.construct_node(
+                                type_constraint='integer',
+                                title={'English': 'something else'},
+                            ),
+                        ),
+                    ],
+                )
+            )
+            self.session.add(user)
+
+        survey = (
+            self.session
+            .query(Survey)
+            .filter(
+                Survey.title['English'].astext == 'repeatable required'
+            )
+            .one()
+        )
+
+        # url to test
+        url = self.api_root + '/submissions'
+        # http method
+        method = 'POST'
+        # body
+        body = {
+            "survey_id": survey.id,
+            "submitter_name": "regular",
+            "submission_type": "public_submission",
+            "answers": [
+                {
+                    "survey_node_id": survey.nodes[0].id,
+                    "type_constraint": 'integer',
+                    "answer": 2147483647,
+                },
+                {
+                    "survey_node_id": (
+                        survey.nodes[0].sub_surveys[0].nodes[0].id
+                    ),
+                    "type_constraint": 'integer',
+                    "answer": 20,
+                },
+                {
+                    "survey_node_id": (
+                        survey.nodes[0].sub_surveys[0].nodes[1].id
+                    ),
+                    "type_constraint": 'text',
+                    "answer": 'Person',
+                },
+                {
+                    "survey_node_id": survey.nodes[1].id,
+                    "type_constraint": 'integer',
+                    "answer": 12,
+                },
+            ]
+        }
+        # make request
+        response = self.fetch(url, method=method, body=json_encode(body))
+        self.assertEqual(response.code, 400, msg=response.body)
+        self.assertIn(
+            survey.nodes[0].sub_surveys[0].nodes[0].id,
+            json_decode(response.body)['error']
+        )
+
     def test_repeatable_required_valid_with_optional_subquestion(self):
         user = (
             self.session
@@ -5305,6 +6559,58 @@ class TestNodeApi(DokoHTTPTest):
         self.assertEqual(len(nodes), 1)
         self.assertEqual(nodes[0]['title'], {'French': 'integer'})
 
+    def test_list_nodes_with_ranked_search(self):
+        with self.session.begin():
+            self.session.add_all((
+                models.construct_node(
+                    languages=['French'],
+                    title={'French': 'integer question'},
+                    hint={'French': ''},
+                    type_constraint='integer',
+                ),
+                models.construct_node(
+                    languages=['French'],
+                    title={'French': 'integr'},
+                    hint={'French': ''},
+                    type_constraint='integer',
+                ),
+                models.construct_node(
+                    languages=['French'],
+                    title={'French': 'integer'},
+                    hint={'French': ''},
+                    type_constraint='integer',
+                ),
+            ))
+
+        url = self.api_root + '/nodes'
+        query_params = {
+            'search': 'integer',
+            'search_fields': 'title',
+            'lang': 'French',
+            'rank': 'true',
+        }
+        url = self.append_query_params(url, query_params)
+        response = self.fetch(url, method='GET')
+        response_body = json_decode(response.body)
+        self.assertIn('nodes', response_body, msg=response_body)
+        self.assertEqual(
+            [node['title']['French'] for node in response_body['nodes']],
+            ['integer', 'integr', 'integer question']
+        )
+
+    def test_list_nodes_with_ranked_regex_search(self):
+        url = self.api_root + '/nodes'
+        query_params = {
+            'search': '.*',
+            'search_fields': 'title',
+            'lang': 'French',
+            'regex': 'true',
+            'rank': 'true',
+        }
+        url = self.append_query_params(url, query_params)
+        response = self.fetch(url, method='GET')
+        self.assertEqual(response.code, 400)
+
     def test_list_nodes_with_regex_no_language_specified(self):
         with self.session.begin():
             self.session.add_all((
@@ -6122,6 +7428,30 @@ class TestUserApi(DokoHTTPTest):
         )
         self.assertEqual(user.name, 'new name')
 
+    def test_update_user_invalidates_principal(self):
+        enumerator_id = 'a7becd02-1a3f-4c1d-a0e1-286ba121aef3'
+        with self.session.begin():
+            creator = Administrator(name='admin')
+            survey = models.construct_survey(
+                survey_type='enumerator_only',
+                title={'English': 'survey'},
+                creator=creator
+            )
+            self.session.add(survey)
+        survey_url = self.api_root + '/surveys/' + survey.id
+        response = self.fetch(survey_url, _logged_in_user=enumerator_id)
+        self.assertEqual(response.code, 403)
+        self.assertIsNotNone(self.app.principal_cache.get(enumerator_id))
+
+        url = self.api_root + '/users/' + enumerator_id
+        body = {'allowed_surveys': [survey.id]}
+        response = self.fetch(url, method='PUT', body=json_encode(body))
+        self.assertEqual(response.code, 202, msg=response.body)
+        self.assertIsNone(self.app.principal_cache.get(enumerator_id))
+
+        response = self.fetch(survey_url, _logged_in_user=enumerator_id)
+        self.assertEqual(response.code, 200, msg=response.body)
+
     def test_update_user_email(self):
         user_id = 'b7becd02-1a3f-4c1d-a0e1-286ba121aef4'
         url = self.api_root + '/users/' + user_id
@@ -6315,3 +7645,132 @@ class TestUserApi(DokoHTTPTest):
         )
 
         self.assertEqual(api_response.code, 401)
+
+
+@unittest.skipIf(async_db.momoko is None, 'momoko is not installed')
+class TestAsyncPool(DokoHTTPTest):
+
+    """The API with the non-blocking pool gives the same responses."""
+
+    def get_app(self):
+        """Return the application with a connected momoko pool."""
+        app = super().get_app()
+        app.db_pool = async_db.create_pool(2, ioloop=self.io_loop)
+        self.io_loop.run_sync(app.db_pool.connect)
+        self.addCleanup(app.db_pool.close)
+        return app
+
+    def assertSameWithoutPool(self, path, uses_pool=False):
+        url = self.api_root + path
+        pool = self.app.db_pool
+        with patch.object(pool, 'execute', wraps=pool.execute) as execute:
+            with_pool = self.fetch(url, method='GET')
+        self.assertEqual(with_pool.code, 200, msg=with_pool.body)
+        self.assertEqual(execute.called, uses_pool)
+        if uses_pool:
+            # The pool's queries count toward the request's queries
+            self.assertGreaterEqual(
+                int(with_pool.headers['X-Query-Count']), execute.call_count
+            )
+        self.app.db_pool = None
+        try:
+            without_pool = self.fetch(url, method='GET')
+        finally:
+            self.app.db_pool = pool
+        self.assertEqual(
+            json_decode(with_pool.body), json_decode(without_pool.body)
+        )
+
+    def test_list_fields(self):
+        self.assertSameWithoutPool(
+            '/surveys?fields=id,title&limit=5', uses_pool=True
+        )
+
+    def test_list_fields_no_count(self):
+        self.assertSameWithoutPool(
+            '/submissions?fields=id,submitter_name&count=false',
+            uses_pool=True,
+        )
+
+    def test_list(self):
+        self.assertSameWithoutPool('/surveys')
+
+    def test_detail(self):
+        self.assertSameWithoutPool(
+            '/surveys/b0816b52-204f-41d4-aaf0-ac6ae2970923',
+            uses_pool=True,
+        )
+
+    def test_detail_fields(self):
+        self.assertSameWithoutPool(
+            '/surveys/b0816b52-204f-41d4-aaf0-ac6ae2970923?fields=id,title'
+        )
+
+    def test_detail_not_modified(self):
+        url = self.api_root + '/surveys/b0816b52-204f-41d4-aaf0-ac6ae2970923'
+        etag = self.fetch(url).headers['Etag']
+        with patch.object(
+                self.app.executor, 'submit', wraps=self.app.executor.submit
+        ) as submit:
+            response = self.fetch(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 304, msg=response.body)
+        # Only the authentication check ran on the executor
+        self.assertEqual(submit.call_count, 2)
+
+    def test_detail_cached(self):
+        url = self.api_root + '/surveys/b0816b52-204f-41d4-aaf0-ac6ae2970923'
+        first = self.fetch(url)
+        with patch.object(
+                self.app.executor, 'submit', wraps=self.app.executor.submit
+        ) as submit:
+            second = self.fetch(url)
+        self.assertEqual(second.code, 200, msg=second.body)
+        self.assertEqual(second.body, first.body)
+        self.assertEqual(self.app.survey_cache.stats()['hits'], 1)
+        self.assertEqual(submit.call_count, 2)
+
+    def test_list_submissions(self):
+        self.assertSameWithoutPool(
+            '/surveys/b0816b52-204f-41d4-aaf0-ac6ae2970923/submissions'
+        )
+
+    def test_list_submissions_fields(self):
+        self.assertSameWithoutPool(
+            '/surveys/b0816b52-204f-41d4-aaf0-ac6ae2970923/submissions'
+            '?fields=id,submitter_name',
+            uses_pool=True,
+        )
+
+    def test_stats(self):
+        self.assertSameWithoutPool(
+            '/surveys/b0816b52-204f-41d4-aaf0-ac6ae2970923/stats',
+            uses_pool=True,
+        )
+
+    def test_activity(self):
+        self.assertSameWithoutPool(
+            '/surveys/b0816b52-204f-41d4-aaf0-ac6ae2970923/activity',
+            uses_pool=True,
+        )
+
+    def test_activity_all(self):
+        self.assertSameWithoutPool('/surveys/activity', uses_pool=True)
+
+    def test_fetch_all(self):
+        query = sa.select([Survey.id]).where(
+            Survey.id == 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
+        )
+        rows = self.io_loop.run_sync(
+            lambda: async_db.fetch_all(self.app.db_pool, query, self.session)
+        )
+        self.assertEqual(rows, [('b0816b52-204f-41d4-aaf0-ac6ae2970923',)])
+
+        start = models.util.statement_count(self.session)
+        count = self.io_loop.run_sync(
+            lambda: async_db.fetch_scalar(
+                self.app.db_pool, sa.select([sa.func.count(Survey.id)]),
+                self.session,
+            )
+        )
+        self.assertEqual(count, self.session.query(Survey).count())
+        self.assertEqual(models.util.statement_count(self.session), start + 1)
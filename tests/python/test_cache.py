@@ -0,0 +1,57 @@
+"""Cache tests."""
+import unittest
+
+from dokomoforms.cache import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_get_and_put(self):
+        cache = LRUCache(2)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(
+            cache.stats(), {'size': 1, 'max_size': 2, 'hits': 1, 'misses': 1}
+        )
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_version_mismatch_is_a_miss(self):
+        cache = LRUCache(2)
+        cache.put('a', 1, version=1)
+        self.assertIsNone(cache.get('a', version=2))
+        self.assertEqual(len(cache), 0)
+
+    def test_ttl(self):
+        now = [0]
+        cache = LRUCache(2, ttl=10, clock=lambda: now[0])
+        cache.put('a', 1)
+        now[0] = 5
+        self.assertEqual(cache.get('a'), 1)
+        now[0] = 10
+        self.assertIsNone(cache.get('a'))
+
+    def test_invalidate(self):
+        cache = LRUCache(3)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.put('c', 3)
+        cache.invalidate('a')
+        cache.invalidate_where(lambda key: key == 'b')
+        self.assertEqual(len(cache), 1)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_max_size_zero(self):
+        cache = LRUCache(0)
+        cache.put('a', 1)
+        self.assertIsNone(cache.get('a'))
@@ -24,6 +24,7 @@ utils = (setUpModule, tearDownModule)
 import dokomoforms.handlers as handlers
 import dokomoforms.handlers.auth
 from dokomoforms.handlers.util import BaseHandler, BaseAPIHandler
+from dokomoforms.models.util import statement_count
 import dokomoforms.models as models
 
 
@@ -57,6 +58,32 @@ class TestIndex(DokoHTTPTest):
             msg=survey_dropdown
         )
 
+    def test_menu_shows_new_survey(self):
+        # Cache the menu
+        response = self.fetch('/', method='GET')
+        self.assertEqual(response.code, 200, msg=response.body)
+
+        body = {
+            'survey_type': 'public',
+            'default_language': 'English',
+            'title': {'English': 'Menu_Survey'},
+            'nodes': [],
+        }
+        response = self.fetch(
+            self.api_root + '/surveys', method='POST', body=json_encode(body)
+        )
+        self.assertEqual(response.code, 201, msg=response.body)
+
+        response = self.fetch('/', method='GET')
+        response_soup = BeautifulSoup(response.body, 'html.parser')
+        survey_dropdown = (
+            response_soup.find('ul', {'aria-labelledby': 'SurveysDropdown'})
+        )
+        self.assertIn(
+            'Menu_Survey', survey_dropdown.findAll('li')[0].text,
+            msg=survey_dropdown
+        )
+
 
 class TestNotFound(DokoHTTPTest):
     def test_bogus_url(self):
@@ -356,6 +383,78 @@ class TestBaseHandler(DokoHTTPTest):
             self.assertEqual(handler.get_cookie('user'), cookie_object.value)
             self.assertIsNone(handler.current_user_model)
 
+    def test_current_user_model_looked_up_once(self):
+        dummy_request = lambda: None
+        dummy_request.cookies = {}
+        dummy_connection = lambda: None
+        dummy_close_callback = lambda _: None
+        dummy_connection.set_close_callback = dummy_close_callback
+        dummy_request.connection = dummy_connection
+        self.session.expunge_all()
+
+        with patch.object(BaseHandler, '_current_user_cookie') as p:
+            p.return_value = 'b7becd02-1a3f-4c1d-a0e1-286ba121aef4'
+            # Put the user in the principal cache
+            BaseHandler(self.app, dummy_request).current_principal
+            handler = BaseHandler(self.app, dummy_request)
+            start = statement_count(handler.session)
+            principal = handler.current_principal
+            self.assertEqual(handler.get_current_user(), principal.name)
+            self.assertEqual(handler._get_current_user_id(), principal.id)
+            self.assertEqual(
+                handler.user_default_language,
+                principal.preferences['default_language']
+            )
+            self.assertEqual(statement_count(handler.session) - start, 0)
+            user = handler.current_user_model
+            self.assertEqual(user.id, principal.id)
+            self.assertIs(handler.current_user_model, user)
+        self.assertEqual(statement_count(handler.session) - start, 1)
+
+    def test_current_principal(self):
+        dummy_request = lambda: None
+        dummy_request.cookies = {}
+        dummy_connection = lambda: None
+        dummy_close_callback = lambda _: None
+        dummy_connection.set_close_callback = dummy_close_callback
+        dummy_request.connection = dummy_connection
+        user_id = 'a7becd02-1a3f-4c1d-a0e1-286ba121aef3'
+        survey_id = 'c0816b52-204f-41d4-aaf0-ac6ae2970925'
+        with patch.object(BaseHandler, '_current_user_cookie') as p:
+            p.return_value = user_id
+            principal = BaseHandler(self.app, dummy_request).current_principal
+        user = self.session.query(models.User).get(user_id)
+        self.assertEqual(principal.id, user_id)
+        self.assertEqual(principal.role, 'enumerator')
+        self.assertFalse(principal.is_administrator)
+        self.assertEqual(
+            principal.emails, tuple(email.address for email in user.emails)
+        )
+        self.assertEqual(
+            principal.allowed_survey_ids,
+            frozenset(survey.id for survey in user.allowed_surveys)
+        )
+        self.assertIn(survey_id, principal.allowed_survey_ids)
+        self.assertIs(self.app.principal_cache.get(user_id), principal)
+
+    def test_principal_emails_in_user_order(self):
+        user_id = 'a7becd02-1a3f-4c1d-a0e1-286ba121aef3'
+        with self.session.begin():
+            user = self.session.query(models.User).get(user_id)
+            user.emails.append(models.Email(address='0first@example.com'))
+            user.emails.append(models.Email(address='zlast@example.com'))
+        self.session.expire_all()
+        user = self.session.query(models.User).get(user_id)
+        principal = models.load_principal(self.session, user_id)
+        self.assertEqual(
+            principal.emails, tuple(email.address for email in user.emails)
+        )
+
+    def test_query_count_header(self):
+        response = self.fetch('/admin/', method='GET')
+        self.assertEqual(response.code, 200)
+        self.assertGreater(int(response.headers['X-Query-Count']), 0)
+
 
 class TestBaseAPIHandler(DokoHTTPTest):
     def test_api_version(self):
@@ -403,6 +502,27 @@ class TestEnumerate(DokoHTTPTest):
             )
         )
 
+    def test_get_public_survey_not_modified(self):
+        survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
+        url = '/enumerate/' + survey_id
+        response = self.fetch(url, method='GET')
+        self.assertEqual(response.code, 200)
+        etag = response.headers['Etag']
+
+        not_modified = self.fetch(
+            url, method='GET', headers={'If-None-Match': etag}
+        )
+        self.assertEqual(not_modified.code, 304, msg=not_modified.body)
+        self.assertEqual(not_modified.body, b'')
+        self.assertEqual(len(self.app.survey_cache), 1)
+
+        # Another user sees a different page
+        other_user = self.fetch(
+            url, method='GET', headers={'If-None-Match': etag},
+            _logged_in_user=None
+        )
+        self.assertEqual(other_user.code, 200)
+
     def test_get_public_survey_by_title_not_logged_in(self):
         survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
         with self.session.begin():
@@ -6,6 +6,7 @@ import datetime
 from decimal import Decimal
 import os
 from statistics import pstdev, stdev
+import tempfile
 import uuid
 import unittest
 
@@ -19,18 +20,23 @@ import psycopg2
 import dateutil.tz
 import dateutil.parser
 
+import sqlalchemy as sa
 from sqlalchemy import func, or_
 from sqlalchemy.exc import IntegrityError, DataError
-from sqlalchemy.orm.exc import FlushError
+from sqlalchemy.orm.exc import FlushError, NoResultFound
 
 from psycopg2.extras import NumericRange, DateRange, DateTimeRange
 
+from dokomoforms.cache import LRUCache
 import dokomoforms.models as models
 from dokomoforms.models.answer import IntegerAnswer
 import dokomoforms.exc as exc
 from dokomoforms.models.survey import Bucket
-from dokomoforms.models.util import column_search
+from dokomoforms.models.submission import _survey_daily_submissions_table
+from dokomoforms.models.util import column_search, statement_count
+from dokomoforms.models.async_db import compile_query
 from dokomoforms.handlers.api.v0.serializer import ModelJSONSerializer
+from dokomoforms.storage import FilesystemPhotoStorage
 
 
 class TestBase(unittest.TestCase):
@@ -57,6 +63,70 @@ class TestBase(unittest.TestCase):
             TypeError, models.ModelJSONEncoder().default, object()
         )
 
+    def test_str_slow_path(self):
+        user = models.User(name='</base>')
+        user._fast_json = False
+        self.assertEqual(
+            str(user),
+            json.dumps(user, cls=models.ModelJSONEncoder, indent=4)
+            .replace('</', '<\\/')
+        )
+        self.assertEqual(str(user), models.Base.__str__(models.User(
+            name='</base>'
+        )))
+
+    def test_fast_json_dumps_same_as_json_dumps(self):
+        node = models.construct_node(
+            type_constraint='multiple_choice',
+            title={'English': 'a</script>', 'Français': 'ç'},
+            choices=[models.Choice(choice_text={'English': 'b'})],
+        )
+        note = models.construct_node(
+            type_constraint='note', title={'English': '</'},
+            last_update_time=datetime.datetime.now(tz=dateutil.tz.tzutc()),
+        )
+        photo = models.Photo(
+            mime_type='image/png', size=1, created_on=datetime.date.today()
+        )
+        things = OrderedDict((
+            ('model', node),
+            ('models', [node, models.User(name='u'), note, photo]),
+            ('bytes', b'a'),
+            ('datetime', datetime.datetime.now(tz=dateutil.tz.tzutc())),
+            ('date', datetime.date.today()),
+            ('time', datetime.time(1, 2, 3)),
+            ('decimal', Decimal('2.3')),
+            ('range', NumericRange(1, 2, '[)')),
+            ('float', float('inf')),
+            ('tuple', (1, True, None, '')),
+            ('nested', {1: {'</': []}, None: {}}),
+        ))
+        for indent in (None, 4):
+            self.assertEqual(
+                models.fast_json_dumps(things, indent=indent),
+                json.dumps(things, cls=models.ModelJSONEncoder, indent=indent)
+                .replace('</', '<\\/')
+            )
+
+    def test_fast_json_dumps_compiles_field_plans(self):
+        photo = models.Photo(mime_type='image/png', size=1)
+        models.fast_json_dumps(photo)
+        converter = models.util._JSON_CONVERTERS[models.Photo]
+        self.assertIsNot(converter, models.Photo._asdict)
+        self.assertEqual(converter(photo), photo._asdict())
+
+        node = models.construct_node(
+            type_constraint='multiple_choice', title={'English': 'a'}
+        )
+        models.fast_json_dumps(node)
+        self.assertIs(
+            models.util._JSON_CONVERTERS[type(node)], type(node)._asdict
+        )
+
+    def test_fast_json_dumps_unserializable(self):
+        self.assertRaises(TypeError, models.fast_json_dumps, [object()])
+        self.assertRaises(TypeError, models.fast_json_dumps, {object(): 1})
+
     def test_create_engine(self):
         engine1 = models.create_engine()
         self.assertEqual(engine1.echo, None)
@@ -189,6 +259,124 @@ class TestUtil(DokoTest):
             found_node
         )
 
+    def test_compile_query(self):
+        with self.session.begin():
+            self.session.add_all((
+                models.construct_node(
+                    title={'English': 'a%a'},
+                    type_constraint='integer',
+                ),
+                models.construct_node(
+                    title={'English': 'aa'},
+                    type_constraint='integer',
+                ),
+            ))
+
+        query = column_search(
+            self.session.query(models.Node.id, models.Node.title),
+            model_cls=models.Node, column_name='title', search_term='%',
+            language='English',
+        )
+        sql, params = compile_query(query)
+        cursor = self.connection.connection.cursor()
+        cursor.execute(sql, params)
+        self.assertEqual(cursor.fetchall(), [tuple(row) for row in query])
+
+    def test_column_search_rank(self):
+        with self.session.begin():
+            self.session.add_all((
+                models.construct_node(
+                    title={'English': 'integer question'},
+                    type_constraint='integer',
+                ),
+                models.construct_node(
+                    title={'English': 'integer'},
+                    type_constraint='integer',
+                ),
+                models.construct_node(
+                    title={'English': 'integr'},
+                    type_constraint='integer',
+                ),
+                models.construct_node(
+                    title={'English': 'decimal'},
+                    type_constraint='integer',
+                ),
+            ))
+
+        def search(**kwargs):
+            return [
+                title['English'] for title, in column_search(
+                    self.session.query(models.Node.title),
+                    model_cls=models.Node, column_name='title',
+                    search_term='integer', language='English', **kwargs
+                )
+            ]
+
+        self.assertEqual(
+            sorted(search()), ['integer', 'integer question']
+        )
+        self.assertEqual(
+            search(rank=True), ['integer', 'integr', 'integer question']
+        )
+
+    def test_column_search_rank_regex(self):
+        self.assertRaises(
+            ValueError, column_search,
+            self.session.query(models.Node),
+            model_cls=models.Node, column_name='title', search_term='.*',
+            language='English', regex=True, rank=True,
+        )
+
+    def test_trigram_indexes(self):
+        indexes = {
+            name for name, in self.session.execute(
+                sa.text(
+                    'SELECT indexname FROM pg_indexes'
+                    " WHERE schemaname = :schema AND indexname LIKE '%trgm%'"
+                ),
+                {'schema': models.Base.metadata.schema},
+            )
+        }
+        self.assertEqual(
+            indexes,
+            {
+                'survey_title_trgm', 'auth_user_name_trgm',
+                'email_address_trgm', 'submission_submitter_name_trgm',
+                'survey_title_trgm_english', 'node_title_trgm_english',
+            }
+        )
+
+    def test_spatial_indexes(self):
+        tables = {
+            table for table, definition in self.session.execute(
+                sa.text(
+                    'SELECT tablename, indexdef FROM pg_indexes'
+                    ' WHERE schemaname = :schema'
+                ),
+                {'schema': models.Base.metadata.schema},
+            )
+            if 'USING gist (main_answer)' in definition
+        }
+        self.assertEqual(tables, {'answer_location', 'answer_facility'})
+
+    def test_photo_storage_constraints(self):
+        constraints = {
+            name for name, in self.session.execute(
+                sa.text(
+                    'SELECT conname FROM pg_constraint'
+                    ' WHERE conrelid = CAST(:table AS regclass)'
+                    " AND contype = 'c'"
+                ),
+                {'table': models.Base.metadata.schema + '.photo'},
+            )
+        }
+        self.assertTrue(
+            {
+                'image_only_in_database_storage',
+                'content_hash_outside_database_storage',
+            } <= constraints
+        )
+
 
 class TestColumnProperties(DokoTest):
     def _create_survey_node(self, type_constraint='integer'):
@@ -486,6 +674,90 @@ class TestColumnProperties(DokoTest):
             ]
         )
 
+    def test_question_stats_batched(self):
+        with self.session.begin():
+            survey = models.construct_survey(
+                survey_type='public',
+                creator=models.Administrator(name='creator'),
+                title={'English': 'survey'},
+                nodes=[
+                    models.construct_survey_node(
+                        node=models.construct_node(
+                            type_constraint=type_constraint,
+                            title={'English': type_constraint + str(i)},
+                            allow_multiple=True,
+                            **(
+                                {'choices': [
+                                    models.Choice(
+                                        choice_text={'English': 'one'}
+                                    ),
+                                    models.Choice(
+                                        choice_text={'English': 'two'}
+                                    ),
+                                ]}
+                                if type_constraint == 'multiple_choice'
+                                else {}
+                            )
+                        ),
+                    )
+                    for i, type_constraint in enumerate(
+                        ['integer', 'integer', 'multiple_choice', 'photo']
+                    )
+                ],
+            )
+            self.session.add(survey)
+        survey = self.session.query(models.Survey).one()
+        nodes = survey.nodes
+        two = nodes[2].node.choices[1]
+        with self.session.begin():
+            survey.submissions.append(
+                models.construct_submission(
+                    submission_type='public_submission',
+                    answers=[
+                        models.construct_answer(
+                            survey_node=nodes[0],
+                            type_constraint='integer',
+                            answer=i,
+                        ) for i in (1, 2, 2, 5)
+                    ] + [
+                        models.construct_answer(
+                            survey_node=nodes[2],
+                            type_constraint='multiple_choice',
+                            answer=two.id,
+                        ),
+                    ],
+                )
+            )
+            self.session.add(survey)
+        list(survey._sequentialize())
+
+        start = statement_count(self.session)
+        stats = {
+            stat['survey_node'].id: {
+                s['query']: s['result'] for s in stat['stats']
+            }
+            for stat in models.generate_question_stats(survey)
+        }
+
+        # One query per answer type, plus one for the choices
+        self.assertEqual(statement_count(self.session) - start, 4)
+        self.assertEqual(stats[nodes[0].id]['count'], 4)
+        self.assertEqual(stats[nodes[0].id]['min'], 1)
+        self.assertEqual(stats[nodes[0].id]['max'], 5)
+        self.assertEqual(stats[nodes[0].id]['sum'], 10)
+        self.assertEqual(stats[nodes[0].id]['avg'], 2.5)
+        self.assertEqual(stats[nodes[0].id]['mode'], 2)
+        self.assertEqual(
+            stats[nodes[0].id]['stddev_samp'],
+            models.answer_stddev_samp(nodes[0])
+        )
+        self.assertEqual(stats[nodes[1].id]['count'], 0)
+        self.assertIsNone(stats[nodes[1].id]['mode'])
+        self.assertEqual(
+            stats[nodes[2].id], {'count': 1, 'mode': two}
+        )
+        self.assertEqual(stats[nodes[3].id], {'count': 0})
+
     def test_question_stats_weird_type(self):
         survey_id = self._create_survey_node('photo').root_survey_id
         survey = self.session.query(models.Survey).get(survey_id)
@@ -732,6 +1004,46 @@ class TestUser(DokoTest):
             0
         )
 
+    def test_menu_surveys(self):
+        with self.session.begin():
+            admin = models.Administrator(name='adm')
+            self.session.add(models.Administrator(
+                name='this one',
+                surveys=[
+                    models.construct_survey(
+                        survey_type='public',
+                        title={'English': 'survey'},
+                        administrators=[admin],
+                    ),
+                    models.construct_survey(
+                        survey_type='public',
+                        title={'English': 'other survey'},
+                        administrators=[admin],
+                    ),
+                ],
+            ))
+
+        user = (
+            self.session.query(models.User).filter_by(name='this one').one()
+        )
+        cache = LRUCache(2)
+        surveys = models.menu_surveys(self.session, cache, user.id)
+        self.assertCountEqual(
+            [survey.id for survey in surveys],
+            [survey.id for survey in user.surveys]
+        )
+        self.assertEqual(
+            {survey.title['English'] for survey in surveys},
+            {'survey', 'other survey'}
+        )
+        self.assertIs(
+            models.menu_surveys(self.session, cache, user.id), surveys
+        )
+
+        admin_surveys = models.menu_surveys(self.session, None, admin.id, 1)
+        self.assertEqual(len(admin_surveys), 1)
+        self.assertEqual(admin_surveys[0].default_language, 'English')
+
     def test_most_recent_submissions(self):
         with self.session.begin():
             self.session.add_all((
@@ -1646,6 +1958,142 @@ class TestSurvey(DokoTest):
             '02:00:00'
         )
 
+    def test_submission_statistics_after_delete_and_update(self):
+        with self.session.begin():
+            self.session.add(
+                models.Administrator(
+                    name='creator',
+                    surveys=[
+                        models.construct_survey(
+                            survey_type='public',
+                            title={'English': 'survey'},
+                        ),
+                    ],
+                )
+            )
+
+        with self.session.begin():
+            survey = self.session.query(models.Survey).one()
+            survey.submissions.extend([
+                models.construct_submission(
+                    submission_type='public_submission',
+                    save_time=dateutil.parser.parse('2015/7/29 {}:00'.format(
+                        hour
+                    )),
+                ) for hour in (1, 2, 3)
+            ])
+            self.session.add(survey)
+
+        def statistics():
+            return (
+                self.session
+                .query(
+                    models.Survey.num_submissions,
+                    models.Survey.earliest_submission_time,
+                    models.Survey.latest_submission_time,
+                )
+                .one()
+            )
+
+        num, earliest, latest = statistics()
+        self.assertEqual(num, 3)
+        self.assertEqual(earliest.time().isoformat(), '01:00:00')
+        self.assertEqual(latest.time().isoformat(), '03:00:00')
+
+        with self.session.begin():
+            first = (
+                self.session
+                .query(models.Submission)
+                .order_by(models.Submission.save_time)
+                .first()
+            )
+            self.session.delete(first)
+
+        num, earliest, latest = statistics()
+        self.assertEqual(num, 2)
+        self.assertEqual(earliest.time().isoformat(), '02:00:00')
+        self.assertEqual(latest.time().isoformat(), '03:00:00')
+
+        with self.session.begin():
+            last = (
+                self.session
+                .query(models.Submission)
+                .order_by(models.Submission.save_time.desc())
+                .first()
+            )
+            last.save_time = dateutil.parser.parse('2015/7/29 0:30')
+
+        num, earliest, latest = statistics()
+        self.assertEqual(num, 2)
+        self.assertEqual(earliest.time().isoformat(), '00:30:00')
+        self.assertEqual(latest.time().isoformat(), '02:00:00')
+
+    def test_daily_submissions_after_insert_delete_and_update(self):
+        with self.session.begin():
+            self.session.add(
+                models.Administrator(
+                    name='creator',
+                    surveys=[
+                        models.construct_survey(
+                            survey_type='public',
+                            title={'English': 'survey'},
+                        ),
+                    ],
+                )
+            )
+
+        with self.session.begin():
+            survey = self.session.query(models.Survey).one()
+            survey.submissions.extend([
+                models.construct_submission(
+                    submission_type='public_submission',
+                    save_time=dateutil.parser.parse(save_time),
+                ) for save_time in (
+                    '2015/7/29 1:00', '2015/7/29 2:00', '2015/7/30 12:00'
+                )
+            ])
+            self.session.add(survey)
+
+        daily = _survey_daily_submissions_table.c
+
+        def daily_submissions():
+            return {
+                day.isoformat(): num
+                for day, num in (
+                    self.session
+                    .query(daily.day, daily.num_submissions)
+                    .filter(daily.survey_id == survey.id)
+                )
+            }
+
+        self.assertEqual(
+            daily_submissions(), {'2015-07-29': 2, '2015-07-30': 1}
+        )
+
+        with self.session.begin():
+            first = (
+                self.session
+                .query(models.Submission)
+                .order_by(models.Submission.save_time)
+                .first()
+            )
+            self.session.delete(first)
+
+        self.assertEqual(
+            daily_submissions(), {'2015-07-29': 1, '2015-07-30': 1}
+        )
+
+        with self.session.begin():
+            last = (
+                self.session
+                .query(models.Submission)
+                .order_by(models.Submission.save_time.desc())
+                .first()
+            )
+            last.save_time = dateutil.parser.parse('2015/7/29 3:00')
+
+        self.assertEqual(daily_submissions(), {'2015-07-29': 2})
+
     def test_administrators(self):
         with self.session.begin():
             creator = models.Administrator(name='creator')
@@ -2283,6 +2731,104 @@ class TestSurvey(DokoTest):
             2
         )
 
+    def test_load_survey_tree(self):
+        cn = models.construct_node
+        with self.session.begin():
+            mc_node = cn(
+                type_constraint='multiple_choice',
+                title={'English': 'A'},
+                choices=[
+                    models.Choice(choice_text={'English': 'one'}),
+                    models.Choice(choice_text={'English': 'two'}),
+                ],
+            )
+            self.session.add(
+                models.Administrator(
+                    name='creator',
+                    surveys=[
+                        models.construct_survey(
+                            survey_type='public',
+                            title={'English': 'survey'},
+                            nodes=[
+                                models.construct_survey_node(
+                                    node=mc_node,
+                                    sub_surveys=[
+                                        models.SubSurvey(
+                                            buckets=[
+                                                models.construct_bucket(
+                                                    bucket_type=(
+                                                        'multiple_choice'
+                                                    ),
+                                                    bucket=mc_node.choices[1],
+                                                ),
+                                            ],
+                                            nodes=[
+                                                models.construct_survey_node(
+                                                    node=cn(
+                                                        type_constraint=(
+                                                            'note'
+                                                        ),
+                                                        title={'English': 'B'},
+                                                    ),
+                                                ),
+                                                models.construct_survey_node(
+                                                    node=cn(
+                                                        type_constraint=(
+                                                            'integer'
+                                                        ),
+                                                        title={'English': 'C'},
+                                                    ),
+                                                ),
+                                            ],
+                                        ),
+                                    ],
+                                ),
+                                models.construct_survey_node(
+                                    node=cn(
+                                        type_constraint='integer',
+                                        title={'English': 'D'},
+                                    ),
+                                ),
+                            ],
+                        ),
+                    ],
+                )
+            )
+
+        survey_id = self.session.query(models.Survey.id).scalar()
+        self.session.expunge_all()
+        expected = json.dumps(
+            self.session.query(models.Survey).get(survey_id),
+            cls=models.ModelJSONEncoder,
+        )
+        self.session.expunge_all()
+
+        loaded = models.load_survey_tree(self.session, survey_id)
+        start = statement_count(self.session)
+        seq = list(loaded._sequentialize())
+        actual = json.dumps(loaded, cls=models.ModelJSONEncoder)
+        bucket = seq[0].sub_surveys[0].buckets[0]
+        self.assertEqual(bucket.bucket.choice_text['English'], 'two')
+
+        self.assertListEqual(
+            [sn.node.title['English'] for sn in seq], list('ABCD')
+        )
+        self.assertEqual(actual, expected)
+        self.assertEqual(statement_count(self.session) - start, 0)
+
+    def test_load_survey_tree_not_found(self):
+        self.assertRaises(
+            NoResultFound,
+            models.load_survey_tree, self.session, str(uuid.uuid4())
+        )
+
+    def test_load_survey_tree_custom_exception(self):
+        self.assertRaises(
+            ValueError,
+            models.load_survey_tree,
+            self.session, str(uuid.uuid4()), ValueError
+        )
+
 
 class TestSurveyNode(DokoTest):
     def test_factory_function_missing_type_constraint(self):
@@ -3752,6 +4298,88 @@ class TestAnswer(DokoTest):
             }
         )
 
+    def test_insert_answers(self):
+        with self.session.begin():
+            creator = models.Administrator(name='creator')
+            survey = models.Survey(
+                title={'English': 'survey'},
+                nodes=[
+                    models.construct_survey_node(
+                        node=models.construct_node(
+                            type_constraint='integer',
+                            title={'English': 'integer question'},
+                        ),
+                    ),
+                    models.construct_survey_node(
+                        node=models.construct_node(
+                            type_constraint='integer',
+                            title={'English': 'another integer question'},
+                        ),
+                        allow_dont_know=True,
+                    ),
+                    models.construct_survey_node(
+                        node=models.construct_node(
+                            type_constraint='location',
+                            title={'English': 'location question'},
+                        ),
+                    ),
+                ],
+            )
+            creator.surveys = [survey]
+
+            self.session.add(creator)
+
+        integer_node, dont_know_node, location_node = survey.nodes
+        with self.session.begin():
+            submission = models.PublicSubmission(survey=survey)
+            self.session.add(submission)
+            self.session.flush()
+            # Load the server defaults
+            self.assertIsNotNone(submission.save_time)
+            start = statement_count(self.session)
+            answers = models.insert_answers(
+                self.session, submission, [
+                    (integer_node, {
+                        'type_constraint': 'integer', 'answer': 3
+                    }),
+                    (dont_know_node, {
+                        'type_constraint': 'integer',
+                        'response': {
+                            'response_type': 'dont_know',
+                            'response': 'no idea',
+                        },
+                    }),
+                    (location_node, {
+                        'type_constraint': 'location',
+                        'answer': {'lng': 5, 'lat': -5},
+                    }),
+                ]
+            )
+
+        # One INSERT for the answer table and one per answer type table
+        self.assertEqual(statement_count(self.session) - start, 3)
+        self.assertEqual(
+            [answer.answer_number for answer in answers], [0, 1, 2]
+        )
+        self.assertEqual(answers[0].response['response'], 3)
+        self.assertEqual(answers[1].response['response'], 'no idea')
+        self.assertEqual(
+            answers[2].response['response'], {'lng': 5, 'lat': -5}
+        )
+        # Reading the answers doesn't go back to the database
+        self.assertEqual(statement_count(self.session) - start, 3)
+
+        self.assertEqual(
+            [
+                answer.response for answer in (
+                    self.session
+                    .query(models.Answer)
+                    .order_by(models.Answer.answer_number)
+                )
+            ],
+            [answer.response for answer in answers]
+        )
+
     def test_asdict(self):
         with self.session.begin():
             creator = models.Administrator(name='creator')
@@ -4260,6 +4888,75 @@ class TestAnswer(DokoTest):
             updated_answer.actual_photo_id
         )
 
+    def test_add_new_photo_to_session_with_storage(self):
+        with self.session.begin():
+            creator = models.Administrator(name='creator')
+            survey = models.Survey(
+                title={'English': 'survey'},
+                nodes=[
+                    models.construct_survey_node(
+                        node=models.construct_node(
+                            type_constraint='photo',
+                            title={'English': 'photo_question'},
+                        ),
+                    ),
+                ],
+            )
+            creator.surveys = [survey]
+
+            self.session.add(creator)
+
+        desired_id = str(uuid.uuid4())
+
+        with self.session.begin():
+            the_survey = self.session.query(models.Survey).one()
+            submission = models.PublicSubmission(
+                survey=the_survey,
+                answers=[
+                    models.construct_answer(
+                        survey_node=the_survey.nodes[0],
+                        type_constraint='photo',
+                        answer=desired_id,
+                    ),
+                ],
+            )
+
+            self.session.add(submission)
+
+        photo_path = os.path.join(
+            os.path.abspath('.'),
+            'dokomoforms/static/src/common/img/favicon.png'
+        )
+        with open(photo_path, 'rb') as photo_file:
+            photo_bytes = photo_file.read()
+
+        with tempfile.TemporaryDirectory() as photo_directory:
+            storage = FilesystemPhotoStorage(photo_directory)
+            models.add_new_photo_to_session(
+                self.session,
+                id=desired_id,
+                mime_type='png',
+                image=photo_bytes,
+                storage=storage,
+            )
+
+            photo = self.session.query(models.Photo).one()
+            self.assertEqual(photo.storage, 'filesystem')
+            self.assertIsNone(photo.image)
+            self.assertEqual(photo.size, len(photo_bytes))
+            self.assertEqual(b''.join(storage.chunks(photo)), photo_bytes)
+
+    def test_photo_image_only_in_database_storage(self):
+        with self.assertRaises(IntegrityError):
+            with self.session.begin():
+                self.session.add(models.Photo(
+                    id=str(uuid.uuid4()),
+                    mime_type='png',
+                    storage='filesystem',
+                    content_hash='0' * 64,
+                    image=b'image',
+                ))
+
     def test_add_new_photo_to_session_bogus_id(self):
         with self.session.begin():
             creator = models.Administrator(name='creator')
@@ -0,0 +1,93 @@
+"""Photo storage tests."""
+from base64 import b64encode
+import hashlib
+import os
+import tempfile
+import unittest
+
+from dokomoforms.storage import (
+    DatabasePhotoStorage, FilesystemPhotoStorage, photo_storages
+)
+
+
+class FakePhoto:
+    image = None
+    storage = None
+    content_hash = None
+    size = None
+
+
+class TestDatabasePhotoStorage(unittest.TestCase):
+    def test_store(self):
+        storage = DatabasePhotoStorage()
+        photo = FakePhoto()
+        storage.store(photo, b'image')
+        self.assertEqual(photo.image, b64encode(b'image'))
+        self.assertEqual(photo.storage, 'database')
+        self.assertEqual(
+            photo.content_hash, hashlib.sha256(b'image').hexdigest()
+        )
+        self.assertEqual(photo.size, 5)
+        self.assertEqual(b''.join(storage.chunks(photo)), b'image')
+        self.assertIsNone(storage.accel_redirect(photo))
+
+
+class TestFilesystemPhotoStorage(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def test_store(self):
+        storage = FilesystemPhotoStorage(self.directory)
+        photo = FakePhoto()
+        storage.store(photo, b'image')
+        content_hash = hashlib.sha256(b'image').hexdigest()
+        self.assertIsNone(photo.image)
+        self.assertEqual(photo.storage, 'filesystem')
+        self.assertEqual(photo.content_hash, content_hash)
+        self.assertEqual(photo.size, 5)
+        self.assertEqual(
+            storage.path(photo),
+            os.path.join(
+                self.directory, content_hash[:2], content_hash[2:4],
+                content_hash
+            )
+        )
+        self.assertEqual(b''.join(storage.chunks(photo)), b'image')
+
+    def test_chunks(self):
+        storage = FilesystemPhotoStorage(self.directory)
+        storage.chunk_size = 2
+        photo = FakePhoto()
+        storage.store(photo, b'image')
+        self.assertEqual(list(storage.chunks(photo)), [b'im', b'ag', b'e'])
+
+    def test_same_content_same_file(self):
+        storage = FilesystemPhotoStorage(self.directory)
+        photo_a, photo_b = FakePhoto(), FakePhoto()
+        storage.store(photo_a, b'image')
+        storage.store(photo_b, b'image')
+        self.assertEqual(storage.path(photo_a), storage.path(photo_b))
+        leaf = os.path.dirname(storage.path(photo_a))
+        self.assertEqual(os.listdir(leaf), [photo_a.content_hash])
+
+    def test_accel_redirect(self):
+        storage = FilesystemPhotoStorage(self.directory, '/protected/')
+        photo = FakePhoto()
+        storage.store(photo, b'image')
+        content_hash = photo.content_hash
+        self.assertEqual(
+            storage.accel_redirect(photo),
+            '/protected/{}/{}/{}'.format(
+                content_hash[:2], content_hash[2:4], content_hash
+            )
+        )
+        self.assertIsNone(
+            FilesystemPhotoStorage(self.directory).accel_redirect(photo)
+        )
+
+    def test_photo_storages(self):
+        storages = photo_storages(self.directory)
+        self.assertEqual(set(storages), {'database', 'filesystem'})
+        self.assertEqual(storages['filesystem'].directory, self.directory)
@@ -103,6 +103,14 @@ class TestFunctions(unittest.TestCase):
             webapp.ensure_that_user_wants_to_drop_schema
         )
 
+    def test_get_executor(self):
+        executor = webapp.get_executor(2)
+        self.assertIs(webapp.get_executor(2), executor)
+        self.assertEqual(executor.submit(sum, (1, 2)).result(), 3)
+
+    def test_get_executor_no_workers(self):
+        self.assertIsNone(webapp.get_executor(0))
+
 
 class TestApplication(unittest.TestCase):
     def test_init(self):
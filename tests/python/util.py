@@ -5,6 +5,7 @@ Also injects the --schema=doko_test option.
 """
 from contextlib import contextmanager
 from functools import wraps
+import tempfile
 import unittest
 from unittest.mock import patch
 from urllib.parse import urlencode
@@ -145,6 +146,9 @@ class DokoHTTPTest(DokoFixtureTest, LogTrapTestCase, AsyncHTTPTestCase):
         options.https = True
         options.debug = True
         options.demo = False
+        photo_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(photo_directory.cleanup)
+        options.photo_directory = photo_directory.name
         self.app = Application(self.session, options=options)
         return self.app
 
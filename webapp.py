@@ -8,6 +8,7 @@ of the PostgreSQL database.
 The application looks for gettext translation files like
 locale/{locale}/LC_MESSAGES/dokomoforms.mo
 """
+from concurrent.futures import ThreadPoolExecutor
 import os
 import textwrap
 import signal
@@ -34,7 +35,10 @@ if __name__ == '__main__':  # pragma: no cover
     parse_options()
 
 import dokomoforms.handlers as handlers
+from dokomoforms.cache import LRUCache
 from dokomoforms.models import create_engine, Base, UUID_REGEX
+from dokomoforms.models.async_db import create_pool
+from dokomoforms.storage import photo_storages
 from dokomoforms.handlers.api.v0 import (
     SurveyResource, SubmissionResource, PhotoResource, NodeResource,
     UserResource
@@ -123,6 +127,24 @@ def api_url(path, *args, **kwargs):
     )
 
 
+_executors = {}
+
+
+def get_executor(num_workers: int) -> ThreadPoolExecutor:
+    """Return the ThreadPoolExecutor for database work, or None.
+
+    Applications with the same number of workers share an executor.
+
+    :param num_workers: the maximum number of threads. If this is 0, return
+                        None and run the database work on the IOLoop.
+    """
+    if not num_workers:
+        return None
+    if num_workers not in _executors:
+        _executors[num_workers] = ThreadPoolExecutor(num_workers)
+    return _executors[num_workers]
+
+
 class Application(tornado.web.Application):
 
     """The tornado.web.Application for Dokomo Forms."""
@@ -225,6 +247,11 @@ class Application(tornado.web.Application):
                 '/surveys/({uuid})/activity/?', sur.as_view('activity'),
                 name='survey_activity'
             ),
+            api_url(
+                '/surveys/({uuid})/nodes/({uuid})/map/?',
+                sur.as_view('map_data'),
+                name='survey_node_map'
+            ),
             api_url(
                 '/surveys/activity/?', sur.as_view('activity_all'),
                 name='activity_all'
@@ -235,12 +262,20 @@ class Application(tornado.web.Application):
                 '/submissions/?', SubmissionResource.as_list(),
                 name='submissions'
             ),
+            api_url(
+                '/submissions/batch/?', SubmissionResource.as_view('batch'),
+                name='submission_batch'
+            ),
             api_url(
                 '/submissions/({uuid})/?', SubmissionResource.as_detail(),
                 name='submission'
             ),
             # * * Photos
             api_url('/photos/?', PhotoResource.as_list(), name='photos'),
+            api_url(
+                '/photos/({uuid})/image/?', PhotoResource.as_view('image'),
+                name='photo_image'
+            ),
             api_url(
                 '/photos/({uuid})/?', PhotoResource.as_detail(), name='photo'
             ),
@@ -302,10 +337,49 @@ class Application(tornado.web.Application):
                     'DROP SCHEMA IF EXISTS {} CASCADE'.format(options.schema)
                 ))
             Base.metadata.create_all(engine)
-            Session = sessionmaker(bind=engine, autocommit=True)
-            self.session = Session()
+            # Each request gets its own session (see BaseHandler.session)
+            self.session_factory = sessionmaker(bind=engine, autocommit=True)
+            self.session = self.session_factory()
+            # Read-only API requests can skip the executor
+            # (see dokomoforms.models.async_db)
+            self.db_pool = create_pool(options.async_db_pool_size)
         else:
+            # Every request uses the supplied session
+            self.session_factory = None
             self.session = session
+            self.db_pool = None
+
+        self.executor = get_executor(options.db_executor_workers)
+
+        # Fully loaded surveys (see dokomoforms.models.snapshot)
+        self.survey_cache = LRUCache(
+            options.survey_cache_size, ttl=options.survey_cache_ttl
+        )
+
+        # Logged-in users (see dokomoforms.models.principal)
+        self.principal_cache = LRUCache(
+            options.principal_cache_size, ttl=options.principal_cache_ttl
+        )
+
+        # The survey menu of each administrator (see menu_surveys)
+        self.menu_cache = LRUCache(
+            options.principal_cache_size, ttl=options.principal_cache_ttl
+        )
+
+        # API tokens that passed bcrypt (see BaseResource.is_authenticated)
+        self.token_cache = LRUCache(
+            options.token_cache_size, ttl=options.token_cache_ttl
+        )
+
+        # Where photos are read from, by Photo.storage, and written to
+        # (see dokomoforms.storage)
+        photo_directory = options.photo_directory
+        if photo_directory is None:
+            photo_directory = os.path.join(_pwd, 'photos')
+        self.photo_storages = photo_storages(
+            photo_directory, options.photo_accel_redirect
+        )
+        self.photo_storage = self.photo_storages[options.photo_storage]
 
 
 def start_http_server(http_server, port):  # pragma: no cover
@@ -379,7 +453,10 @@ def main(msg=None):  # pragma: no cover
         logging.getLogger('sqlalchemy').setLevel(log_level)
     if options.kill:
         ensure_that_user_wants_to_drop_schema()
-    http_server = tornado.httpserver.HTTPServer(Application(), xheaders=True)
+    application = Application()
+    if application.db_pool is not None:
+        tornado.ioloop.IOLoop.current().run_sync(application.db_pool.connect)
+    http_server = tornado.httpserver.HTTPServer(application, xheaders=True)
     tornado.locale.load_gettext_translations(
         os.path.join(_pwd, 'locale'), 'dokomoforms'
     )